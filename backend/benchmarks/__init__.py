@@ -0,0 +1,27 @@
+"""
+Benchmarks and accuracy reports for the processing pipeline.
+
+Run from the backend directory as modules, e.g. `python -m benchmarks.quantization`.
+"""
+import glob
+import os
+
+from index import IndexWriter
+import projects
+
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test_data')
+
+
+def test_files():
+    """Return paths of the bundled test data CSVs."""
+    return sorted(glob.glob(os.path.join(TEST_DATA_DIR, '*.csv')))
+
+
+def build_index(csv_path, index_path, language='english', tokenization='utterances'):
+    """Index `csv_path` at `index_path` the same way as project creation does."""
+    with open(csv_path, encoding='utf-8', errors='ignore') as f:
+        files = {os.path.basename(csv_path): f.read()}
+    index_writer = IndexWriter(index_path)
+    projects.index_files(index_writer, files, language, tokenization)
+    index_writer.finish()
@@ -0,0 +1,66 @@
+"""
+Accuracy report for quantized embeddings.
+
+Indexes each bundled test data CSV, stores its embedding slice at every supported
+precision and compares the recurrence matrices and themes of `generate_recurrence`
+against the float32 slice.
+
+    python -m benchmarks.quantization [model ...]
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+from benchmarks import build_index, test_files
+import embeddings
+from index import IndexReader, IndexUpdater
+import processing
+
+
+MODELS = ('composition', 'composition-delta')
+
+
+def _recurrence(index_path, model, precision, vectors):
+    """Run `generate_recurrence` with the embedding slice stored at `precision`."""
+    data, scales = embeddings.quantize(vectors, precision)
+    updater = IndexUpdater(index_path)
+    updater.save_term_embeddings(data, scales)
+    updater.finish()
+    result = processing.generate_recurrence(index_path, model, limit=None, include_text=False)
+    size = data.nbytes + (scales.nbytes if scales is not None else 0)
+    return (np.array(result['recurrence_matrix']), [u.get('themes') for u in result['utterances']], size)
+
+
+def report(models=MODELS):
+    """Print accuracy of each quantized precision against float32 for all test files."""
+    print('{:<28} {:<18} {:<8} {:>10} {:>10} {:>10} {:>8}'.format(
+        'File', 'Model', 'Precision', 'Bytes', 'Max err', 'Mean err', 'Themes'
+    ))
+    for csv_path in test_files():
+        index_path = tempfile.mkdtemp()
+        try:
+            build_index(csv_path, index_path)
+            terms = IndexReader(index_path).get_terms_ordered()
+            vectors = processing.get_term_embeddings(terms)
+            updater = IndexUpdater(index_path)
+            updater.save_ignored_terms(processing.get_term_vectors(terms)[1])
+            updater.finish()
+            for model in models:
+                reference, reference_themes, _ = _recurrence(index_path, model, 'float32', vectors)
+                for precision in embeddings.PRECISIONS:
+                    matrix, themes, size = _recurrence(index_path, model, precision, vectors)
+                    errors = np.abs(matrix - reference)
+                    agreement = np.mean([t == r for t, r in zip(themes, reference_themes)]) if themes else 1
+                    print('{:<28} {:<18} {:<8} {:>10} {:>10.2e} {:>10.2e} {:>7.1%}'.format(
+                        os.path.basename(csv_path)[:28], model, precision, size,
+                        errors.max(initial=0), errors.mean() if errors.size else 0, agreement
+                    ))
+        finally:
+            shutil.rmtree(index_path, True)
+
+
+if __name__ == '__main__':
+    report(sys.argv[1:] or MODELS)
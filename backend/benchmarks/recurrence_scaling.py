@@ -0,0 +1,50 @@
+"""
+Thread scaling benchmark for the tiled recurrence engine.
+
+Computes recurrence of random composition-like (dense) and delta embeddings in
+fixed size tiles for 1 to N threads and reports the time and speedup of each.
+Limit BLAS to a single thread (e.g. OPENBLAS_NUM_THREADS=1) to measure the pool
+alone.
+
+    python -m benchmarks.recurrence_scaling [n_utterances] [max_threads] [block_size]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+from scipy import sparse
+
+import recurrence
+
+
+def scaling(n_utterances=8000, max_threads=os.cpu_count() or 1, block_size=1024, n_dims=300, n_terms=5000):
+    """Print timings of computing recurrence with 1, 2, 4... up to `max_threads` threads."""
+    random = np.random.RandomState(0)
+    dense = random.normal(size=(n_utterances, n_dims))
+    terms = sparse.random(n_utterances, n_terms, density=0.002, random_state=random, format='csr')
+    models = (
+        ('composition', recurrence.UtteranceEmbeddings(dense)),
+        ('composition-delta', recurrence.UtteranceEmbeddings(dense, terms)),
+    )
+
+    threads = []
+    n = 1
+    while n < max_threads:
+        threads.append(n)
+        n *= 2
+    threads.append(max_threads)
+
+    print('{:<18} {:>8} {:>10} {:>8}'.format('Model', 'Threads', 'Seconds', 'Speedup'))
+    for name, embeddings in models:
+        baseline = None
+        for workers in threads:
+            start = time.perf_counter()
+            recurrence.compute_matrix(embeddings, recurrence.DTYPE, workers, block_size)
+            seconds = time.perf_counter() - start
+            baseline = baseline or seconds
+            print('{:<18} {:>8} {:>10.2f} {:>7.1f}x'.format(name, workers, seconds, baseline / seconds))
+
+
+if __name__ == '__main__':
+    scaling(*[int(arg) for arg in sys.argv[1:4]])
@@ -0,0 +1,80 @@
+"""
+Benchmark of the term layout engines.
+
+Lays out the vocabulary of each bundled test data CSV (or, given a number of terms,
+that many rows of the embedding table) with every layout engine, and reports the
+time taken, the share of each term's nearest neighbours in embedding space kept
+among its nearest neighbours in the layout, and the share of its layout neighbours
+in common with the 'tsne' layout. t-SNE is skipped above `TSNE_MAX_TERMS` terms.
+
+    python -m benchmarks.term_layout [n_terms]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from benchmarks import build_index, test_files
+from index import IndexReader
+import layout
+import processing
+import registry
+import util
+
+
+N_NEIGHBOURS = 10
+TSNE_MAX_TERMS = 10000
+
+
+def _layout_neighbours(positions, k=N_NEIGHBOURS):
+    return cKDTree(positions).query(positions, k=k + 1)[1][:, 1:]
+
+
+def _overlap(a, b):
+    """Return the mean share of neighbours in common between rows of neighbour indices `a` and `b`."""
+    return np.mean([len(set(x) & set(y)) / len(x) for x, y in zip(a.tolist(), b.tolist())])
+
+
+def compare(name, vectors):
+    """Print timings and neighbour agreement of each layout engine for `vectors`."""
+    k = min(N_NEIGHBOURS, len(vectors) - 1)
+    neighbours = layout.nearest_neighbours(vectors, k, n_probes=len(vectors))[0]  # Exact
+    layouts = {}
+    for engine in sorted(layout.ENGINES, key=lambda engine: engine != 'tsne'):
+        if engine == 'tsne' and not 5 < len(vectors) <= TSNE_MAX_TERMS:  # More terms than its perplexity
+            continue
+        start = time.perf_counter()
+        positions = layout.layout(vectors, engine)
+        seconds = time.perf_counter() - start
+        layouts[engine] = _layout_neighbours(positions, k)
+        print('{:<28} {:<6} {:>8} {:>10.2f} {:>10.1%} {:>10}'.format(
+            name[:28], engine, len(vectors), seconds, _overlap(neighbours, layouts[engine]),
+            '{:.1%}'.format(_overlap(layouts['tsne'], layouts[engine])) if 'tsne' in layouts else '-'
+        ))
+
+
+def report(n_terms=None):
+    """Print the benchmark for the test data vocabularies, or `n_terms` rows of the embedding table."""
+    print('{:<28} {:<6} {:>8} {:>10} {:>10} {:>10}'.format(
+        'Vocabulary', 'Engine', 'Terms', 'Seconds', 'Kept', 'As t-SNE'
+    ))
+    if n_terms:
+        vectors = registry.get('embeddings').take(np.arange(n_terms), dtype=np.float64)
+        compare('embeddings[:{}]'.format(n_terms), util.normalize_rows(vectors))
+        return
+    for csv_path in test_files():
+        index_path = tempfile.mkdtemp()
+        try:
+            build_index(csv_path, index_path)
+            vectors, _ = processing.get_term_vectors(IndexReader(index_path).get_terms_ordered())
+            compare(os.path.basename(csv_path), np.asarray(vectors, dtype=np.float64))
+        finally:
+            shutil.rmtree(index_path, True)
+
+
+if __name__ == '__main__':
+    report(*[int(arg) for arg in sys.argv[1:2]])
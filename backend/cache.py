@@ -0,0 +1,260 @@
+"""
+Disk cache of recurrence results.
+
+Results are stored in the `cache` directory of each project, keyed by the parameters
+they were computed with, and stamped with the index files they were computed from, so
+rewriting the index invalidates them. Each project's cache is kept within a size budget
+by evicting its least recently used entries.
+
+Arrays (and the components of sparse matrices) are stored as `.npy` files and returned
+memory-mapped, so several processes can share one cached matrix, and reading a few
+rows of it doesn't load the rest. All files of an entry are named after its key
+('<name>-<digest>'), and are evicted together.
+
+Recurrence matrices of appended utterances are cached as blocks of rows (see
+`recurrence.BlockMatrix`): the blocks of the matrix before appending are linked
+into the new entry as they are, and only the block of appended rows is written.
+"""
+from hashlib import sha1
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import ujson as json
+
+import recurrence
+from index import EMBEDDINGS_FILE, EMBEDDING_SCALES_FILE, INDEX_FILE
+
+
+CACHE_DIR = 'cache'
+STAMP_FILE = 'stamp.json'
+CSR_COMPONENTS = ('data', 'indices', 'indptr')
+
+# Size budget (bytes) of the cache of each project
+BUDGET = int(os.environ.get('DISCURSIS_CACHE_BUDGET', 1024 * 1024 * 1024))
+
+
+def _stamp(project_dir):
+    """Identify the current version of the index files in `project_dir`."""
+    stamp = {}
+    for filename in (INDEX_FILE, EMBEDDINGS_FILE, EMBEDDING_SCALES_FILE):
+        try:
+            stat = os.stat(os.path.join(project_dir, filename))
+            stamp[filename] = [stat.st_mtime_ns, stat.st_size]
+        except FileNotFoundError:
+            pass
+    return stamp
+
+
+class Cache:
+    """Cache of results computed from the index of a project."""
+
+    def __init__(self, project_dir, budget=BUDGET):
+        """Open the cache of `project_dir`, clearing it if the index has been rewritten since."""
+        self.directory = os.path.join(project_dir, CACHE_DIR)
+        self.budget = budget
+        stamp = _stamp(project_dir)
+        try:
+            with open(os.path.join(self.directory, STAMP_FILE)) as f:
+                valid = json.load(f) == stamp
+        except (OSError, ValueError):
+            valid = False
+        if not valid:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            os.makedirs(self.directory, exist_ok=True)
+            self._write(STAMP_FILE, lambda path: _dump_json(path, stamp))
+
+    def _path(self, name, params, extension):
+        """Return the path of the file of entry `name` for `params` with `extension`."""
+        digest = sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, '{}-{}{}'.format(name, digest, extension))
+
+    def _write(self, filename, write):
+        """Write a file with `write(path)` to a temporary path, then move it into place atomically."""
+        fd, path = tempfile.mkstemp(suffix=os.path.splitext(filename)[1], prefix='.', dir=self.directory)
+        os.close(fd)
+        try:
+            write(path)
+            os.replace(path, os.path.join(self.directory, filename))
+        except BaseException:
+            os.remove(path)
+            raise
+
+    def _evict(self, keep):
+        """Evict least recently used entries, except that of file `keep`, until the cache fits in the budget."""
+        entries = {}
+        for entry in os.scandir(self.directory):
+            # Skip the stamp and files still being written
+            if entry.name != STAMP_FILE and not entry.name.startswith('.') and entry.is_file():
+                stat = entry.stat()
+                used, size, paths = entries.get(_key(entry.name), (0, 0, []))
+                entries[_key(entry.name)] = (max(used, stat.st_mtime_ns), size + stat.st_size, paths + [entry.path])
+        size = sum(entry_size for _, entry_size, _ in entries.values())
+        for key, (_, entry_size, paths) in sorted(entries.items(), key=lambda item: item[1][0]):
+            if size <= self.budget:
+                break
+            if key != _key(os.path.basename(keep)):
+                for path in paths:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                size -= entry_size
+
+    def get_json(self, name, params):
+        """Return the cached JSON value `name` for `params`, or None."""
+        path = self._path(name, params, '.json')
+        try:
+            os.utime(path)  # Mark as recently used
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put_json(self, name, params, value):
+        """Cache the JSON `value` of `name` for `params`."""
+        path = self._path(name, params, '.json')
+        self._write(os.path.basename(path), lambda temp_path: _dump_json(temp_path, value))
+        self._evict(path)
+        return value
+
+    def get_array(self, name, params, extension='.npy'):
+        """Return the cached array `name` for `params` memory-mapped read-only, or None."""
+        path = self._path(name, params, extension)
+        try:
+            os.utime(path)  # Mark as recently used
+            return np.load(path, mmap_mode='r')
+        except FileNotFoundError:
+            return None
+
+    def put_array(self, name, params, compute, extension='.npy', evict=True):
+        """Cache the array `name` for `params` written as `.npy` by `compute(path)`, returning it memory-mapped."""
+        path = self._path(name, params, extension)
+        self._write(os.path.basename(path), compute)
+        if evict:
+            self._evict(path)
+        return np.load(path, mmap_mode='r')
+
+    def get_matrix(self, name, params):
+        """
+        Return the cached dense or sparse (CSR) matrix `name` for `params` with memory-mapped data.
+
+        Returns None if the matrix, or any part of it, isn't cached.
+        """
+        description = self.get_json(name, params)
+        if description is None:
+            return None
+        if description['format'] == 'dense':
+            return self.get_array(name, params)
+        if description['format'] == 'blocks':
+            blocks = [self.get_array(name, params, '.{}.npy'.format(i)) for i in range(description['count'])]
+            if any(block is None for block in blocks):
+                return None
+            return recurrence.BlockMatrix(blocks)
+        components = [self.get_array(name, params, '.{}.npy'.format(component)) for component in CSR_COMPONENTS]
+        if any(component is None for component in components):
+            return None
+        from scipy.sparse import csr_matrix
+        return csr_matrix(tuple(components), shape=description['shape'])
+
+    def put_matrix(self, name, params, matrix):
+        """
+        Cache the dense or sparse (CSR) `matrix` `name` for `params`, returning it with memory-mapped data.
+
+        Dense matrices may also be given as a function `compute(path)` writing them as `.npy`. The
+        description of the matrix is written after its data, so the entry is only found once complete.
+        """
+        if callable(matrix):
+            self.put_array(name, params, matrix, evict=False)
+            description = {'format': 'dense', 'params': params}
+        elif isinstance(matrix, np.ndarray):
+            self.put_array(name, params, lambda path: np.save(path, matrix), evict=False)
+            description = {'format': 'dense', 'params': params}
+        else:
+            matrix = matrix.tocsr()
+            for component in CSR_COMPONENTS:
+                self.put_array(
+                    name, params, lambda path: np.save(path, getattr(matrix, component)),
+                    '.{}.npy'.format(component), evict=False
+                )
+            description = {'format': 'csr', 'shape': list(matrix.shape), 'params': params}
+        self.put_json(name, params, description)
+        return self.get_matrix(name, params)
+
+    def extend_matrix(self, name, params, source, compute):
+        """
+        Cache the dense matrix `name` for `params` as that of cache `source` with a block of rows appended.
+
+        The block is written as `.npy` by `compute(path)`. Existing blocks are linked rather than copied,
+        so only the new block is written. Returns the `recurrence.BlockMatrix`, or None if `source`
+        doesn't have the matrix.
+        """
+        description = source.get_json(name, params)
+        if description is None or description['format'] not in ('dense', 'blocks'):
+            return None
+        if description['format'] == 'dense':
+            paths = [source._path(name, params, '.npy')]
+        else:
+            paths = [source._path(name, params, '.{}.npy'.format(i)) for i in range(description['count'])]
+        for i, path in enumerate(paths):
+            target = self._path(name, params, '.{}.npy'.format(i))
+            try:
+                os.link(path, target)
+            except FileNotFoundError:
+                return None  # Evicted since
+            except OSError:
+                shutil.copyfile(path, target)
+        self._write(os.path.basename(self._path(name, params, '.{}.npy'.format(len(paths)))), compute)
+        self.put_json(name, params, {'format': 'blocks', 'count': len(paths) + 1, 'params': params})
+        return self.get_matrix(name, params)
+
+    def find_matrices(self, name):
+        """Return the params of the cached matrices `name`."""
+        found = []
+        for entry in os.scandir(self.directory):
+            # Entries are named '<name>-<sha1 hex digest>.json'
+            prefix, _, digest = entry.name[:-len('.json')].rpartition('-')
+            if prefix == name and len(digest) == 40 and entry.name.endswith('.json'):
+                try:
+                    with open(entry.path) as f:
+                        found.append(json.load(f)['params'])
+                except (OSError, ValueError, KeyError):
+                    pass
+        return found
+
+    def detach(self):
+        """
+        Move the entries of this cache aside, e.g. before updating the index.
+
+        Returns a cache of the moved entries, which is no longer invalidated with the index;
+        `clear` removes it once done, or `restore` moves it back.
+        """
+        path = tempfile.mkdtemp(prefix='.' + CACHE_DIR + '-', dir=os.path.dirname(self.directory))
+        os.rmdir(path)
+        os.rename(self.directory, path)
+        detached = Cache.__new__(Cache)
+        detached.directory = path
+        detached.budget = self.budget
+        return detached
+
+    def restore(self, project_dir):
+        """Move the entries of this detached cache back as the cache of `project_dir`, replacing its entries."""
+        directory = os.path.join(project_dir, CACHE_DIR)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.rename(self.directory, directory)
+        self.directory = directory
+
+    def clear(self):
+        """Remove all entries of this cache."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _key(filename):
+    """Return the key of the entry that `filename` belongs to."""
+    return filename.split('.', 1)[0]
+
+
+def _dump_json(path, value):
+    with open(path, 'w') as f:
+        json.dump(value, f)
@@ -1,4 +1,5 @@
 """Class-based application configuration."""
+import os
 
 
 class ConfigClass(object):
@@ -18,6 +19,10 @@ class ConfigClass(object):
     CELERY_BROKER_URL = 'redis://localhost:6379',
     CELERY_RESULT_BACKEND = 'redis://localhost:6379'
 
+    # Shared resources loaded before worker processes are forked (Celery always, WSGI if enabled)
+    PRELOAD_RESOURCES = ('embeddings', 'stopwords', 'jieba', 'spacy')
+    PRELOAD_ON_IMPORT = os.environ.get('DISCURSIS_PRELOAD', '').lower() in ('1', 'true', 'yes')
+
     # Flask-SQLAlchemy settings
     SQLALCHEMY_DATABASE_URI = 'sqlite:///storage.db'    # File-based SQL database
     SQLALCHEMY_TRACK_MODIFICATIONS = False    # Avoids SQLAlchemy warning
@@ -0,0 +1,237 @@
+"""
+Binary store for the paraphrase embeddings.
+
+The text distributions of the embeddings are converted once into a float32
+matrix (`vectors.npy`) and a term vocabulary (`vocab.txt`, one term per row).
+Loading the store memory-maps the matrix, so processes share its pages through
+the OS page cache and only touch the rows they actually use.
+
+The matrix can also be kept in a quantized precision (`float16`, or `int8` with
+a scale per row), selected with the `DISCURSIS_EMBEDDING_PRECISION` environment
+variable. Quantized variants are derived from the float32 matrix on first use.
+
+The store can also hold a global 2D layout of the whole vocabulary (`layout.npy`),
+so projects can look up term positions instead of laying out their own terms.
+
+Run this module as a script to (re)build the store, with `--layout` to also
+(re)build the global layout:
+
+    python embeddings.py [--layout] [precision ...]
+"""
+import os
+import sys
+
+import numpy as np
+
+import registry
+
+
+RESOURCES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources')
+STORE_DIR = os.path.join(RESOURCES_DIR, 'embeddings')
+VECTORS_FILE = 'vectors.npy'
+VOCAB_FILE = 'vocab.txt'
+LAYOUT_FILE = 'layout.npy'
+N_DIMS = 300
+PRECISIONS = ('float32', 'float16', 'int8')
+PRECISION = os.environ.get('DISCURSIS_EMBEDDING_PRECISION', 'float32')
+
+
+def quantize(vectors, precision=PRECISION):
+    """
+    Quantize float `vectors` to `precision`.
+
+    Returns (data, scales), where `scales` holds the per-row scale factors for `int8`
+    and is `None` otherwise.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError('Unsupported embedding precision {}'.format(precision))
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if precision != 'int8':
+        return (vectors.astype(precision), None)
+    scales = np.abs(vectors).max(axis=1, initial=0) / 127
+    scales[scales == 0] = 1
+    data = np.rint(vectors / scales[:, None]).astype(np.int8)
+    return (data, scales.astype(np.float32))
+
+
+def dequantize(data, scales=None, dtype=np.float32):
+    """Restore float vectors of `dtype` from quantized `data` and optional per-row `scales`."""
+    if scales is None:
+        return np.asarray(data, dtype=dtype)
+    return np.asarray(data, dtype=dtype) * np.asarray(scales, dtype=dtype)[:, None]
+
+
+def _vectors_file(precision):
+    """Return filenames of the vectors (and scales) for `precision` within a store."""
+    if precision == 'float32':
+        return (VECTORS_FILE, None)
+    if precision == 'int8':
+        return ('vectors-int8.npy', 'scales-int8.npy')
+    return ('vectors-{}.npy'.format(precision), None)
+
+
+def _read_paragram(path):
+    """Yield (term, values) pairs from the space separated paragram text format."""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            parts = line.rstrip('\n').split(' ')
+            yield parts[0], parts[1:]
+
+
+def _read_zh(path):
+    """Yield (term, values) pairs from the tab/comma separated ZH format."""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t')
+            yield parts[0], parts[1].split(',')
+
+
+SOURCES = (
+    ('paragram-phrase-XXL.txt', _read_paragram),
+    ('zh.tsv', _read_zh),
+)
+
+
+def convert(resources_dir=RESOURCES_DIR, store_dir=STORE_DIR):
+    """
+    Convert the text embeddings in `resources_dir` into a binary store at `store_dir`.
+
+    Terms are kept from the first source that defines them, so PP-XXL takes precedence
+    over the ZH embeddings.
+    """
+    vocab = {}
+    vectors = []
+    for filename, read in SOURCES:
+        for term, values in read(os.path.join(resources_dir, filename)):
+            if term not in vocab:
+                vocab[term] = len(vectors)
+                vectors.append(np.array(values, dtype=np.float32))
+
+    # Write to temporary files first so a partially written store is never loaded
+    os.makedirs(store_dir, exist_ok=True)
+    vectors_path = os.path.join(store_dir, VECTORS_FILE)
+    vocab_path = os.path.join(store_dir, VOCAB_FILE)
+    with open(vectors_path + '.tmp', 'wb') as f:
+        np.save(f, np.vstack(vectors) if vectors else np.zeros((0, N_DIMS), dtype=np.float32))
+    with open(vocab_path + '.tmp', 'w', encoding='utf-8') as f:
+        f.writelines(term + '\n' for term in vocab)
+    os.replace(vectors_path + '.tmp', vectors_path)
+    os.replace(vocab_path + '.tmp', vocab_path)
+
+
+def convert_precision(precision, store_dir=STORE_DIR):
+    """Derive the quantized `precision` variant of the float32 store at `store_dir`."""
+    vectors_file, scales_file = _vectors_file(precision)
+    data, scales = quantize(np.load(os.path.join(store_dir, VECTORS_FILE), mmap_mode='r'), precision)
+    for filename, array in ((vectors_file, data), (scales_file, scales)):
+        if filename:
+            path = os.path.join(store_dir, filename)
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, array)
+            os.replace(path + '.tmp', path)
+
+
+def build_layout(store_dir=STORE_DIR, engine=None, progress=None):
+    """
+    Lay out all terms of the float32 store at `store_dir` in 2D with layout `engine`.
+
+    Positions are saved alongside the vectors, to be looked up by `EmbeddingStore.get_layout`.
+    """
+    import layout
+
+    vectors = np.load(os.path.join(store_dir, VECTORS_FILE), mmap_mode='r')
+    positions = layout.layout(vectors, engine, progress).astype(np.float32)
+    path = os.path.join(store_dir, LAYOUT_FILE)
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, positions)
+    os.replace(path + '.tmp', path)
+
+
+class EmbeddingStore:
+    """Memory-mapped term embeddings with a term -> row vocabulary."""
+
+    def __init__(self, store_dir=STORE_DIR, precision='float32'):
+        """Open the store at `store_dir` with vectors in `precision`."""
+        vectors_file, scales_file = _vectors_file(precision)
+        self.precision = precision
+        self.vectors = np.load(os.path.join(store_dir, vectors_file), mmap_mode='r')
+        self.scales = np.load(os.path.join(store_dir, scales_file), mmap_mode='r') if scales_file else None
+        with open(os.path.join(store_dir, VOCAB_FILE), encoding='utf-8') as f:
+            self.vocab = {line.rstrip('\n'): i for i, line in enumerate(f)}
+        self.n_dims = self.vectors.shape[1]
+
+        # The global layout is optional, and only used if it covers the current vocabulary
+        self.layout = None
+        layout_path = os.path.join(store_dir, LAYOUT_FILE)
+        if os.path.exists(layout_path):
+            layout = np.load(layout_path, mmap_mode='r')
+            if len(layout) == len(self.vocab):
+                self.layout = layout
+
+    def __contains__(self, term):
+        return term in self.vocab
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def get_rows(self, terms):
+        """Return (rows, skipped_terms) with the store rows of all known `terms`."""
+        rows = []
+        skipped_terms = []
+        for term in terms:
+            row = self.vocab.get(term)
+            if row is None:
+                skipped_terms.append(term)
+            else:
+                rows.append(row)
+        return (np.array(rows, dtype=np.int64), skipped_terms)
+
+    def take(self, rows, dtype=np.float32):
+        """Return the (dequantized) vectors at `rows`."""
+        return dequantize(self.vectors[rows], self.scales[rows] if self.scales is not None else None, dtype)
+
+    def get_vectors(self, terms, dtype=np.float64):
+        """Return matrix with a row for each of `terms`, zero for unknown terms."""
+        matrix = np.zeros((len(terms), self.n_dims), dtype=dtype)
+        positions = []
+        rows = []
+        for i, term in enumerate(terms):
+            row = self.vocab.get(term)
+            if row is not None:
+                positions.append(i)
+                rows.append(row)
+        if rows:
+            matrix[positions] = self.take(rows, dtype)
+        return matrix
+
+    def get_layout(self, terms):
+        """
+        Return (positions, skipped_terms) of all known `terms` in the global layout.
+
+        Raises `ValueError` if the store has no global layout (see `build_layout`).
+        """
+        if self.layout is None:
+            raise ValueError('Embedding store has no global layout')
+        rows, skipped_terms = self.get_rows(terms)
+        return (np.asarray(self.layout[rows], dtype=np.float64).reshape(-1, 2), skipped_terms)
+
+
+def load(store_dir=STORE_DIR, resources_dir=RESOURCES_DIR, precision=PRECISION):
+    """Load the embedding store, converting the text embeddings first if it doesn't exist yet."""
+    if not os.path.exists(os.path.join(store_dir, VOCAB_FILE)):
+        convert(resources_dir, store_dir)
+    if not os.path.exists(os.path.join(store_dir, _vectors_file(precision)[0])):
+        convert_precision(precision, store_dir)
+    return EmbeddingStore(store_dir, precision)
+
+
+registry.register('embeddings', load)
+
+
+if __name__ == '__main__':
+    convert()
+    for precision in sys.argv[1:]:
+        if precision == '--layout':
+            build_layout(progress=lambda fraction: print('Laying out terms ({:.0%})'.format(fraction)))
+        else:
+            convert_precision(precision)
@@ -0,0 +1,111 @@
+"""
+Binary wire format for recurrence responses.
+
+A payload is a little-endian uint32 header length, followed by a JSON header
+(utterances, channels, encoding...) padded with spaces to a multiple of 8 bytes,
+followed by the matrix values in little-endian `float16` or `uint8`. Values of
+`uint8` matrices decode as `offset + value * scale`.
+
+Square recurrence matrices are symmetric, so only their upper triangle
+(diagonal included) is sent, row by row. Sparse matrices send int32 row and
+column coordinates followed by their values, and banded matrices send their
+N x (2 * window + 1) band row by row. Tiles between arbitrary ranges of rows and
+columns send all their values, row by row.
+"""
+import struct
+
+import numpy as np
+import ujson as json
+
+
+MIMETYPES = {
+    'application/vnd.discursis.recurrence+float16': 'float16',
+    'application/vnd.discursis.recurrence+uint8': 'uint8'
+}
+ENCODINGS = ('float16', 'uint8')
+
+
+def _encode_values(values, encoding):
+    """Encode float `values` as `encoding`, returning (encoded values, header fields)."""
+    if encoding == 'float16':
+        return (values.astype('<f2'), {})
+    if encoding == 'uint8':
+        # Delta models recur in [-1, 1], others in [0, 1]
+        offset = -1.0 if values.size and values.min() < 0 else 0.0
+        scale = (1.0 - offset) / 255
+        encoded = np.rint((values - offset) / scale)
+        return (np.clip(encoded, 0, 255).astype(np.uint8), {'offset': offset, 'scale': scale})
+    raise ValueError('Unsupported encoding {}'.format(encoding))
+
+
+def _upper_triangle(matrix):
+    """Return the upper triangle (diagonal included) of square `matrix`, row by row."""
+    n = len(matrix)
+    values = np.empty(n * (n + 1) // 2, dtype=matrix.dtype)
+    start = 0
+    for i in range(n):
+        values[start:start + n - i] = matrix[i, i:]
+        start += n - i
+    return values
+
+
+def encode(header, values, encoding):
+    """Encode the `header` dict and float `values` into a payload, returning a list of buffers."""
+    encoded, fields = _encode_values(np.asarray(values), encoding)
+    header = dict(header, encoding=encoding, **fields)
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * (-(len(header_bytes) + 4) % 8)
+    return [struct.pack('<I', len(header_bytes)), header_bytes, encoded.tobytes()]
+
+
+def encode_recurrence(result, encoding, layout='upper'):
+    """
+    Encode `generate_recurrence` `result` (with an array `recurrence_matrix`) as a binary payload.
+
+    Dense matrices are sent in `layout`, 'upper' for symmetric matrices or 'dense' for tiles.
+    """
+    if layout not in ('upper', 'dense'):
+        raise ValueError('Unsupported layout {}'.format(layout))
+    header = {key: value for key, value in result.items() if key != 'recurrence_matrix'}
+    matrix = result['recurrence_matrix']
+    if isinstance(matrix, dict) and 'band' in matrix:
+        header['shape'] = list(matrix['band'].shape)
+        header['layout'] = 'band'
+        header['window'] = matrix['window']
+        return encode(header, matrix['band'], encoding)
+    if isinstance(matrix, dict):
+        # Sparse coordinates, sent as int32 rows and cols before the values
+        header['shape'] = list(matrix['shape'])
+        header['layout'] = 'coordinates'
+        header['count'] = len(matrix['values'])
+        buffers = encode(header, matrix['values'], encoding)
+        indices = [np.asarray(matrix[key], dtype='<i4').tobytes() for key in ('rows', 'cols')]
+        return buffers[:2] + indices + buffers[2:]
+    header['shape'] = list(matrix.shape)
+    header['layout'] = layout
+    if layout == 'dense':
+        return encode(header, matrix, encoding)
+    return encode(header, _upper_triangle(matrix), encoding)
+
+
+def decode(payload):
+    """Decode a binary `payload`, returning (header, matrix) with float32 values."""
+    header_length = struct.unpack_from('<I', payload)[0]
+    header = json.loads(payload[4:4 + header_length].decode('utf-8'))
+    offset = 4 + header_length
+    if header.get('layout') == 'coordinates':
+        indices = np.frombuffer(payload, dtype='<i4', count=2 * header['count'], offset=offset)
+        offset += indices.nbytes
+    values = np.frombuffer(payload, dtype='<f2' if header['encoding'] == 'float16' else np.uint8,
+                           offset=offset).astype(np.float32)
+    if header['encoding'] == 'uint8':
+        values = header['offset'] + values * header['scale']
+    if header.get('layout') == 'coordinates':
+        rows, cols = indices.reshape(2, -1)
+        return (header, {'shape': header['shape'], 'rows': rows, 'cols': cols, 'values': values})
+    if header.get('layout') == 'upper':
+        n = header['shape'][0]
+        matrix = np.zeros((n, n), dtype=np.float32)
+        matrix[np.triu_indices(n)] = values
+        return (header, matrix + np.triu(matrix, 1).T)
+    return (header, values.reshape(header['shape']))
@@ -1,36 +1,51 @@
 """This module provides access to creating and manipulating indexes."""
 from collections import Counter
+import io
 import os
 import sqlite3
 
-from .schema import index_schema
+import numpy as np
+
+from .schema import index_schema, term_tree_schema
 
 
 INDEX_FILE = 'index.db'
+EMBEDDINGS_FILE = 'embeddings.npy'
+EMBEDDING_SCALES_FILE = 'embedding_scales.npy'
 
 
 class IndexWriter:
-    """Allow creation of an index."""
+    """Allow creation of an index, or appending utterances to an existing one."""
 
-    def __init__(self, index_path):
-        """Create the index at `index_path`."""
+    def __init__(self, index_path, append=False):
+        """Create the index at `index_path`, or open it to `append` utterances."""
         self.field_id = 0
+        self.fields = {}
         self.utterance_num = 0
         self.term_freqs = Counter()
         self.connection = sqlite3.connect(os.path.join(index_path, INDEX_FILE))
 
-        # Initialise index
-        list(self.connection.cursor().executescript(index_schema))
+        if append:
+            # Continue from the existing utterances and metadata fields
+            cursor = self.connection.cursor()
+            self.utterance_num = cursor.execute('select coalesce(max(id) + 1, 0) from utterance').fetchone()[0]
+            self.fields = dict(cursor.execute('select name, id from metadata_field').fetchall())
+            self.field_id = max(self.fields.values(), default=-1) + 1
+        else:
+            # Initialise index
+            list(self.connection.cursor().executescript(index_schema))
 
         # Cursor for future writing
         self.cursor = self.connection.cursor()
 
     def add_metadata_field(self, field_name):
-        """Register metadata field on the index."""
+        """Register metadata field on the index, returning its id."""
+        if field_name in self.fields:
+            return self.fields[field_name]
         self.cursor.execute('insert into metadata_field(id, name) values(?, ?)', [self.field_id, field_name])
-        field_id = self.field_id
+        self.fields[field_name] = self.field_id
         self.field_id += 1
-        return field_id
+        return self.fields[field_name]
 
     def add_utterance(self, channel, text, metadata, term_counts):
         """Add analysed utterance including text and metadata."""
@@ -63,15 +78,26 @@ class IndexWriter:
         self.term_freqs.update(list(term_counts.keys()))
         self.utterance_num += 1  # increment utterance number
 
-    def finish(self):
-        """Close the connection to index with any final updates."""
+    def flush(self):
+        """
+        Write the term stats of the utterances added so far, without committing them.
 
-        # Term stats
+        Other readers and updaters can then see them on `connection`, within the same transaction.
+        """
+        # Term stats, adding to the frequencies of existing terms when appending
         insert_term_data = list(self.term_freqs.items())
         self.cursor.executemany(
-            'insert into term_stats(term, frequency) values(?, ?)',
+            """
+            insert into term_stats(term, frequency) values(?, ?)
+            on conflict(term) do update set frequency = frequency + excluded.frequency
+            """,
             insert_term_data
         )
+        self.term_freqs = Counter()
+
+    def finish(self):
+        """Close the connection to index with any final updates."""
+        self.flush()
         # Add foreign key to utterance term table
         """
         NOT SUPPORTED BY SQLITE
@@ -83,12 +109,24 @@ class IndexWriter:
         self.connection.commit()
         self.connection.close()
 
+    def abort(self):
+        """Close the connection to index, discarding everything added since it was opened."""
+        self.connection.rollback()
+        self.connection.close()
+
 
 class IndexUpdater:
     """Allow updating of an index."""
 
-    def __init__(self, index_path):
-        self.connection = sqlite3.connect(os.path.join(index_path, INDEX_FILE))
+    def __init__(self, index_path, connection=None):
+        """
+        Open the index at `index_path` for updating.
+
+        Updates made on an existing `connection` (e.g. of an `IndexWriter`) are left for its owner to
+        commit or roll back, rather than with `finish`.
+        """
+        self.index_path = index_path
+        self.connection = connection or sqlite3.connect(os.path.join(index_path, INDEX_FILE))
         # Cursor for future writing
         self.cursor = self.connection.cursor()
 
@@ -104,6 +142,75 @@ class IndexUpdater:
             insert_data
         )
 
+    def save_term_embeddings(self, vectors, scales=None):
+        """
+        Save term embedding `vectors`, one row per term in `IndexReader.get_terms_added` order.
+
+        Quantized `vectors` are saved with their per-row `scales`.
+        """
+        self._save_setting('term_embedding_order', 'added')
+        scales_path = os.path.join(self.index_path, EMBEDDING_SCALES_FILE)
+        if scales is None and os.path.exists(scales_path):
+            os.remove(scales_path)
+        for filename, array in ((EMBEDDINGS_FILE, vectors), (EMBEDDING_SCALES_FILE, scales)):
+            if array is not None:
+                path = os.path.join(self.index_path, filename)
+                with open(path + '.tmp', 'wb') as f:
+                    np.save(f, array)
+                os.replace(path + '.tmp', path)
+
+    def append_term_embeddings(self, vectors, scales=None):
+        """
+        Append the embedding `vectors` (and `scales`) of terms added since those saved, in place.
+
+        Appended rows can be removed again with `truncate_term_embeddings`.
+        """
+        for filename, array in ((EMBEDDINGS_FILE, vectors), (EMBEDDING_SCALES_FILE, scales)):
+            if array is not None:
+                path = os.path.join(self.index_path, filename)
+                _resize_rows(path, len(np.load(path, mmap_mode='r')), array)
+
+    def truncate_term_embeddings(self, count):
+        """Keep the first `count` rows of the saved term embeddings (and scales), in place."""
+        for filename in (EMBEDDINGS_FILE, EMBEDDING_SCALES_FILE):
+            path = os.path.join(self.index_path, filename)
+            if os.path.exists(path):
+                _resize_rows(path, count)
+
+    def save_term_tree(self, edges, mean_distance):
+        """
+        Save the (source, target, distance) `edges` of the minimum spanning tree of the term layout,
+        and the `mean_distance` between all pairs of laid out terms, replacing any saved before.
+        """
+        for statement in term_tree_schema.split(';'):
+            self.cursor.execute(statement)
+        self.cursor.execute('delete from term_tree')
+        self.cursor.executemany('insert into term_tree(source, target, distance) values (?, ?, ?)', edges)
+        self.cursor.execute(
+            "insert or replace into term_layout_stats(name, value) values ('mean_distance', ?)", (mean_distance,)
+        )
+
+    def update_term_tree(self, removed_edges, added_edges, mean_distance):
+        """
+        Remove the (source, target) `removed_edges` from the saved term tree and add the (source, target,
+        distance) `added_edges`, with the new `mean_distance` between laid out terms.
+        """
+        self.cursor.executemany('delete from term_tree where source = ? and target = ?', removed_edges)
+        self.cursor.executemany('insert into term_tree(source, target, distance) values (?, ?, ?)', added_edges)
+        self.cursor.execute(
+            "insert or replace into term_layout_stats(name, value) values ('mean_distance', ?)", (mean_distance,)
+        )
+
+    def save_term_layout_mode(self, mode):
+        """Save the `mode` (e.g. 'project' or 'global') the term layout was created with."""
+        self._save_setting('term_layout_mode', mode)
+
+    def _save_setting(self, name, value):
+        """Save the text `value` of setting `name`, replacing any saved before."""
+        for statement in term_tree_schema.split(';'):
+            self.cursor.execute(statement)
+        self.cursor.execute('insert or replace into index_settings(name, value) values (?, ?)', (name, value))
+
     def save_ignored_terms(self, terms):
         """Save `terms` not used in layout/clustering."""
         self.cursor.executemany(
@@ -119,9 +226,11 @@ class IndexUpdater:
 
 class IndexReader:
     """Allow reading from an index."""
-    def __init__(self, index_path):
+    def __init__(self, index_path, connection=None):
+        """Open the index at `index_path`, or read it through an existing `connection`, including its updates."""
         print(os.path.join(index_path, INDEX_FILE))
-        self.connection = sqlite3.connect(os.path.join(index_path, INDEX_FILE))
+        self.index_path = index_path
+        self.connection = connection or sqlite3.connect(os.path.join(index_path, INDEX_FILE))
         self.cursor = self.connection.cursor()
 
     def get_utterances(self, start=None, limit=None, include_text=False):
@@ -155,6 +264,10 @@ class IndexReader:
         else:
             return self.cursor.execute(q).fetchall()
 
+    def get_channels(self):
+        """Return the channel of each utterance, in order."""
+        return [c[0] for c in self.cursor.execute('select channel from utterance order by id asc').fetchall()]
+
     def get_utterance_count(self):
         """Return total number of utterances."""
         return self.cursor.execute('select count(*) from utterance').fetchall()[0][0]
@@ -162,19 +275,37 @@ class IndexReader:
     def get_top_terms(self, limit):
         """Return `limit` top terms by frequency."""
         return self.cursor.execute(
-            'select term from term_stats order by frequency desc limit ?', (limit,)
+            'select term from term_stats order by frequency desc, rowid limit ?', (limit,)
         ).fetchall()
 
     def get_terms_ordered(self):
         """Return ordered list of all terms."""
         return [t[0] for t in self.cursor.execute(
-            'select term from term_stats order by frequency desc'
+            'select term from term_stats order by frequency desc, rowid'
         ).fetchall()]
 
+    def get_terms_added(self):
+        """Return list of all terms in the order they were added to the index."""
+        return [t[0] for t in self.cursor.execute('select term from term_stats order by rowid').fetchall()]
+
+    def get_term_embedding_terms(self):
+        """
+        Return the terms of the rows of `get_term_embeddings`, in order.
+
+        Embeddings saved before they were kept in `get_terms_added` order are in `get_terms_ordered` order.
+        """
+        if self.get_term_embedding_order() == 'added':
+            return self.get_terms_added()
+        return self.get_terms_ordered()
+
+    def get_term_embedding_order(self):
+        """Return the order of the rows of `get_term_embeddings`: 'added' or (for older indexes) 'ordered'."""
+        return self._get_setting('term_embedding_order', 'ordered')
+
     def get_term_frequencies(self):
         """Return term frequencies."""
         return self.cursor.execute(
-            'select * from term_stats order by frequency desc'
+            'select * from term_stats order by frequency desc, rowid'
         ).fetchall()
 
     def get_term_layout(self):
@@ -183,6 +314,53 @@ class IndexReader:
             'select * from term_layout'
         ).fetchall()}
 
+    def get_term_layout_mode(self):
+        """Return the mode saved by `IndexUpdater.save_term_layout_mode`, 'project' if none was saved."""
+        return self._get_setting('term_layout_mode', 'project')
+
+    def _get_setting(self, name, default=None):
+        """Return the text value of setting `name`, or `default` if it wasn't saved."""
+        try:
+            rows = self.cursor.execute('select value from index_settings where name = ?', (name,)).fetchall()
+        except sqlite3.OperationalError:  # Indexes created before settings were stored
+            return default
+        return rows[0][0] if rows else default
+
+    def get_term_tree(self):
+        """
+        Return the (edges, mean distance) saved by `IndexUpdater.save_term_tree`.
+
+        Returns `None` for indexes created before term trees were stored.
+        """
+        try:
+            edges = self.cursor.execute('select source, target, distance from term_tree').fetchall()
+            stats = self.cursor.execute(
+                "select value from term_layout_stats where name = 'mean_distance'"
+            ).fetchall()
+        except sqlite3.OperationalError:
+            return None
+        if not stats:
+            return None
+        return (edges, stats[0][0])
+
+    def get_term_embeddings(self):
+        """
+        Return memory-mapped term embeddings aligned with `get_term_embedding_terms`.
+
+        Returns `None` for indexes created before embeddings were stored.
+        """
+        path = os.path.join(self.index_path, EMBEDDINGS_FILE)
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode='r')
+
+    def get_term_embedding_scales(self):
+        """Return per-row scales of quantized term embeddings, or `None` if they aren't quantized."""
+        path = os.path.join(self.index_path, EMBEDDING_SCALES_FILE)
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode='r')
+
     def get_ignored_terms(self):
         """Return list of ignored terms."""
         return [t[0] for t in self.cursor.execute(
@@ -190,6 +368,53 @@ class IndexReader:
         ).fetchall()]
 
 
+def _resize_rows(path, count, rows=None):
+    """
+    Resize the `.npy` array at `path` to its first `count` rows, followed by any `rows`.
+
+    The rows are truncated or appended in place, and only the header rewritten, unless the header
+    would change in size. New rows are written before the header, so readers see the old shape
+    until they're complete.
+    """
+    array = np.load(path, mmap_mode='r')
+    dtype, row_shape, fortran_order = array.dtype, array.shape[1:], np.isfortran(array)
+    del array  # Unmap before resizing
+    with open(path, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            np.lib.format.read_array_header_1_0(f)
+        else:
+            np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    shape = (count + (0 if rows is None else len(rows)),) + row_shape
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(
+        header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': shape}
+    )
+    header = header.getvalue()
+
+    if version != (1, 0) or len(header) != offset or fortran_order:
+        # Rewrite the whole array instead
+        array = np.load(path, mmap_mode='r')[:count]
+        if rows is not None:
+            array = np.concatenate([array, np.asarray(rows, dtype=dtype)])
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, array)
+        del array
+        os.replace(path + '.tmp', path)
+        return
+    with open(path, 'r+b') as f:
+        if rows is None:
+            f.write(header)
+        f.seek(offset + count * dtype.itemsize * int(np.prod(row_shape, dtype=np.int64)))
+        if rows is not None:
+            f.write(np.ascontiguousarray(rows, dtype=dtype).tobytes())
+        f.truncate()
+        if rows is not None:
+            f.seek(0)
+            f.write(header)
+
+
 def delete_index(index_path):
     """Delete index at specified `index_path`."""
     os.remove(index_path)
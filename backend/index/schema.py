@@ -56,5 +56,44 @@ create table ignored_terms (
     foreign key(term) references term_stats(term)
 );
 
+create table term_tree (
+    source text,
+    target text,
+    distance real,
+    foreign key(source) references term_stats(term),
+    foreign key(target) references term_stats(term)
+);
+
+create table term_layout_stats (
+    name text primary key,
+    value real
+);
+
+create table index_settings (
+    name text primary key,
+    value text
+);
+
 commit;
 """
+
+# Tables added since the first indexes, created when first written to older indexes
+term_tree_schema = """
+create table if not exists term_tree (
+    source text,
+    target text,
+    distance real,
+    foreign key(source) references term_stats(term),
+    foreign key(target) references term_stats(term)
+);
+
+create table if not exists term_layout_stats (
+    name text primary key,
+    value real
+);
+
+create table if not exists index_settings (
+    name text primary key,
+    value text
+);
+"""
@@ -0,0 +1,264 @@
+"""
+2D layout of term vectors.
+
+Layout engines are selected by name with the `DISCURSIS_LAYOUT_ENGINE` environment
+variable. The default, 'umap', is a UMAP-style layout in NumPy only: it builds a
+graph of the nearest neighbours of each term (in a PCA projection of the vectors, so
+nearest neighbours are approximate), weights its edges by fuzzy membership, and
+optimises positions from a PCA initialisation so that neighbours attract and random
+pairs repel. Cost grows with the number of terms times the number of neighbours,
+rather than with all pairs of terms. 'tsne' is the t-SNE of scikit-learn (Barnes-Hut).
+
+Engines are seeded, so the same vectors are always laid out the same way, and
+report progress as a fraction to an optional `progress` callback.
+"""
+import os
+
+import numpy as np
+
+import util
+
+
+ENGINE = os.environ.get('DISCURSIS_LAYOUT_ENGINE', 'umap')
+SEED = 0
+
+# Neighbours of each term in the graph, and optimisation epochs
+N_NEIGHBOURS = 15
+N_EPOCHS = 200
+
+# Dimensions of the PCA projection neighbours are found in, and terms compared at a time
+PCA_DIMENSIONS = 50
+BLOCK_SIZE = 256
+
+# Terms compared with all others to find their neighbours, and cells searched for the neighbours of more
+EXACT_NEIGHBOURS = 4096
+N_PROBES = 10
+
+# Epochs (0 for none) and learning rate of the local refinement of existing positions
+REFINE_EPOCHS = int(os.environ.get('DISCURSIS_LAYOUT_REFINE_EPOCHS', 0))
+REFINE_LEARNING_RATE = 0.1
+
+# Perplexity and learning rate of the 'tsne' engine
+TSNE_PERPLEXITY = 5
+TSNE_LEARNING_RATE = 75
+
+# Curve of the low dimensional similarity, 1 / (1 + A d^2B), for a minimum distance of 0.1
+A = 1.577
+B = 0.895
+NEGATIVE_SAMPLES = 5
+
+
+def layout(vectors, engine=None, progress=None):
+    """Lay out the rows of `vectors` in 2D with layout `engine` (default `ENGINE`), returning positions."""
+    engine = engine or ENGINE
+    if engine not in ENGINES:
+        raise ValueError('Unsupported layout engine {}'.format(engine))
+    positions = ENGINES[engine](np.asarray(vectors, dtype=np.float64), progress=progress)
+    if progress:
+        progress(1.0)
+    return positions
+
+
+def pca(vectors, n_components):
+    """Project the rows of `vectors` on their first `n_components` principal components."""
+    centred = vectors - vectors.mean(axis=0)
+    if centred.shape[1] <= n_components:
+        return centred
+    _, components = np.linalg.eigh(centred.T @ centred)  # Ascending eigenvalues
+    return centred @ components[:, ::-1][:, :n_components]
+
+
+def nearest_neighbours(vectors, n_neighbours, n_probes=N_PROBES, seed=SEED, block_size=BLOCK_SIZE):
+    """
+    Return (indices, cosine distances) of approximately the `n_neighbours` nearest other rows of `vectors`.
+
+    Rows are partitioned into cells around about sqrt(n) centroids (by a few rounds of spherical
+    k-means), and the rows of each cell are only compared with the rows of its `n_probes` nearest
+    cells. Up to `EXACT_NEIGHBOURS` rows are compared with all others. Neighbours are nearest first.
+    """
+    normalized = util.normalize_rows(vectors).astype(np.float32)
+    n = len(normalized)
+    indices = np.zeros((n, n_neighbours), dtype=np.int64)
+    distances = np.zeros((n, n_neighbours))
+    if n <= EXACT_NEIGHBOURS:
+        cells = [np.arange(n)]
+        candidates = cells
+    else:
+        assignments, centroids = kmeans(normalized, int(np.sqrt(n)), seed=seed, block_size=block_size * 16)
+        order = np.argsort(assignments, kind='stable')
+        cells = np.split(order, np.cumsum(np.bincount(assignments, minlength=len(centroids)))[:-1])
+        probes = np.argsort(-(centroids @ centroids.T), axis=1)[:, :n_probes]
+        candidates = [np.concatenate([cells[probe] for probe in cell_probes]) for cell_probes in probes]
+
+    for cell, cell_candidates in zip(cells, candidates):
+        if len(cell_candidates) <= n_neighbours:
+            cell_candidates = np.arange(n)
+        for start in range(0, len(cell), block_size):
+            rows = cell[start:start + block_size]
+            block = 1 - normalized[rows] @ normalized[cell_candidates].T
+            block[rows[:, None] == cell_candidates[None, :]] = np.inf  # Not a neighbour of itself
+            nearest = np.argpartition(block, n_neighbours - 1, axis=1)[:, :n_neighbours]
+            nearest_distances = np.take_along_axis(block, nearest, axis=1)
+            order = np.argsort(nearest_distances, axis=1, kind='stable')
+            indices[rows] = cell_candidates[np.take_along_axis(nearest, order, axis=1)]
+            distances[rows] = np.maximum(np.take_along_axis(nearest_distances, order, axis=1), 0)
+    return (indices, distances)
+
+
+def kmeans(vectors, n_clusters, n_iterations=5, seed=SEED, block_size=BLOCK_SIZE * 16):
+    """
+    Cluster the rows of `vectors` by cosine similarity with a few rounds of spherical k-means.
+
+    Returns (assignments, centroids), with the normalised centroids of `n_clusters` clusters
+    initialised from random rows.
+    """
+    normalized = util.normalize_rows(vectors).astype(np.float32)
+    n = len(normalized)
+    random = np.random.RandomState(seed)
+    centroids = normalized[random.choice(n, min(n_clusters, n), replace=False)]
+    assignments = np.zeros(n, dtype=np.int64)
+    for _ in range(n_iterations):
+        assignments = np.concatenate([
+            np.argmax(normalized[start:start + block_size] @ centroids.T, axis=1)
+            for start in range(0, n, block_size)
+        ])
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, normalized)
+        centroids = np.where(np.bincount(assignments, minlength=len(centroids))[:, None] > 0, sums, centroids)
+        centroids = util.normalize_rows(centroids).astype(np.float32)
+    return (assignments, centroids)
+
+
+def fuzzy_graph(indices, distances):
+    """
+    Weight the nearest neighbour graph of `indices` at `distances` by fuzzy membership.
+
+    Each term's nearest neighbour has weight 1, and the bandwidth of the others is found by
+    binary search so that its weights sum to log2(number of neighbours). Directed weights are
+    then combined as a fuzzy union. Returns the symmetric graph as a sparse COO matrix.
+    """
+    from scipy.sparse import coo_matrix
+
+    n, k = indices.shape
+    rho = distances[:, 0]
+    target = np.log2(k)
+    low = np.zeros(n)
+    high = np.full(n, np.inf)
+    sigma = np.ones(n)
+    for _ in range(64):
+        total = np.exp(-np.maximum(distances - rho[:, None], 0) / sigma[:, None]).sum(axis=1)
+        over = total > target
+        high = np.where(over, sigma, high)
+        low = np.where(over, low, sigma)
+        sigma = np.where(np.isinf(high), sigma * 2, (low + high) / 2)
+    weights = np.exp(-np.maximum(distances - rho[:, None], 0) / np.maximum(sigma, 1e-12)[:, None])
+    graph = coo_matrix((weights.ravel(), (np.repeat(np.arange(n), k), indices.ravel())), shape=(n, n)).tocsr()
+    transpose = graph.T.tocsr()
+    return (graph + transpose - graph.multiply(transpose)).tocoo()
+
+
+def umap_layout(
+    vectors, n_neighbours=N_NEIGHBOURS, n_epochs=N_EPOCHS, seed=SEED, progress=None,
+    initial=None, learning_rate=1.0
+):
+    """
+    Lay out the rows of `vectors` with a UMAP-style optimisation of their nearest neighbour graph.
+
+    Positions start from the first two principal components of `vectors`, or from `initial`
+    positions, and move by at most `learning_rate` (decaying to 0) per epoch.
+    """
+    n = len(vectors)
+    if not n:
+        return np.zeros((0, 2))
+    projected = pca(vectors, max(PCA_DIMENSIONS, 2))
+    if initial is not None:
+        positions = np.array(initial, dtype=np.float64).reshape(n, 2)
+    else:
+        positions = projected[:, :2]
+        if positions.shape[1] < 2:
+            positions = np.hstack([positions, np.zeros((n, 2 - positions.shape[1]))])
+        scale = np.abs(positions).max() if n > 2 else 0
+        if scale > 0:
+            positions = positions * (10 / scale)
+    if n <= 2:
+        return positions
+
+    graph = fuzzy_graph(*nearest_neighbours(projected, min(n_neighbours, n - 1)))
+    heads, tails, weights = graph.row, graph.col, graph.data
+    probabilities = weights / weights.max()
+    if progress:
+        progress(0.2)
+
+    random = np.random.RandomState(seed)
+    positions = positions.astype(np.float32)
+    initial_learning_rate = learning_rate
+    for epoch in range(n_epochs):
+        learning_rate = initial_learning_rate * (1 - epoch / n_epochs)
+
+        # Neighbours attract, each edge sampled in proportion to its weight
+        sampled = random.random_sample(len(heads)) < probabilities
+        edge_heads, edge_tails = heads[sampled], tails[sampled]
+        delta = positions[edge_heads] - positions[edge_tails]
+        squared = np.maximum(np.einsum('ij,ij->i', delta, delta), 1e-12)
+        powered = np.exp(B * np.log(squared))  # squared ** B
+        coefficients = -2 * A * B * powered / squared / (1 + A * powered)
+        gradient = np.clip(coefficients[:, None] * delta, -4, 4)
+        update = _sum_rows(gradient, edge_heads, n) - _sum_rows(gradient, edge_tails, n)
+
+        # Random pairs repel
+        negative_heads = np.repeat(edge_heads, NEGATIVE_SAMPLES)
+        negative_tails = random.randint(n, size=len(negative_heads))
+        delta = positions[negative_heads] - positions[negative_tails]
+        squared = np.einsum('ij,ij->i', delta, delta)
+        coefficients = 2 * B / ((0.001 + squared) * (1 + A * np.exp(B * np.log(np.maximum(squared, 1e-12)))))
+        coefficients[negative_tails == negative_heads] = 0
+        gradient = np.clip(coefficients[:, None] * delta, -4, 4)
+        update += _sum_rows(gradient, negative_heads, n)
+
+        # Updates of all edges are applied at once, so limit the step of terms with many edges
+        degrees = np.bincount(edge_heads, minlength=n) + np.bincount(edge_tails, minlength=n)
+        positions += (learning_rate * update / np.maximum(degrees, 1)[:, None] ** 0.5).astype(np.float32)
+        if progress and (epoch + 1) % 20 == 0:
+            progress(0.2 + 0.8 * (epoch + 1) / n_epochs)
+    return positions.astype(np.float64)
+
+
+def refine(vectors, positions, n_epochs=REFINE_EPOCHS, progress=None):
+    """
+    Refine existing `positions` of the rows of `vectors` (e.g. from a global layout) locally.
+
+    Runs `n_epochs` of the 'umap' optimisation from `positions` with a small learning rate,
+    so terms move towards their nearest neighbours among `vectors` without losing the overall
+    arrangement.
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    if not n_epochs:
+        return positions
+    return umap_layout(
+        np.asarray(vectors, dtype=np.float64), n_epochs=n_epochs, progress=progress,
+        initial=positions, learning_rate=REFINE_LEARNING_RATE
+    )
+
+
+def _sum_rows(values, indices, n):
+    """Sum the rows of 2-column `values` into the `n` rows of `indices`."""
+    return np.stack([np.bincount(indices, weights=values[:, i], minlength=n) for i in range(2)], axis=1)
+
+
+def tsne_layout(vectors, seed=SEED, progress=None):
+    """
+    Lay out the rows of `vectors` with the Barnes-Hut t-SNE of scikit-learn (its default method).
+
+    Parameters are those projects were laid out with before the 'umap' engine, which is compared
+    with this reference in `benchmarks/term_layout.py`.
+    """
+    from sklearn import manifold
+
+    tsne = manifold.TSNE(perplexity=TSNE_PERPLEXITY, learning_rate=TSNE_LEARNING_RATE, random_state=seed)
+    return tsne.fit_transform(vectors)
+
+
+ENGINES = {
+    'umap': umap_layout,
+    'tsne': tsne_layout
+}
@@ -1,67 +1,123 @@
 """Processing functions."""
-from collections import defaultdict, namedtuple
+from collections import namedtuple
 
 import numpy as np
-from scipy.spatial import distance
-from scipy import spatial
-from scipy.sparse.csgraph import connected_components
-from sklearn import cluster, manifold
 
+import cache
+import embeddings
 from index import IndexReader, IndexUpdater
+import layout
+import recurrence
+import registry
 import util
 
 BOOLEAN_FREQ = True
+THEMES_BLOCK_SIZE = 1024
+DISTANCE_BLOCK_PAIRS = 256 * 1024
 
 
-# Load PP-XXL Embeddings
-PP_EMBEDDINGS = {}
-for embedding in open('resources/paragram-phrase-XXL.txt'):
-    parts = embedding.split(' ')
-    PP_EMBEDDINGS[parts[0]] = [float(v) for v in parts[1:]]
+def get_term_vectors(terms):
+    """Get vectors for `terms` with paraphrase embeddings."""
+    rows, skipped_terms = registry.get('embeddings').get_rows(terms)
+    return (registry.get('embeddings').take(rows), skipped_terms)
 
 
-# Load ZH Embeddings
-for embedding in open('resources/zh.tsv'):
-    parts = embedding.split('\t')
-    vals = [float(v) for v in parts[1].split(',')]
-    if parts[0] not in PP_EMBEDDINGS:
-        PP_EMBEDDINGS[parts[0]] = vals
+def get_term_embeddings(terms):
+    """Get float32 embedding matrix for `terms`, with zero rows for terms without embeddings."""
+    return registry.get('embeddings').get_vectors(terms, dtype=np.float32)
 
 
-def get_term_vectors(terms):
-    """Get vectors for `terms` with paraphrase embeddings."""
-    skipped_terms = []
-    vectors = []
-    for term in terms:
-        try:
-            vectors.append(PP_EMBEDDINGS[term])
-        except KeyError:
-            skipped_terms.append(term)
+def load_term_embeddings(index_reader, terms):
+    """Load float64 embeddings of `terms` from the index, falling back to the global embeddings."""
+    vectors = index_reader.get_term_embeddings()
+    if vectors is None:
+        return registry.get('embeddings').get_vectors(terms)
+    row_index = {term: i for i, term in enumerate(index_reader.get_term_embedding_terms())}
+    rows = np.array([row_index[term] for term in terms], dtype=np.int64)
+    scales = index_reader.get_term_embedding_scales()
+    return embeddings.dequantize(vectors[rows], None if scales is None else scales[rows], dtype=np.float64)
+
+
+def generate_2d_projection(terms, engine=None, progress=None):
+    """Project `terms` into 2D space with layout `engine` (see `layout.layout`)."""
+    term_vectors, skipped_terms = get_term_vectors(terms)
+    positions = layout.layout(term_vectors, engine, progress)
+    return (positions, skipped_terms)
 
-    return (vectors, skipped_terms)
 
+def lookup_2d_projection(terms, refine_epochs=None, progress=None):
+    """
+    Look up `terms` in the global 2D layout of the embedding store (see `embeddings.build_layout`).
+
+    Positions are refined locally for `refine_epochs` (default `layout.REFINE_EPOCHS`), if any.
+    Returns (positions, skipped_terms) like `generate_2d_projection`.
+    """
+    positions, skipped_terms = registry.get('embeddings').get_layout(terms)
+    refine_epochs = layout.REFINE_EPOCHS if refine_epochs is None else refine_epochs
+    if refine_epochs:
+        term_vectors, _ = get_term_vectors(terms)
+        positions = layout.refine(term_vectors, positions, refine_epochs, progress)
+    if progress:
+        progress(1.0)
+    return (positions, skipped_terms)
 
-def generate_2d_projection(terms):
-    """Project `terms` into 2D space."""
+
+def place_terms(terms, layout_vectors, layout_positions, n_neighbours=5):
+    """
+    Place `terms` in an existing 2D layout of terms with `layout_vectors` at `layout_positions`.
+
+    Each term is placed at the similarity-weighted mean position of its `n_neighbours` most similar
+    laid out terms. Only `terms` are looked up in the embeddings. Returns (positions, skipped_terms)
+    like `generate_2d_projection`.
+    """
     term_vectors, skipped_terms = get_term_vectors(terms)
-    # return manifold.TSNE(perplexity=5).fit_transform(term_vectors)  # TODO: check params
-    positions = manifold.TSNE(perplexity=5, learning_rate=75).fit_transform(term_vectors)  # TODO: check params
+    layout_positions = np.asarray(layout_positions, dtype=np.float64)
+    n_neighbours = min(n_neighbours, len(layout_vectors))
+    if not len(term_vectors) or not n_neighbours:
+        return (np.zeros((len(term_vectors), 2)), skipped_terms)
+    similarities = util.normalize_rows(term_vectors) @ util.normalize_rows(layout_vectors).T
+    neighbours = np.argpartition(-similarities, n_neighbours - 1, axis=1)[:, :n_neighbours]
+    weights = np.clip(np.take_along_axis(similarities, neighbours, axis=1), 1e-6, None)
+    positions = (weights[:, :, None] * layout_positions[neighbours]).sum(axis=1) / weights.sum(axis=1)[:, None]
     return (positions, skipped_terms)
 
 
-def find_similar_terms(positions, distance_threshold):
-    """Return sparse matrix of similar terms based on `positions` within `distance_threshold`."""
-    distances = distance.cdist(positions, positions)
-    avg_distance = np.mean(distances)
-    return distances <= (avg_distance * distance_threshold)
+def find_similar_terms(positions, distance_threshold, sample_size=None):
+    """
+    Return sparse (CSR) matrix of similar terms based on `positions` within `distance_threshold`.
+
+    The threshold is relative to the mean distance between terms (see `mean_distance` for
+    `sample_size`). Pairs within it are found with a k-d tree, so memory scales with the number
+    of similar pairs rather than all pairs of terms.
+
+    Projects cut their clusters from the term tree instead (see `cut_term_tree`); this is the
+    all-pairs definition those clusters match.
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.spatial import cKDTree
+
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    n = len(positions)
+    radius = mean_distance(positions, sample_size=sample_size) * distance_threshold
+    pairs = cKDTree(positions).query_pairs(radius, output_type='ndarray').reshape(-1, 2)
+    # Symmetric, and every term is similar to itself
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1], np.arange(n)])
+    cols = np.concatenate([pairs[:, 1], pairs[:, 0], np.arange(n)])
+    return coo_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(n, n)).tocsr()
 
 
 def generate_term_clusters(terms, distances):
     """Transform similar terms `distances` matrix into dictionary of clusters mapping name -> terms."""
+    from scipy.sparse.csgraph import connected_components
+
     n_components, components = connected_components(distances)
-    components = list(filter(lambda l: len(l) > 1, [np.where(components == i)[0] for i in range(n_components)]))
+    # Group terms by component, each in term order, components in order of their first term
+    order = np.argsort(components, kind='stable')
+    boundaries = np.flatnonzero(np.diff(components[order])) + 1
+    groups = [c for c in np.split(order, boundaries) if len(c) > 1]
+    groups.sort(key=lambda c: c[0])
     clusters_by_name = {}
-    for i, c in enumerate(components):
+    for c in groups:
         lead_term = terms[c[0]]
         cluster_terms = [terms[i] for i in c]
         clusters_by_name[lead_term] = cluster_terms
@@ -69,11 +125,147 @@ def generate_term_clusters(terms, distances):
     return clusters_by_name
 
 
+def generate_term_tree(positions):
+    """
+    Compute the minimum spanning tree of the euclidean distances between 2D term `positions`.
+
+    The tree is found among the edges of their Delaunay triangulation, which contains it, so
+    never needs all pairwise distances. Terms within a distance of each other are connected by
+    tree edges no longer than it, so cutting longer edges leaves the same clusters as
+    `find_similar_terms` (single linkage).
+
+    Returns (sources, targets, distances) arrays of the tree's edges.
+    """
+    from scipy.spatial import Delaunay
+
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    n = len(positions)
+    try:
+        # Joggle input so duplicate or collinear positions are still triangulated
+        simplices = Delaunay(positions, qhull_options='QJ').simplices
+        pairs = np.concatenate([simplices[:, [0, 1]], simplices[:, [1, 2]], simplices[:, [0, 2]]])
+    except (RuntimeError, ValueError):  # Too few positions to triangulate
+        pairs = np.stack(np.triu_indices(n, 1), axis=1)
+    return _spanning_tree(positions, pairs)
+
+
+def update_term_tree(positions, start, sources, targets, block_pairs=DISTANCE_BLOCK_PAIRS):
+    """
+    Update the minimum spanning tree (`sources`, `targets`) of the first `start` 2D term `positions` with the rest.
+
+    A tree edge from a term goes to the nearest term in one of 6 cones of 60° around it, since a nearer
+    term in the same cone would be nearer to both ends. So the new tree is found among the old tree's
+    edges and those from each new term to its nearest term in each cone, with distances from the new
+    terms computed about `block_pairs` pairs at a time.
+
+    Returns (sources, targets, distances) arrays like `generate_term_tree`.
+    """
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    n = len(positions)
+    pairs = [np.stack([np.asarray(sources, dtype=np.int64), np.asarray(targets, dtype=np.int64)], axis=1)]
+    rows = max(1, block_pairs // n)
+    for block_start in range(start, n, rows):
+        block = np.arange(block_start, min(block_start + rows, n))
+        offsets = positions[None, :, :] - positions[block, None, :]
+        distances = np.linalg.norm(offsets, axis=2)
+        distances[np.arange(len(block)), block] = np.inf  # Not to itself
+        cones = np.floor_divide(np.arctan2(offsets[..., 1], offsets[..., 0]), np.pi / 3).astype(np.int64) % 6
+        for cone in range(6):
+            cone_distances = np.where(cones == cone, distances, np.inf)
+            nearest = cone_distances.argmin(axis=1)
+            found = np.isfinite(cone_distances[np.arange(len(block)), nearest])
+            pairs.append(np.stack([block[found], nearest[found]], axis=1))
+    return _spanning_tree(positions, np.concatenate(pairs))
+
+
+def _spanning_tree(positions, pairs):
+    """Return the (sources, targets, distances) of the minimum spanning tree of `positions` among edges `pairs`."""
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import minimum_spanning_tree
+
+    n = len(positions)
+    # Duplicate edges would be summed
+    pairs = np.sort(pairs, axis=1)
+    keys = np.unique(pairs[:, 0] * n + pairs[:, 1])
+    pairs = np.stack([keys // n, keys % n], axis=1)
+    distances = np.linalg.norm(positions[pairs[:, 0]] - positions[pairs[:, 1]], axis=1)
+    # Zero weights would be missing edges
+    weights = np.maximum(distances, np.finfo(np.float64).tiny)
+    tree = minimum_spanning_tree(coo_matrix((weights, (pairs[:, 0], pairs[:, 1])), shape=(n, n))).tocoo()
+    return (tree.row, tree.col, np.linalg.norm(positions[tree.row] - positions[tree.col], axis=1))
+
+
+def mean_distance(positions, sample_size=None, block_pairs=DISTANCE_BLOCK_PAIRS):
+    """
+    Return the mean euclidean distance between all pairs of `positions` (self included).
+
+    Distances are summed about `block_pairs` pairs at a time. `sample_size` estimates the mean from
+    that many random pairs instead, in constant time.
+    """
+    from scipy.spatial import distance
+
+    positions = np.asarray(positions, dtype=np.float64)
+    n = len(positions)
+    if not n:
+        return 0.0
+    if sample_size is not None and sample_size < n * n:
+        random = np.random.RandomState(0)
+        total = 0.0
+        for start in range(0, sample_size, block_pairs):
+            count = min(block_pairs, sample_size - start)
+            pairs = random.randint(n, size=(2, count))
+            total += np.linalg.norm(positions[pairs[0]] - positions[pairs[1]], axis=1).sum()
+        return total / sample_size
+    total = 0.0
+    rows = max(1, block_pairs // n)
+    for start in range(0, n, rows):
+        total += distance.cdist(positions[start:start + rows], positions).sum()
+    return total / n ** 2
+
+
+def extend_mean_distance(positions, start, mean, block_pairs=DISTANCE_BLOCK_PAIRS):
+    """
+    Return the mean euclidean distance between all pairs of `positions`, given their `mean` among the first `start`.
+
+    Only distances from the new positions are summed, about `block_pairs` pairs at a time.
+    """
+    from scipy.spatial import distance
+
+    positions = np.asarray(positions, dtype=np.float64)
+    n = len(positions)
+    if not n:
+        return 0.0
+    total = mean * start ** 2
+    rows = max(1, block_pairs // n)
+    for block_start in range(start, n, rows):
+        block = positions[block_start:block_start + rows]
+        # Pairs of new and old positions are counted in both orders
+        total += 2 * distance.cdist(block, positions[:start]).sum() + distance.cdist(block, positions[start:]).sum()
+    return total / n ** 2
+
+
+def cut_term_tree(terms, edges, distance):
+    """
+    Cluster `terms` by cutting the (source, target, distance) `edges` of their tree longer than `distance`.
+
+    Returns clusters like `generate_term_clusters`.
+    """
+    from scipy.sparse import coo_matrix
+
+    term_index = {term: i for i, term in enumerate(terms)}
+    kept = [(term_index[source], term_index[target]) for source, target, length in edges if length <= distance]
+    rows, cols = np.array(kept, dtype=np.int64).reshape(-1, 2).T
+    adjacency = coo_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(len(terms), len(terms)))
+    return generate_term_clusters(terms, adjacency)
+
+
 def generate_cluster_layout(dir, n_clusters=25):
     """Generate term layout using TSNE."""
+    from sklearn import cluster, manifold
+
     index_reader = IndexReader(dir)
     terms = index_reader.get_terms_ordered()
-    term_vectors = [PP_EMBEDDINGS.get(term, np.zeros(300)) for term in terms]
+    term_vectors = registry.get('embeddings').get_vectors(terms)
     positions = manifold.TSNE().fit_transform(term_vectors)  # TODO: check params
     clusters = cluster.KMeans(n_clusters=n_clusters).fit_predict(positions)
     index_writer = IndexUpdater(dir)
@@ -81,74 +273,126 @@ def generate_cluster_layout(dir, n_clusters=25):
     index_writer.finish()
 
 
-def generate_term_matrix(project_dir):
+def build_term_matrix(utterance_terms, term_index):
+    """Build sparse (CSR) utterance x term matrix from lists of `utterance_terms`, with columns from `term_index`."""
+    from scipy import sparse
+
+    indptr = np.zeros(len(utterance_terms) + 1, dtype=np.int64)
+    np.cumsum([len(terms) for terms in utterance_terms], out=indptr[1:])
+    indices = np.fromiter(
+        (term_index[term] for terms in utterance_terms for term in terms),
+        dtype=np.int64, count=indptr[-1]
+    )
+    data = np.ones(len(indices))  # Boolean frequencies
+    return sparse.csr_matrix((data, indices, indptr), shape=(len(utterance_terms), len(term_index)))
+
+
+def generate_term_matrix(project_dir, start=0, limit=None):
+    """Generate sparse utterance x term matrix for an index, with columns in `get_terms_ordered` order."""
     index_reader = IndexReader(project_dir)
-    for u_data in index_reader.get_utterances():
-        utterance_terms = u_data[3].split('::') if u_data[3] else []
+    term_index = {term: i for i, term in enumerate(index_reader.get_terms_ordered())}
+    utterance_terms = [
+        u_data[3].split('::') if u_data[3] else []
+        for u_data in index_reader.get_utterances(start, limit)
+    ]
+    return build_term_matrix(utterance_terms, term_index)
 
 
-def generate_recurrence(
-    project_dir, model, num_terms=None,
-    start=0, limit=250, include_text=True, delta=False, n_themes=3
-):
+def cosine_recurrence(embeddings):
     """
-    Generate recurrence for an index.recurrence_matrix.
+    Generate recurrence matrix of cosine similarities between the rows of dense or sparse `embeddings`.
 
-    # TODO -- partial update (no text excerpts)
+    Similarities are clipped to [0, 1] and every utterance fully recurs with itself. Sparse
+    embeddings are multiplied sparse, so cost scales with their non-zeros rather than their width.
+    """
+    return recurrence.UtteranceEmbeddings(embeddings).tile()
 
-    `model` specifies type of recurrence model used (term, composition)
+
+def infer_themes(utterance_embeddings, concept_vectors, n_themes=3, block_size=THEMES_BLOCK_SIZE):
     """
-    index_reader = IndexReader(project_dir)
-    terms = index_reader.get_terms_ordered()
-    ignored_terms = []
-    filter_terms = None
-    if num_terms:
-        filter_terms = set(terms[:num_terms])
+    Return indices of the `n_themes` concepts nearest to each utterance embedding, nearest first.
 
+    Nearest is by euclidean distance, computed for blocks of utterances at a time as
+    |c|^2 - 2 u.c (|u|^2 doesn't change the ranking) followed by a top-k partition.
+    """
+    n_themes = min(n_themes, len(concept_vectors))
+    themes = np.zeros((len(utterance_embeddings), n_themes), dtype=np.int64)
+    if n_themes == 0:
+        return themes
+    concept_norms = np.einsum('ij,ij->i', concept_vectors, concept_vectors)
+    for start in range(0, len(utterance_embeddings), block_size):
+        distances = concept_norms - 2 * (utterance_embeddings[start:start + block_size] @ concept_vectors.T)
+        nearest = np.argpartition(distances, n_themes - 1, axis=1)[:, :n_themes]
+        order = np.argsort(np.take_along_axis(distances, nearest, axis=1), axis=1, kind='stable')
+        themes[start:start + block_size] = np.take_along_axis(nearest, order, axis=1)
+    return themes
+
+
+def _parse_model(model, delta=False):
+    """Split the '-delta' suffix from `model`, returning (model, delta)."""
     # TODO make this a real param
     if model.endswith('-delta'):
         model = model.replace('-delta', '')
         delta = True
+    if model not in ('composition', 'term', 'term-expansion'):
+        raise ValueError('Unsupported model {}'.format(model))
+    return (model, delta)
 
-    # Load vectors
-    if model == 'composition':
-        # Paraphrase compositional model
-        concept_vectors = {
-            term: PP_EMBEDDINGS.get(term, np.zeros(300))
-            for term in terms
-        }
-        n_dims = 300
-        if delta:
-            term_vectors = util.generate_term_vectors(terms)
-        tree = spatial.cKDTree(list(concept_vectors.values()))
-        labels = list(concept_vectors.keys())
-        ignored_terms = index_reader.get_ignored_terms()
-    elif model in ('term', 'term-expansion'):
-        # Term model
-        concept_vectors = util.generate_term_vectors(terms)
-        n_dims = len(terms)
-        if delta:
-            term_vectors = concept_vectors
-
-    # Term mappings & filter terms
+
+def _select_columns(terms, ignored_terms, num_terms):
+    """Return (term columns, concept columns) of the term matrix used by a model with `num_terms`."""
+    term_columns = np.arange(len(terms))
+    concept_columns = term_columns
     if num_terms:
-        filter_terms = set(terms[:num_terms])
+        term_columns = term_columns[:num_terms]
+        concept_columns = np.array([i for i in term_columns if terms[i] not in ignored_terms], dtype=np.int64)
+    return (term_columns, concept_columns)
+
+
+def _compose_embeddings(term_matrix, term_columns, concept_columns, concept_vectors, delta):
+    """
+    Compose utterance embeddings from the utterance x term matrix, as the sums of their concept vectors.
+
+    Models without `concept_vectors` embed utterances as their concepts. Returns (embeddings, term
+    embeddings), the latter `None` unless `delta`.
+    """
+    concept_matrix = term_matrix[:, concept_columns]
+    if concept_vectors is not None:
+        utterance_embeddings = concept_matrix @ concept_vectors[concept_columns]
+    else:
+        utterance_embeddings = concept_matrix
+    return (utterance_embeddings, term_matrix[:, term_columns] if delta else None)
+
+
+def load_recurrence_model(
+    project_dir, model, num_terms=None,
+    start=0, limit=250, include_text=True, delta=False, n_themes=3
+):
+    """
+    Load utterances of an index with their embeddings for a recurrence model.
+
+    Takes the same parameters as `generate_recurrence`, and returns the same result
+    except that `embeddings` (`recurrence.UtteranceEmbeddings`) replace the matrix.
+    """
+    index_reader = IndexReader(project_dir)
+    terms = index_reader.get_terms_ordered()
+    term_index = {term: i for i, term in enumerate(terms)}
+    model, delta = _parse_model(model, delta)
 
-    # Load utterances and calculate embeddings
+    # Filter terms & concepts as column selections of the term matrix
+    ignored_terms = set(index_reader.get_ignored_terms()) if model == 'composition' else set()
+    term_columns, concept_columns = _select_columns(terms, ignored_terms, num_terms)
+    concept_terms = set(terms[i] for i in concept_columns)
+
+    # Load utterances
     utterances = []
-    utterance_embeddings = []
     channels = []
-    if delta:
-        utterance_embeddings_term = []
     for u_data in index_reader.get_utterances(start, limit, include_text):
         channel = u_data[1]
         utterance_terms = u_data[3].split('::') if u_data[3] else []
         utterance_concepts = utterance_terms
-        if filter_terms:
-            utterance_concepts = list(filter(
-                lambda t: t in filter_terms and t not in ignored_terms,
-                utterance_concepts
-            ))
+        if num_terms:
+            utterance_concepts = [t for t in utterance_terms if t in concept_terms]
         utterance = {
             'id': u_data[0],
             'channel': channel,
@@ -160,83 +404,463 @@ def generate_recurrence(
             utterance['text'] = u_data[4]
         if channel not in channels:
             channels.append(channel)
-        # Calcualte utterance embedding
-        utterance_concept_vectors = [
-            concept_vectors[term]
-            for term in utterance_concepts
-        ]
-        if len(utterance_concept_vectors):
-            if model == 'composition':
-                if len(utterance_concept_vectors) > 1:
-                    embedding = np.sum(utterance_concept_vectors, axis=0)
-                else:
-                    embedding = utterance_concept_vectors[0]
-            else:
-                # Utterance is represented as the sum of all individual concept vectors
-                embedding = np.sum(utterance_concept_vectors, axis=0)
-        else:
-            embedding = np.zeros(n_dims)
-        if delta:
-            utterance_term_vectors = np.array([
-                term_vectors[term]
-                for term in filter(lambda t: not filter_terms or t in filter_terms, utterance_terms)
-            ])
-            if len(utterance_term_vectors):
-                # Utterance is represented as the sum of all individual term vectors
-                utterance_embeddings_term.append(np.sum(utterance_term_vectors, axis=0))
-            else:
-                utterance_embeddings_term.append(np.zeros(len(terms)))
-
-        utterance_embeddings.append(embedding)
-
-        if model == 'composition':
-            if (len(utterance_terms) > 0):
-                hits = tree.query(embedding, k=n_themes)[1]
-                utterance['themes'] = ([labels[i] for i in hits[:len(utterance_terms)]])
-            else:
-                utterance['themes'] = []
-
         utterances.append(utterance)
 
-    utterance_embeddings = np.array(utterance_embeddings)
-    recurrence_matrix = np.nan_to_num((1 - distance.squareform(distance.pdist(utterance_embeddings, metric='cosine'))))
-    recurrence_matrix = np.clip(recurrence_matrix, 0, 1)
-    if delta:
-        utterance_embeddings_term = np.array(utterance_embeddings_term)
-        recurrence_matrix_term = np.nan_to_num((1 - distance.squareform(
-            distance.pdist(utterance_embeddings_term, metric='cosine')))
-        )
-        recurrence_matrix_term = np.clip(recurrence_matrix_term, 0, 1)
-        recurrence_matrix = np.subtract(recurrence_matrix, recurrence_matrix_term)
+    # Calculate utterance embeddings; each utterance is the sum of its concept vectors
+    term_matrix = build_term_matrix([u['terms'] for u in utterances], term_index)
+    concept_vectors = load_term_embeddings(index_reader, terms) if model == 'composition' else None
+    utterance_embeddings, utterance_embeddings_term = _compose_embeddings(
+        term_matrix, term_columns, concept_columns, concept_vectors, delta
+    )
+
+    # Infer themes as the concepts nearest to each utterance
+    if model == 'composition':
+        themes = infer_themes(utterance_embeddings, concept_vectors, n_themes)
+        for utterance, hits in zip(utterances, themes):
+            utterance['themes'] = [terms[i] for i in hits[:len(utterance['terms'])]]
 
     return {
         'utterances': utterances,
         'utterance_count': index_reader.get_utterance_count(),
-        'recurrence_matrix': recurrence_matrix.tolist(),
+        'embeddings': recurrence.UtteranceEmbeddings(utterance_embeddings, utterance_embeddings_term),
         'channels': channels
     }
 
 
-def generate_channel_similarity(project_dir, model, num_terms=None):
+def load_recurrence(
+    project_dir, model, num_terms=None,
+    start=0, limit=250, include_text=True, delta=False, n_themes=3
+):
+    """
+    Load utterances of an index with their recurrence matrix, through the project's cache.
+
+    Takes the same parameters as `generate_recurrence`, and returns the same result except
+    that the matrix is a read-only float32 array, so values are rounded to float32 precision
+    (JSON included). Full recurrence matrices are cached once per model and shared by the
+    slices of every range of utterances. Utterance texts aren't cached, but read from the index.
+    """
+    model, delta = _parse_model(model, delta)
+    project_cache = cache.Cache(project_dir)
+    matrix_params = {'model': model, 'delta': delta, 'num_terms': num_terms}
+    params = dict(matrix_params, start=start, limit=limit, n_themes=n_themes)
+    loaded = {}
+
+    def load_embeddings():
+        if not loaded:
+            loaded.update(load_recurrence_model(
+                project_dir, model, num_terms, start, limit, False, delta, n_themes
+            ))
+        return loaded['embeddings']
+
+    result = project_cache.get_json('utterances', params)
+    if result is None:
+        load_embeddings()
+        result = project_cache.put_json('utterances', params, {
+            key: value for key, value in loaded.items() if key != 'embeddings'
+        })
+    if include_text:
+        u_texts = [u_data[4] for u_data in IndexReader(project_dir).get_utterances(start, limit, True)]
+        for utterance, text in zip(result['utterances'], u_texts):
+            utterance['text'] = text
+
+    n = len(result['utterances'])
+    offset = result['utterances'][0]['id'] if n else 0
+    matrix = project_cache.get_matrix('recurrence', matrix_params)
+    if matrix is not None:
+        result['recurrence_matrix'] = matrix[offset:offset + n, offset:offset + n]
+    else:
+        if offset or n < result['utterance_count']:
+            matrix_params = dict(matrix_params, start=start, limit=limit)
+        result['recurrence_matrix'] = project_cache.get_matrix('recurrence', matrix_params)
+        if result['recurrence_matrix'] is None:
+            result['recurrence_matrix'] = project_cache.put_matrix(
+                'recurrence', matrix_params, lambda path: recurrence.compute(load_embeddings(), path)
+            )
+    return result
+
+
+def load_utterance_embeddings(project_dir, model, num_terms=None, delta=False):
+    """Load the normalised embeddings of all utterances of an index for a recurrence model, through its cache."""
+    model, delta = _parse_model(model, delta)
+    return _cached_utterance_embeddings(
+        cache.Cache(project_dir), {'model': model, 'delta': delta, 'num_terms': num_terms},
+        lambda: load_recurrence_model(
+            project_dir, model, num_terms, limit=None, include_text=False, delta=delta
+        )['embeddings']
+    )
+
+
+def _cached_utterance_embeddings(project_cache, params, compute):
+    """Return the utterance embeddings for `params` from `project_cache`, caching `compute()` if missing."""
+    names = ['normalized', 'normalized-term'][:2 if params['delta'] else 1]
+    parts = [project_cache.get_matrix(name, params) for name in names]
+    if any(part is None for part in parts):
+        parts = list(compute().parts())
+        for i, (name, part) in enumerate(zip(names, parts)):
+            cached = project_cache.put_matrix(name, params, part)
+            if cached is not None:  # Unless evicted again already
+                parts[i] = cached
+    return recurrence.UtteranceEmbeddings.from_normalized(*parts)
+
+
+def _extend_utterance_embeddings(project_dir, old_cache, params, old_terms, old_count):
+    """Extend the utterance embeddings of `old_cache` with utterances appended to the index, if cached."""
+    names = ['normalized', 'normalized-term'][:2 if params['delta'] else 1]
+    old_parts = [old_cache.get_matrix(name, params) for name in names]
+    if any(part is None for part in old_parts):
+        return None
+
+    from scipy.sparse import csr_matrix, vstack
+    index_reader = IndexReader(project_dir)
+    term_index = {term: i for i, term in enumerate(index_reader.get_terms_ordered())}
+    count = index_reader.get_utterance_count() - old_count
+    appended = load_recurrence_model(
+        project_dir, params['model'], params['num_terms'], old_count, count,
+        include_text=False, delta=params['delta']
+    )['embeddings']
+    parts = []
+    for name, old_part, part in zip(names, old_parts, appended.parts()):
+        if isinstance(old_part, np.ndarray):
+            part = np.concatenate([old_part, part])
+        else:
+            # Columns of sparse embeddings are terms, which appending may have reordered
+            columns = np.array([term_index[term] for term in old_terms[:params['num_terms']]], dtype=np.int64)
+            old_part = csr_matrix((old_part.data, columns[old_part.indices], old_part.indptr), shape=(
+                old_part.shape[0], part.shape[1]
+            ))
+            part = vstack([old_part, part]).tocsr()
+        parts.append(cache.Cache(project_dir).put_matrix(name, params, part))
+    return recurrence.UtteranceEmbeddings.from_normalized(*parts)
+
+
+def extend_recurrence_cache(project_dir, old_cache, old_terms, old_count):
+    """
+    Carry the cached recurrence of `old_cache` over to an index that utterances were appended to.
+
+    `old_terms` and `old_count` are the ordered terms and number of utterances before appending.
+    Models over all terms, or whose top `num_terms` are unchanged, keep the embeddings of existing
+    utterances, so their cached utterance embeddings are extended with new utterances, and their full
+    recurrence matrices with a block of only the rows of new utterances (see `Cache.extend_matrix`).
+    Other entries are recomputed on demand.
+    """
+    index_reader = IndexReader(project_dir)
+    terms = index_reader.get_terms_ordered()
+    if index_reader.get_utterance_count() == old_count:
+        return
+
+    models = old_cache.find_matrices('normalized')
+    models.extend(params for params in old_cache.find_matrices('recurrence') if params not in models)
+    for params in models:
+        num_terms = params['num_terms']
+        if set(params) != {'model', 'delta', 'num_terms'}:
+            continue  # Matrix of a range of utterances
+        if num_terms and set(terms[:num_terms]) != set(old_terms[:num_terms]):
+            continue
+        utterance_embeddings = _extend_utterance_embeddings(project_dir, old_cache, params, old_terms, old_count)
+        if old_cache.get_matrix('recurrence', params) is not None:
+            if utterance_embeddings is None:
+                utterance_embeddings = load_utterance_embeddings(
+                    project_dir, params['model'], num_terms, params['delta']
+                )
+            cache.Cache(project_dir).extend_matrix(
+                'recurrence', params, old_cache, lambda path: recurrence.extend(utterance_embeddings, old_count, path)
+            )
+
+
+def generate_recurrence_tile(project_dir, model, num_terms=None, rows=(0, 256), cols=(0, 256), delta=False):
+    """
+    Generate the recurrence tile between the utterance ranges `rows` and `cols` ((start, stop) pairs).
+
+    Only the tile is computed, from the cached utterance embeddings, so its cost doesn't depend on
+    the size of the project.
+    """
+    for start, stop in (rows, cols):
+        if start < 0 or stop <= start:
+            raise ValueError('Tile ranges must start at 0 or more and not be empty')
+    utterance_embeddings = load_utterance_embeddings(project_dir, model, num_terms, delta)
+    rows = recurrence.utterance_range(slice(*rows), len(utterance_embeddings))
+    cols = recurrence.utterance_range(slice(*cols), len(utterance_embeddings))
+    return {
+        'rows': rows,
+        'cols': cols,
+        'utterance_count': len(utterance_embeddings),
+        'recurrence_matrix': utterance_embeddings.tile(slice(*rows), slice(*cols)).astype(np.float32)
+    }
+
+
+def load_recurrence_pyramid(project_dir, model, num_terms=None, delta=False):
+    """
+    Load the pyramid of mean and max pooled recurrence of a model, through the project's cache.
+
+    Returns a list of {'factor', 'mean', 'max'} levels from the finest to the coarsest (see
+    `recurrence.compute_pyramid`).
+    """
+    model, delta = _parse_model(model, delta)
+    project_cache = cache.Cache(project_dir)
+    params = {'model': model, 'delta': delta, 'num_terms': num_terms}
+
+    def load_levels(factors):
+        levels = [{
+            'factor': factor,
+            'mean': project_cache.get_array('pyramid-mean', dict(params, factor=factor)),
+            'max': project_cache.get_array('pyramid-max', dict(params, factor=factor))
+        } for factor in factors]
+        if all(level['mean'] is not None and level['max'] is not None for level in levels):
+            return levels
+        return None
+
+    factors = project_cache.get_json('pyramid', params)
+    levels = load_levels(factors) if factors is not None else None
+    if levels is None:
+        utterance_embeddings = load_utterance_embeddings(project_dir, model, num_terms, delta)
+        factors = []
+        for factor, means, maxes in recurrence.compute_pyramid(utterance_embeddings):
+            for pooling, values in (('mean', means), ('max', maxes)):
+                project_cache.put_array(
+                    'pyramid-' + pooling, dict(params, factor=factor),
+                    lambda path: np.save(path, values.astype(np.float32))
+                )
+            factors.append(factor)
+        levels = load_levels(project_cache.put_json('pyramid', params, factors))
+    return levels
+
+
+def generate_recurrence_overview(project_dir, model, num_terms=None, max_side=512, pooling='mean', delta=False):
+    """
+    Generate an overview of recurrence from the finest level of its pyramid at most `max_side` blocks wide.
+
+    `pooling` selects the 'mean' or 'max' recurrence of each block of `factor` x `factor` utterances.
+    """
+    if pooling not in ('mean', 'max'):
+        raise ValueError('Unsupported pooling {}'.format(pooling))
+    if max_side < 1:
+        raise ValueError('max_side must be at least 1')
+    levels = load_recurrence_pyramid(project_dir, model, num_terms, delta)
+    if not levels:
+        raise ValueError('No utterances to recur')
+    level = next((level for level in levels if len(level[pooling]) <= max_side), levels[-1])
+    return {
+        'factor': level['factor'],
+        'pooling': pooling,
+        'utterance_count': IndexReader(project_dir).get_utterance_count(),
+        'recurrence_matrix': np.asarray(level[pooling])
+    }
+
+
+def generate_recurrence(
+    project_dir, model, num_terms=None,
+    start=0, limit=250, include_text=True, delta=False, n_themes=3, as_array=False,
+    min_similarity=None, top_k=None, window=None
+):
+    """
+    Generate recurrence for an index.recurrence_matrix.
+
+    # TODO -- partial update (no text excerpts)
+
+    `model` specifies type of recurrence model used (term, composition)
+    `as_array` returns the matrix as a float32 array rather than nested lists
+    `min_similarity` (a magnitude, in [0, 1]) and/or `top_k` (per row, at least 1) return only significant
+    cells, as a sparse matrix of coordinates {'shape', 'rows', 'cols', 'values'}. The top k of a
+    row include the utterance itself, so `top_k` = k + 1 keeps its k most similar other utterances.
+    `window` returns only pairs of utterances at most `window` apart, as a band {'window', 'band'}
+    (see `recurrence.compute_band`)
+
+    Full matrices are cached (see `load_recurrence`).
+    """
+    if top_k is not None and top_k < 1:
+        raise ValueError('top_k must be at least 1')
+    if min_similarity is not None and not 0 <= min_similarity <= 1:
+        raise ValueError('min_similarity must be between 0 and 1')
+    if window is not None and window < 1:
+        raise ValueError('window must be at least 1')
+    if window is None and min_similarity is None and top_k is None:
+        result = load_recurrence(project_dir, model, num_terms, start, limit, include_text, delta, n_themes)
+        if as_array:
+            result['recurrence_matrix'] = np.asarray(result['recurrence_matrix'])
+        else:
+            result['recurrence_matrix'] = result['recurrence_matrix'].tolist()
+        return result
+
+    result = load_recurrence_model(project_dir, model, num_terms, start, limit, include_text, delta, n_themes)
+    if window is not None:
+        dtype = np.float32 if as_array else np.float64
+        band = recurrence.compute_band(result.pop('embeddings'), window, dtype=dtype)
+        result['recurrence_matrix'] = {'window': window, 'band': band if as_array else band.tolist()}
+    else:
+        utterance_embeddings = result.pop('embeddings')
+        rows, cols, values = recurrence.compute_sparse(utterance_embeddings, min_similarity, top_k)
+        n = len(utterance_embeddings)
+        if as_array:
+            result['recurrence_matrix'] = {
+                'shape': (n, n), 'rows': rows, 'cols': cols, 'values': values.astype(np.float32)
+            }
+        else:
+            result['recurrence_matrix'] = {
+                'shape': [n, n], 'rows': rows.tolist(), 'cols': cols.tolist(), 'values': values.tolist()
+            }
+    return result
+
+
+def _channel_pairs(channels):
+    """
+    Return (channel names, sparse channel indicator matrix, pair counts, pairs) of utterance `channels`.
+
+    Pair counts are those of utterances of each channel followed by utterances of each other,
+    counted from the channel sizes, and pairs are the (channel, channel) indices of non-zero
+    counts in order of their first occurrence.
+    """
+    from scipy.sparse import csr_matrix
+    channel_names, first, channels = np.unique(channels, return_index=True, return_inverse=True)
+    n, k = len(channels), len(channel_names)
+    indicator = csr_matrix((np.ones(n), (np.arange(n), channels)), shape=(n, k))
+
+    # Utterances of each channel after each utterance
+    one_hot = indicator.toarray()
+    following = one_hot.sum(axis=0) - np.cumsum(one_hot, axis=0)
+    counts = one_hot.T @ following
+
+    # Order pairs by their first occurrence: the first utterance of the first channel,
+    # followed by the next utterance of the second
+    positions = [np.flatnonzero(channels == b) for b in range(k)]
+    pairs = [(a, b) for a in range(k) for b in range(k) if counts[a, b] > 0]
+    pairs.sort(key=lambda pair: (
+        first[pair[0]], positions[pair[1]][np.searchsorted(positions[pair[1]], first[pair[0]], side='right')]
+    ))
+    return (channel_names, indicator, counts, pairs)
+
+
+def _cached_recurrence(project_cache, params, load_embeddings, memory_limit, workers):
+    """
+    Return the full recurrence matrix of model `params` from `project_cache`, caching it if missing.
+
+    Missing matrices are computed from the utterance embeddings returned by `load_embeddings()`,
+    like those of `load_recurrence`, so exports and views share them. Returns None if the matrix
+    wouldn't fit in the cache's budget.
+    """
+    matrix = project_cache.get_matrix('recurrence', params)
+    if matrix is not None:
+        return matrix
+    n = len(load_embeddings())
+    if n * n * recurrence.DTYPE.itemsize > project_cache.budget:
+        return None
+    return project_cache.put_matrix('recurrence', params, lambda path: recurrence.compute(
+        load_embeddings(), path, memory_limit=memory_limit, workers=workers
+    ))
+
+
+def _upper_tiles(project_cache, params, load_embeddings, memory_limit, workers):
+    """
+    Yield (rows, cols, tile) tiles covering the upper triangle of the recurrence of model `params`.
+
+    Tiles are read from the full matrix in `project_cache`, which is cached first if it fits (see
+    `_cached_recurrence`), otherwise computed from the utterance embeddings returned by
+    `load_embeddings()` (see `recurrence.map_upper`).
+    """
+    size = recurrence.tile_size(memory_limit, workers)
+    matrix = _cached_recurrence(project_cache, params, load_embeddings, memory_limit, workers)
+    if matrix is None:
+        yield from recurrence.map_upper(load_embeddings(), size, workers)
+        return
+    n = len(matrix)
+    for row in range(0, n, size):
+        for col in range(row, n, size):
+            rows, cols = slice(row, min(row + size, n)), slice(col, min(col + size, n))
+            yield (rows, cols, np.asarray(matrix[rows, cols], dtype=np.float64))
+
+
+def _channel_similarity(tiles, indicator):
+    """
+    Sum the forward recurrence between the channels of `indicator` (C), as Cᵀ·triu(R, 1)·C.
+
+    Sums are accumulated from `tiles` of the upper triangle of the recurrence R (see `_upper_tiles`),
+    so the full matrix is never built.
+    """
+    similarity = np.zeros((indicator.shape[1], indicator.shape[1]))
+    for rows, cols, tile in tiles:
+        if rows == cols:
+            tile = np.triu(tile, 1)  # forward direction only
+        similarity += (indicator[cols].T @ (indicator[rows].T @ tile).T).T
+    return similarity
+
+
+def generate_channel_similarity(project_dir, model, num_terms=None, memory_limit=recurrence.MEMORY_LIMIT,
+                                workers=recurrence.WORKERS):
     """
     Generate channel similarities.
 
-    Returns tuple containing (channel pair, cumulative similarity, count).
-    """
-    recurrence = generate_recurrence(project_dir, model, num_terms, limit=None, include_text=False)
-    channel_similarity = defaultdict(int)
-    channel_cooccurrence = defaultdict(int)
-    for u1 in recurrence['utterances']:
-        for u2 in recurrence['utterances']:
-            if u2['id'] > u1['id']:  # forward direction only
-                ch_key = (u1['channel'], u2['channel'])
-                channel_similarity[ch_key] += recurrence['recurrence_matrix'][u1['id']][u2['id']]
-                channel_cooccurrence[ch_key] += 1
-
-    return map(
-        lambda ch_key: (ch_key[0], ch_key[1], channel_similarity[ch_key], channel_cooccurrence[ch_key]),
-        channel_similarity.keys()
+    Returns tuples of (channel, channel, cumulative similarity, count), for each pair of channels
+    with utterances in that order, in order of their first occurrence. Recurrence is read from the
+    full matrix of the model, which is cached if it fits, and computed otherwise.
+    """
+    model, delta = _parse_model(model)
+    tiles = _upper_tiles(
+        cache.Cache(project_dir), {'model': model, 'delta': delta, 'num_terms': num_terms},
+        lambda: load_utterance_embeddings(project_dir, model, num_terms, delta), memory_limit, workers
     )
+    channel_names, indicator, counts, pairs = _channel_pairs(IndexReader(project_dir).get_channels())
+    similarity = _channel_similarity(tiles, indicator)
+    return [
+        (channel_names[a].item(), channel_names[b].item(), similarity[a, b].item(), int(counts[a, b]))
+        for a, b in pairs
+    ]
+
+
+def generate_channel_similarity_sweep(project_dir, models, num_terms_values, memory_limit=recurrence.MEMORY_LIMIT,
+                                      workers=recurrence.WORKERS):
+    """
+    Generate channel similarities for each combination of `models` and `num_terms_values`.
+
+    The utterances, their term matrix and channel pairs are loaded once, and shared by the
+    utterance embeddings of every configuration (unless its recurrence or embeddings are cached).
+
+    Yields tuples of (model, num_terms, channel, channel, cumulative similarity, count), like
+    `generate_channel_similarity` for each configuration in turn.
+    """
+    if not models:
+        raise ValueError('At least one model is required')
+    index_reader = IndexReader(project_dir)
+    project_cache = cache.Cache(project_dir)
+    shared = {}
+
+    def load_shared():
+        if not shared:
+            terms = index_reader.get_terms_ordered()
+            term_index = {term: i for i, term in enumerate(terms)}
+            shared['terms'] = terms
+            shared['term_matrix'] = build_term_matrix([
+                u_data[3].split('::') if u_data[3] else [] for u_data in index_reader.get_utterances()
+            ], term_index)
+            shared['ignored_terms'] = set(index_reader.get_ignored_terms())
+        return shared
+
+    def compose(model, num_terms, delta):
+        loaded = load_shared()
+        ignored_terms = set()
+        concept_vectors = None
+        if model == 'composition':
+            ignored_terms = loaded['ignored_terms']
+            if 'concept_vectors' not in loaded:
+                loaded['concept_vectors'] = load_term_embeddings(index_reader, loaded['terms'])
+            concept_vectors = loaded['concept_vectors']
+        term_columns, concept_columns = _select_columns(loaded['terms'], ignored_terms, num_terms)
+        return recurrence.UtteranceEmbeddings(*_compose_embeddings(
+            loaded['term_matrix'], term_columns, concept_columns, concept_vectors, delta
+        ))
+
+    channel_names, indicator, counts, pairs = _channel_pairs(index_reader.get_channels())
+    for model_name in models:
+        model, delta = _parse_model(model_name)
+        for num_terms in num_terms_values:
+            params = {'model': model, 'delta': delta, 'num_terms': num_terms}
+            tiles = _upper_tiles(project_cache, params, lambda: _cached_utterance_embeddings(
+                project_cache, params, lambda: compose(model, num_terms, delta)
+            ), memory_limit, workers)
+            similarity = _channel_similarity(tiles, indicator)
+            for a, b in pairs:
+                yield (
+                    model_name, num_terms, channel_names[a].item(), channel_names[b].item(),
+                    similarity[a, b].item(), int(counts[a, b])
+                )
 
 
 Primitives = namedtuple('Primitives', [
@@ -247,73 +871,171 @@ Primitives = namedtuple('Primitives', [
 ])
 
 
-def generate_primitives(project_dir, model, num_terms=None, short_range=2, medium_range=10):
+PRIMITIVE_RANGES = (2, 10, None)
+
+
+def primitive_fields(ranges=PRIMITIVE_RANGES):
+    """Return the names of the primitives for neighbour `ranges` (`None` for all neighbours)."""
+    if tuple(ranges) == PRIMITIVE_RANGES:
+        return list(Primitives._fields)
+    return [
+        '{}_{}_{}'.format(channel, direction, 'long' if limit is None else limit)
+        for channel in ('self', 'other') for direction in ('backward', 'forward') for limit in ranges
+    ]
+
+
+def generate_primitives(project_dir, model, num_terms=None, short_range=2, medium_range=10, window=None):
     """
     Generate primitives for an index with specified model parameters.
 
+    `window` computes short and medium ranges from a recurrence band of that width, rather
+    than from full recurrence rows.
+
     Returns a list of `Primitives`.
     """
-    utterance_primitives = []
-    recurrence = generate_recurrence(project_dir, model, num_terms, limit=None, include_text=False)
-
-    # Precalculate ids by channel
-    channel_utterances = defaultdict(list)
-    ids = []
-    for u in recurrence['utterances']:
-        channel_utterances[u['channel']].append(u['id'])
-        ids.append(u['id'])
-
-    def calc_primitive(vals):
-        return np.sum(vals) / len(vals) if len(vals) else 0
-
-    # Calculate primitives for each utterance
-    similarities = np.array(recurrence['recurrence_matrix'])
-    for u in recurrence['utterances']:
-        self_ids = channel_utterances[u['channel']]
-        other_ids = list(filter(lambda i: i not in self_ids, ids))
-
-        # Self Backward
-        self_backward_ids = list(filter(lambda i: i < u['id'], self_ids))
-        sbl_vals = similarities[u['id'], self_backward_ids]
-        self_backward_long = calc_primitive(sbl_vals)
-        sbm_vals = similarities[u['id'], self_backward_ids[-medium_range:]]
-        self_backward_medium = calc_primitive(sbm_vals)
-        sbs_vals = similarities[u['id'], self_backward_ids[-short_range:]]
-        self_backward_short = calc_primitive(sbs_vals)
-
-        # Self Forward
-        self_forward_ids = list(filter(lambda i: i > u['id'], self_ids))
-        sfl_vals = similarities[u['id'], self_forward_ids]
-        self_forward_long = calc_primitive(sfl_vals)
-        sfm_vals = similarities[u['id'], self_forward_ids[:medium_range]]
-        self_forward_medium = calc_primitive(sfm_vals)
-        sfs_vals = similarities[u['id'], self_forward_ids[:short_range]]
-        self_forward_short = calc_primitive(sfs_vals)
-
-        # Other Backward
-        other_backward_ids = list(filter(lambda i: i < u['id'], other_ids))
-        obl_vals = similarities[u['id'], other_backward_ids]
-        other_backward_long = calc_primitive(obl_vals)
-        obm_vals = similarities[u['id'], other_backward_ids[-medium_range:]]
-        other_backward_medium = calc_primitive(obm_vals)
-        obs_vals = similarities[u['id'], other_backward_ids[-short_range:]]
-        other_backward_short = calc_primitive(obs_vals)
-
-        # Other Forward
-        other_forward_ids = list(filter(lambda i: i > u['id'], other_ids))
-        ofl_vals = similarities[u['id'], other_forward_ids]
-        other_forward_long = calc_primitive(ofl_vals)
-        ofm_vals = similarities[u['id'], other_forward_ids[:medium_range]]
-        other_forward_medium = calc_primitive(ofm_vals)
-        ofs_vals = similarities[u['id'], other_forward_ids[:short_range]]
-        other_forward_short = calc_primitive(ofs_vals)
-
-        # utterance_primitives.append
-        utterance_primitives.append(Primitives(
-            self_backward_short, self_backward_medium, self_backward_long,
-            self_forward_short, self_forward_medium, self_forward_long,
-            other_backward_short, other_backward_medium, other_backward_long,
-            other_forward_short, other_forward_medium, other_forward_long
-        ))
+    _check_ranges((short_range, medium_range, None))
+    if window is not None:
+        if window < 1:
+            raise ValueError('window must be at least 1')
+        result = load_recurrence_model(project_dir, model, num_terms, limit=None, include_text=False)
+        return _calculate_banded_primitives(
+            result['utterances'], result['embeddings'], window, short_range, medium_range
+        )
+    return [
+        Primitives(*values)
+        for values in iter_primitives(project_dir, model, num_terms, (short_range, medium_range, None))
+    ]
+
+
+def iter_primitives(
+    project_dir, model, num_terms=None, ranges=PRIMITIVE_RANGES,
+    memory_limit=recurrence.MEMORY_LIMIT, workers=recurrence.WORKERS
+):
+    """
+    Generate the primitives of each utterance for any neighbour `ranges` (`None` for all neighbours).
+
+    Primitives are computed from blocks of recurrence rows in turn, read from the full matrix of the
+    model (cached if it fits) or computed from the utterance embeddings, so memory is bounded by
+    `memory_limit`.
+
+    Yields lists of values in `primitive_fields(ranges)` order.
+    """
+    _check_ranges(ranges)
+    _, channels = np.unique(IndexReader(project_dir).get_channels(), return_inverse=True)
+    positions = np.arange(len(channels))
+    for rows, similarities in _recurrence_rows(project_dir, model, num_terms, memory_limit, workers):
+        for means in _primitive_means(similarities, positions[rows], channels, ranges):
+            yield means.ravel().tolist()
+
+
+def _check_ranges(ranges):
+    """Raise ValueError unless neighbour `ranges` are distinct, and each at least 1 or `None` (all neighbours)."""
+    if any(limit is not None and limit < 1 for limit in ranges):
+        raise ValueError('Primitive ranges must be at least 1')
+    if len(set(ranges)) != len(ranges):
+        raise ValueError('Primitive ranges must be distinct')
+
+
+def _recurrence_rows(project_dir, model, num_terms, memory_limit, workers):
+    """
+    Yield (rows, similarities) blocks of full recurrence rows.
+
+    Rows are read from the full matrix in the project's cache, which is cached first if it fits (see
+    `_cached_recurrence`), and computed by the recurrence engine otherwise.
+    """
+    model, delta = _parse_model(model)
+    params = {'model': model, 'delta': delta, 'num_terms': num_terms}
+
+    def load_embeddings():
+        return load_utterance_embeddings(project_dir, model, num_terms, delta)
+
+    matrix = _cached_recurrence(cache.Cache(project_dir), params, load_embeddings, memory_limit, workers)
+    if matrix is None:
+        yield from recurrence.map_rows(load_embeddings(), memory_limit, workers)
+        return
+    n = len(matrix)
+    size = max(1, memory_limit // (8 * 4 * max(n, 1)))
+    for start in range(0, n, size):
+        rows = slice(start, min(start + size, n))
+        yield (rows, np.asarray(matrix[rows], dtype=np.float64))
+
+
+def _primitive_means(similarities, rows, channels, ranges):
+    """
+    Calculate mean recurrence of the utterances `rows` with their neighbours, from their `similarities`.
+
+    `similarities` are those of each row with all utterances. Neighbours are utterances of the same
+    (self) or other `channels`, backward or forward of each utterance, limited to the nearest of each
+    per `ranges` (`None` for all). They are ranked outwards by cumulative sums of their masks along
+    each row.
+
+    Returns an array of (self backward, self forward, other backward, other forward) x `ranges` means
+    for each row, 0 without neighbours.
+    """
+    positions = np.arange(len(channels))
+    same = channels[rows][:, None] == channels[None, :]
+    before = positions[None, :] < rows[:, None]
+    after = positions[None, :] > rows[:, None]
+    means = np.zeros((len(rows), 4, len(ranges)))
+    for direction, (mask, backward) in enumerate(
+        ((same & before, True), (same & after, False), (~same & before, True), (~same & after, False))
+    ):
+        # Rank of neighbours outwards from each utterance, from 1
+        ranks = np.cumsum(mask, axis=1)
+        if backward:
+            ranks = ranks[:, -1:] - ranks + mask
+        for k, limit in enumerate(ranges):
+            selected = mask if limit is None else mask & (ranks <= limit)
+            means[:, direction, k] = _masked_means(similarities, selected)
+    return means
+
+
+def _masked_means(values, selected):
+    """Return the mean of the `selected` `values` of each row, 0 if none are selected."""
+    counts = selected.sum(axis=1)
+    sums = np.where(selected, values, 0).sum(axis=1)
+    return np.where(counts, sums / np.maximum(counts, 1), 0)
+
+
+def _calculate_banded_primitives(utterances, utterance_embeddings, window, short_range, medium_range):
+    """
+    Calculate `Primitives` of `utterances` with a recurrence band of `window`.
+
+    Short and medium ranges look up the band, computing the few pairs beyond it directly. Long
+    ranges are accumulated from blocks of recurrence rows, so the full matrix is never stored.
+    """
+    ids = np.array([u['id'] for u in utterances])
+    _, channels = np.unique([u['channel'] for u in utterances], return_inverse=True)
+    n_neighbours = max(short_range, medium_range)
+
+    # Nearest utterances of the same and other channels, backward and forward of each utterance, nearest first
+    channel_ids = [ids[channels == channel] for channel in range(channels.max() + 1 if len(ids) else 0)]
+    other_channel_ids = [ids[channels != channel] for channel in range(len(channel_ids))]
+    neighbours = []
+    for i, channel in zip(ids, channels):
+        self_ids = channel_ids[channel]
+        other_ids = other_channel_ids[channel]
+        k_self = np.searchsorted(self_ids, i)
+        k_other = np.searchsorted(other_ids, i)
+        neighbours.extend([
+            self_ids[max(0, k_self - n_neighbours):k_self][::-1], self_ids[k_self + 1:k_self + 1 + n_neighbours],
+            other_ids[max(0, k_other - n_neighbours):k_other][::-1], other_ids[k_other:k_other + n_neighbours]
+        ])
+    lengths = np.array([len(neighbour_ids) for neighbour_ids in neighbours], dtype=np.int64)
+    nearest = np.arange(n_neighbours)[None, :]
+    found = nearest < lengths[:, None]
+    values = np.zeros(found.shape)
+    values[found] = recurrence.band_values(
+        recurrence.compute_band(utterance_embeddings, window), utterance_embeddings,
+        np.repeat(np.repeat(ids, 4), lengths), np.concatenate(neighbours).astype(np.int64)
+    )
+    short_means = _masked_means(values, found & (nearest < short_range)).reshape(-1, 4)
+    medium_means = _masked_means(values, found & (nearest < medium_range)).reshape(-1, 4)
+
+    # Long ranges, as (self backward, self forward, other backward, other forward) means
+    long_means = []
+    for rows, tile in recurrence.map_rows(utterance_embeddings):
+        long_means.extend(_primitive_means(tile, np.arange(len(ids))[rows], channels, (None,))[:, :, 0].tolist())
 
-    return utterance_primitives
+    means = np.stack([short_means, medium_means, np.array(long_means).reshape(-1, 4)], axis=2)
+    return [Primitives(*utterance_means.ravel().tolist()) for utterance_means in means]
@@ -6,15 +6,20 @@ Projects encapsulate data, settings and results for a recurrence analysis.
 from collections import Counter
 import csv
 from io import StringIO, TextIOWrapper
+import logging
 import os
 import shutil
 
 from celery import shared_task
+import numpy as np
 from sqlalchemy import Column, Integer, String
 
+import cache
 from database import db
-from index import IndexReader, IndexUpdater, IndexWriter
+import embeddings
+from index import EMBEDDINGS_FILE, EMBEDDING_SCALES_FILE, INDEX_FILE, IndexReader, IndexUpdater, IndexWriter
 import processing
+import registry
 import text_util
 
 
@@ -23,11 +28,24 @@ PROJECTS_DIR = os.path.join(BASE_DIR, 'projects')
 ALLOWED_EXTENSIONS = set(['csv'])
 CHANNEL_HEADERS = ('channel', 'speaker', 'name')
 
+# 'global' looks up term positions in the global layout of the embedding store, when it has one,
+# rather than laying out the terms of each project
+TERM_LAYOUT = os.environ.get('DISCURSIS_TERM_LAYOUT', 'project')
+
 # Create projects dir
 if not os.path.exists(PROJECTS_DIR):
     os.makedirs(PROJECTS_DIR)
 
 
+def _load_spacy():
+    """Load the spaCy model used for sentence tokenization."""
+    import spacy
+    return spacy.load("en_core_web_sm")
+
+
+registry.register('spacy', _load_spacy)
+
+
 class SimpleDoc(object):
     """
     Simple document wrapper.
@@ -65,74 +83,93 @@ class Project(db.Model):
         self.tokenization = tokenization
         self.status = 'Pending'
 
-    def add_data(self, files):
-        """Load the project's data and process it."""
+    def add_data(self, files, progress=None):
+        """Load the project's data and process it, reporting `progress(message)` of slow steps."""
         project_path = self.get_path()
         os.makedirs(project_path)
         index_writer = IndexWriter(project_path)
 
         try:
-            for filename, data in files.items():
-                f = StringIO(data)
-                reader = csv.reader(f)
-
-                # Process headers
-                channel_id = None
-                metadata_index = {}
-                headers = [h.lower() for h in next(reader)]
-                for i, header in enumerate(headers):
-                    header = header.strip().lower()
-                    if header == 'text':
-                        text_index = i
-                    else:
-                        field_id = index_writer.add_metadata_field(header)
-                        metadata_index[i] = field_id
-                        if header in CHANNEL_HEADERS:
-                            channel_id = field_id
-
-                # Process rows
-                if self.tokenization == 'sentences':
-                    import spacy
-                    nlp = spacy.load("en_core_web_sm")
-                else:
-                    def nlp(u):
-                        return SimpleDoc([u])
-                for row in reader:
-                    utterance_metadata = {}
-                    for i, cell in enumerate(row):
-                        if i == text_index:
-                            utterance_text = cell
-                        else:
-                            utterance_metadata[metadata_index[i]] = cell
-                    for sent in nlp(utterance_text).sents:
-                        index_writer.add_utterance(
-                            utterance_metadata[channel_id], sent.text, utterance_metadata,
-                            Counter(text_util.tokenize(sent.text, language=self.language))
-                        )
-
+            index_files(index_writer, files, self.language, self.tokenization)
             index_writer.finish()
 
             # processing.generate_cluster_layout(datadir)
-            self._create_term_layout()
+            self._create_term_embeddings()
+            self._create_term_layout(progress)
+            self._create_term_tree()
 
         except Exception as e:
             shutil.rmtree(project_path, True)
             raise e
 
+    def append_data(self, files):
+        """
+        Append utterances of `files` to the project's existing index.
+
+        The index is updated in one transaction, and the stored term embeddings only have rows of new
+        terms appended, so errors roll back the index and truncate the embeddings as they were, without
+        copying either. Embeddings, layout positions and term tree edges are only computed for new terms,
+        and cached recurrence is then extended with only the rows of the new utterances.
+        """
+        project_path = self.get_path()
+        self._upgrade_term_embeddings()
+        reader = self.get_reader()
+        old_terms = reader.get_terms_ordered()
+        old_count = reader.get_utterance_count()
+        old_rows = len(reader.get_term_embeddings())
+        # Restoring modification times keeps the restored cache valid for the restored files
+        stats = {}
+        for filename in (INDEX_FILE, EMBEDDINGS_FILE, EMBEDDING_SCALES_FILE):
+            if os.path.exists(os.path.join(project_path, filename)):
+                stats[filename] = os.stat(os.path.join(project_path, filename))
+        index_writer = IndexWriter(project_path, append=True)
+        old_cache = cache.Cache(project_path).detach()
+        try:
+            index_files(index_writer, files, self.language, self.tokenization)
+            index_writer.flush()
+            self._update_term_embeddings(index_writer.connection)
+            terms = self._update_term_layout(old_terms, index_writer.connection)
+            self._update_term_tree(terms, index_writer.connection)
+            index_writer.finish()
+        except Exception:
+            index_writer.abort()
+            IndexUpdater(project_path).truncate_term_embeddings(old_rows)
+            for filename, stat in stats.items():
+                path = os.path.join(project_path, filename)
+                if os.stat(path).st_size == stat.st_size:
+                    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            old_cache.restore(project_path)
+            raise
+
+        try:
+            processing.extend_recurrence_cache(project_path, old_cache, old_terms, old_count)
+        except Exception:
+            # The appended index is complete; anything not cached is computed on demand
+            logging.getLogger(__name__).warning('Failed to extend the cache of %s', project_path, exc_info=True)
+        finally:
+            old_cache.clear()
+
     def get_reader(self):
         """Get `IndexReader` for this project."""
         return IndexReader(self.get_path())
 
     def generate_term_clusters(self, distance_threshold=0.01):
-        """Generate term clusters for this project with given `distance_threshold`."""
+        """
+        Generate term clusters for this project with given `distance_threshold`.
+
+        Clusters are cut from the term tree stored in the index. Projects created before it was stored
+        have it computed on each use instead, until `build_term_trees` stores it, since writing the index
+        would invalidate their cache.
+        """
         reader = self.get_reader()
         terms = reader.get_terms_ordered()
-        term_positions = reader.get_term_layout()
         ignored_terms = reader.get_ignored_terms()
-        terms = list(filter(lambda t: t not in ignored_terms, terms))
-        positions = [term_positions[term] for term in terms]  # maintain order
-        distances = processing.find_similar_terms(positions, distance_threshold)
-        return processing.generate_term_clusters(terms, distances)
+        terms = list(filter(lambda t: t not in ignored_terms, terms))  # maintain order
+        tree = reader.get_term_tree()
+        if tree is None:
+            tree = self._compute_term_tree()
+        edges, mean_distance = tree
+        return processing.cut_term_tree(terms, edges, mean_distance * distance_threshold)
 
     def get_path(self):
         """Get path for this project's data & index."""
@@ -150,16 +187,130 @@ class Project(db.Model):
     def generate_recurrence(self, model, num_terms=None):
         return processing.generate_recurrence(os.path.join(PROJECTS_DIR, str(self.id)), model, num_terms)
 
-    def _create_term_layout(self):
-        """Generate and store 2D projection of term vectors."""
+    def _create_term_embeddings(self):
+        """Store the embeddings of this project's vocabulary alongside its index."""
+        terms = self.get_reader().get_terms_added()
+        updater = self._get_updater()
+        updater.save_term_embeddings(*embeddings.quantize(processing.get_term_embeddings(terms)))
+        updater.finish()
+
+    def _upgrade_term_embeddings(self):
+        """Store the embeddings of this project's vocabulary in the order its terms were added, if they aren't."""
+        reader = self.get_reader()
+        vectors = reader.get_term_embeddings()
+        if vectors is None:
+            return self._create_term_embeddings()
+        if reader.get_term_embedding_order() == 'added':
+            return
+        row_index = {term: i for i, term in enumerate(reader.get_term_embedding_terms())}
+        rows = [row_index[term] for term in reader.get_terms_added()]
+        scales = reader.get_term_embedding_scales()
+        updater = self._get_updater()
+        updater.save_term_embeddings(vectors[rows], None if scales is None else scales[rows])
+        updater.finish()
+
+    def _update_term_embeddings(self, connection):
+        """Append the stored embeddings of terms added to the index since, within the transaction of `connection`."""
+        reader = IndexReader(self.get_path(), connection)
+        vectors = reader.get_term_embeddings()
+        new_terms = reader.get_terms_added()[len(vectors):]
+        new_vectors, new_scales = embeddings.quantize(processing.get_term_embeddings(new_terms), vectors.dtype.name)
+        IndexUpdater(self.get_path(), connection).append_term_embeddings(new_vectors, new_scales)
+
+    def _create_term_layout(self, progress=None):
+        """Generate and store 2D projection of term vectors, reporting `progress(message)`."""
         reader = self.get_reader()
         terms = reader.get_terms_ordered()
-        positions, skipped_terms = processing.generate_2d_projection(terms)
+        project_progress = progress and (lambda fraction: progress('Laying out terms ({:.0%})'.format(fraction)))
+        mode = 'global' if _use_global_layout() else 'project'
+        if mode == 'global':
+            positions, skipped_terms = processing.lookup_2d_projection(terms, progress=project_progress)
+        else:
+            positions, skipped_terms = processing.generate_2d_projection(terms, progress=project_progress)
         terms = list(filter(lambda t: t not in skipped_terms, terms))
         updater = self._get_updater()
         updater.save_term_layout(terms, positions.tolist())
+        updater.save_term_layout_mode(mode)
+        updater.save_ignored_terms(skipped_terms)
+        updater.finish()
+
+    def _update_term_layout(self, old_terms, connection):
+        """
+        Place terms added since `old_terms` in the existing 2D layout, within the transaction of `connection`.
+
+        Terms are looked up in the global layout if the project was laid out in it, whatever the
+        current `TERM_LAYOUT`, and placed next to their most similar terms otherwise. Returns the
+        terms placed.
+        """
+        reader = IndexReader(self.get_path(), connection)
+        layout = reader.get_term_layout()
+        old_terms = set(old_terms)
+        terms = [term for term in reader.get_terms_ordered() if term not in old_terms]
+        if reader.get_term_layout_mode() == 'global':
+            positions, skipped_terms = processing.lookup_2d_projection(terms, refine_epochs=0)
+        else:
+            # Laid out terms have embeddings in the project's slice
+            layout_terms = list(layout)
+            positions, skipped_terms = processing.place_terms(
+                terms, processing.load_term_embeddings(reader, layout_terms), [layout[term] for term in layout_terms]
+            )
+        terms = list(filter(lambda t: t not in skipped_terms, terms))
+        updater = IndexUpdater(self.get_path(), connection)
+        updater.save_term_layout(terms, positions.tolist())
         updater.save_ignored_terms(skipped_terms)
+        return terms
+
+    def _compute_term_tree(self):
+        """Generate the minimum spanning tree of the term layout, returning (edges, mean distance)."""
+        layout = self.get_reader().get_term_layout()
+        terms = list(layout)
+        positions = np.array([layout[term] for term in terms], dtype=np.float64).reshape(-1, 2)
+        sources, targets, distances = processing.generate_term_tree(positions)
+        edges = [(terms[s], terms[t], d) for s, t, d in zip(sources.tolist(), targets.tolist(), distances.tolist())]
+        return (edges, processing.mean_distance(positions))
+
+    def _create_term_tree(self):
+        """Generate and store the minimum spanning tree of the term layout, returning (edges, mean distance)."""
+        edges, mean_distance = self._compute_term_tree()
+        updater = self._get_updater()
+        updater.save_term_tree(edges, mean_distance)
         updater.finish()
+        return (edges, mean_distance)
+
+    def _update_term_tree(self, terms, connection):
+        """Add the newly laid out `terms` to the stored term tree, within the transaction of `connection`."""
+        reader = IndexReader(self.get_path(), connection)
+        layout = reader.get_term_layout()
+        new_terms = set(terms)
+        terms = [term for term in layout if term not in new_terms] + [term for term in layout if term in new_terms]
+        positions = np.array([layout[term] for term in terms], dtype=np.float64).reshape(-1, 2)
+        updater = IndexUpdater(self.get_path(), connection)
+        tree = reader.get_term_tree()
+        if tree is None:
+            sources, targets, distances = processing.generate_term_tree(positions)
+            edges = zip([terms[s] for s in sources.tolist()], [terms[t] for t in targets.tolist()], distances.tolist())
+            updater.save_term_tree(list(edges), processing.mean_distance(positions))
+            return
+
+        edges, mean_distance = tree
+        start = len(terms) - len(new_terms)
+        term_index = {term: i for i, term in enumerate(terms)}
+        old_edges = {frozenset((source, target)): (source, target) for source, target, _ in edges}
+        sources, targets, distances = processing.update_term_tree(
+            positions, start,
+            [term_index[source] for source, _, _ in edges],
+            [term_index[target] for _, target, _ in edges]
+        )
+        edges = {
+            frozenset((terms[s], terms[t])): (terms[s], terms[t], d)
+            for s, t, d in zip(sources.tolist(), targets.tolist(), distances.tolist())
+        }
+        # Only edges that changed are written
+        updater.update_term_tree(
+            [old_edges[key] for key in old_edges if key not in edges],
+            [edges[key] for key in edges if key not in old_edges],
+            processing.extend_mean_distance(positions, start, mean_distance)
+        )
 
     def _get_writer(self):
         """Get `IndexWriter` for this project."""
@@ -182,20 +333,7 @@ def create(creator_id, name, files, language='english', tokenization='utterances
     """
     if Project.query.filter_by(creator_id=creator_id, name=name).first():
         raise ProjectError('A project called {} already exists; Please use a different name.'.format(name))
-
-    # Check file types and schema
-    for f in files:
-        if not _allowed_file(f.filename):
-            raise ProjectError('Invalid file type; Accepted types: {}'.format(ALLOWED_EXTENSIONS))
-        # Look for channel field
-        csv_input = csv.reader(TextIOWrapper(f, encoding='utf-8', errors='ignore'))
-        headers = next(csv_input)
-        f.seek(0)
-        if len(list(filter(lambda h: h.lower() in CHANNEL_HEADERS, headers))) == 0:
-            raise ProjectError(
-                'Data file "{}" missing channel field. '.format(f.filename) +
-                'Specify channel field using one of the following column headers: {}'.format(CHANNEL_HEADERS)
-            )
+    _check_files(files)
 
     # Create project
     project = Project(creator_id, name, language, tokenization)
@@ -213,20 +351,146 @@ def create(creator_id, name, files, language='english', tokenization='utterances
     return project
 
 
+def append(id, files):
+    """Append the utterances of data `files` to the project `id`."""
+    project = Project.query.get(id)
+    if project.status != 'Ready':
+        raise ProjectError('Project is {}; Please wait until it is ready.'.format(project.status.lower()))
+    _check_files(files)
+
+    project.status = 'Running'
+    db.session.commit()
+    data = {f.filename: TextIOWrapper(f, encoding='utf-8', errors='ignore').read() for f in files}
+    if os.environ.get('DISCURSIS_TEST', False):
+        _run_and_append_project(project.id, data)
+    else:
+        _run_and_append_project.delay(project.id, data)
+
+    return project
+
+
+def _check_files(files):
+    """Check file types and schema of data `files`."""
+    for f in files:
+        if not _allowed_file(f.filename):
+            raise ProjectError('Invalid file type; Accepted types: {}'.format(ALLOWED_EXTENSIONS))
+        # Look for channel field
+        csv_input = csv.reader(TextIOWrapper(f, encoding='utf-8', errors='ignore'))
+        headers = next(csv_input)
+        f.seek(0)
+        if len(list(filter(lambda h: h.lower() in CHANNEL_HEADERS, headers))) == 0:
+            raise ProjectError(
+                'Data file "{}" missing channel field. '.format(f.filename) +
+                'Specify channel field using one of the following column headers: {}'.format(CHANNEL_HEADERS)
+            )
+
+
 @shared_task
 def _run_and_save_project(project_id, files):
     project = Project.query.get(project_id)
     project.status = 'Running'
     db.session.commit()
+
+    def progress(message):
+        project.status_info = message
+        db.session.commit()
+
     try:
-        project.add_data(files)
+        project.add_data(files, progress)
     except Exception as e:
         project.status = 'Error'
         project.status_info = str(e)
         raise ProjectError(e)
     project.status = 'Ready'
+    project.status_info = None
     db.session.commit()
 
+    # Build the overview of the default recurrence model in the background
+    if os.environ.get('DISCURSIS_TEST', False):
+        _build_recurrence_pyramid(project_id)
+    else:
+        _build_recurrence_pyramid.delay(project_id)
+
+
+@shared_task
+def _run_and_append_project(project_id, files):
+    project = Project.query.get(project_id)
+    try:
+        project.append_data(files)
+    except Exception as e:
+        # The existing data is restored, so the project stays usable and the append can be retried
+        project.status = 'Ready'
+        project.status_info = 'Appending data failed: {}'.format(e)
+        db.session.commit()
+        raise ProjectError(e)
+    project.status = 'Ready'
+    project.status_info = None
+    db.session.commit()
+
+    if os.environ.get('DISCURSIS_TEST', False):
+        _build_recurrence_pyramid(project_id)
+    else:
+        _build_recurrence_pyramid.delay(project_id)
+
+
+@shared_task
+def _build_recurrence_pyramid(project_id, model='composition', num_terms=None):
+    processing.load_recurrence_pyramid(get_project_dir(str(project_id)), model, num_terms)
+
+
+def build_term_trees():
+    """
+    Store the term trees of ready projects created before they were stored, returning their ids.
+
+    A one-off migration: storing the tree rewrites the index, which invalidates the project's cache.
+    """
+    built = []
+    for project in Project.query.filter_by(status='Ready').all():
+        if project.get_reader().get_term_tree() is None:
+            project._create_term_tree()
+            built.append(project.id)
+    return built
+
+
+def index_files(index_writer, files, language='english', tokenization='utterances'):
+    """Tokenize and add the utterances of CSV `files` (mapping filename -> data) with `index_writer`."""
+    for filename, data in files.items():
+        f = StringIO(data)
+        reader = csv.reader(f)
+
+        # Process headers
+        channel_id = None
+        metadata_index = {}
+        headers = [h.lower() for h in next(reader)]
+        for i, header in enumerate(headers):
+            header = header.strip().lower()
+            if header == 'text':
+                text_index = i
+            else:
+                field_id = index_writer.add_metadata_field(header)
+                metadata_index[i] = field_id
+                if header in CHANNEL_HEADERS:
+                    channel_id = field_id
+
+        # Process rows
+        if tokenization == 'sentences':
+            nlp = registry.get('spacy')
+        else:
+            def nlp(u):
+                return SimpleDoc([u])
+        for row in reader:
+            utterance_metadata = {}
+            for i, cell in enumerate(row):
+                if i == text_index:
+                    utterance_text = cell
+                else:
+                    utterance_metadata[metadata_index[i]] = cell
+            for sent in nlp(utterance_text).sents:
+                index_writer.add_utterance(
+                    utterance_metadata[channel_id], sent.text, utterance_metadata,
+                    Counter(text_util.tokenize(sent.text, language=language))
+                )
+
 
 def delete(id):
     """Delete the specified project."""
@@ -260,6 +524,11 @@ def listall(creator_id):
     return Project.query.filter_by(creator_id=creator_id).all()
 
 
+def _use_global_layout():
+    """Whether term positions are looked up in the global layout of the embedding store."""
+    return TERM_LAYOUT == 'global' and registry.get('embeddings').layout is not None
+
+
 def _allowed_file(filename):
     """Check for valid upload file type."""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
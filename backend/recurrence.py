@@ -0,0 +1,401 @@
+"""
+Recurrence engine.
+
+Recurrence is the cosine similarity between utterance embeddings. Rather than
+computing whole matrices at once, the engine computes tiles of recurrence from
+row-normalised embeddings, so large matrices can be written to and read from
+memory-mapped files within a fixed RAM ceiling.
+
+Tiles are computed on a small thread pool (see `WORKERS`); the matrix products
+release the GIL, so tiles (and both halves of delta models) are computed on
+several cores.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import math
+import os
+
+import numpy as np
+
+import util
+
+
+# RAM ceiling (bytes) for computing or reading recurrence
+MEMORY_LIMIT = int(os.environ.get('DISCURSIS_RECURRENCE_MEMORY', 256 * 1024 * 1024))
+
+# Precision of recurrence matrices stored on disk
+DTYPE = np.dtype(os.environ.get('DISCURSIS_RECURRENCE_DTYPE', 'float32'))
+
+# Side of the finest level of recurrence pyramids
+PYRAMID_MAX_SIDE = int(os.environ.get('DISCURSIS_PYRAMID_MAX_SIDE', 2048))
+
+# Threads computing tiles in each process. The matrix product of each tile already runs on the
+# BLAS library's threads, and Celery runs several worker processes, so more threads than a couple
+# oversubscribe the CPU. Raise it along with fewer BLAS threads (e.g. OMP_NUM_THREADS=1) instead.
+WORKERS = int(os.environ.get('DISCURSIS_RECURRENCE_WORKERS', 2))
+
+# Side of the tiles (0 derives it from the RAM ceiling)
+BLOCK_SIZE = int(os.environ.get('DISCURSIS_RECURRENCE_BLOCK_SIZE', 0))
+
+
+def utterance_range(index, n):
+    """Return (start, stop) of slice `index` over `n` utterances."""
+    start, stop, _ = (index or slice(None)).indices(n)
+    return (start, max(start, stop))
+
+
+def _cosine(normalized, rows, cols):
+    """Compute clipped cosine similarities of `normalized` embeddings for the `rows` x `cols` ranges."""
+    tile = normalized[rows[0]:rows[1]] @ normalized[cols[0]:cols[1]].T
+    if not isinstance(tile, np.ndarray):
+        tile = tile.toarray()
+    np.clip(tile, 0, 1, out=tile)
+
+    # Every utterance fully recurs with itself
+    diagonal = np.arange(max(rows[0], cols[0]), min(rows[1], cols[1]))
+    tile[diagonal - rows[0], diagonal - cols[0]] = 1
+    return tile
+
+
+def _pair_cosine(normalized, rows, cols):
+    """Compute clipped cosine similarities of `normalized` embeddings for the utterance pairs (`rows`, `cols`)."""
+    if isinstance(normalized, np.ndarray):
+        values = np.einsum('ij,ij->i', normalized[rows], normalized[cols])
+    else:
+        values = np.asarray(normalized[rows].multiply(normalized[cols]).sum(axis=1)).ravel()
+    np.clip(values, 0, 1, out=values)
+    values[rows == cols] = 1
+    return values
+
+
+class UtteranceEmbeddings:
+    """
+    Row-normalised utterance embeddings to compute recurrence from.
+
+    Embeddings may be dense or sparse. Delta models also take `term_embeddings`, whose
+    recurrence is subtracted from that of `embeddings`.
+    """
+
+    def __init__(self, embeddings, term_embeddings=None):
+        """Normalise `embeddings` (and optional `term_embeddings`)."""
+        self.normalized = util.normalize_rows(embeddings)
+        self.normalized_term = None
+        if term_embeddings is not None:
+            self.normalized_term = util.normalize_rows(term_embeddings)
+
+    @classmethod
+    def from_normalized(cls, normalized, normalized_term=None):
+        """Wrap already row-normalised embeddings, e.g. memory-mapped cached ones, without copying them."""
+        utterance_embeddings = cls.__new__(cls)
+        utterance_embeddings.normalized = normalized
+        utterance_embeddings.normalized_term = normalized_term
+        return utterance_embeddings
+
+    def __len__(self):
+        return self.normalized.shape[0]
+
+    def parts(self):
+        """Return the normalised embeddings whose recurrence makes up this model."""
+        if self.normalized_term is None:
+            return [self.normalized]
+        return [self.normalized, self.normalized_term]
+
+    def tile(self, rows=None, cols=None):
+        """Compute the recurrence tile for the utterance slices `rows` x `cols` (default: all)."""
+        rows = utterance_range(rows, len(self))
+        cols = utterance_range(cols, len(self))
+        tile = _cosine(self.normalized, rows, cols)
+        if self.normalized_term is not None:
+            tile -= _cosine(self.normalized_term, rows, cols)
+        return tile
+
+    def pairs(self, rows, cols, block_size=8192):
+        """Compute recurrence of the utterance pairs given by index arrays `rows` and `cols`."""
+        values = np.empty(len(rows))
+        for start in range(0, len(rows), block_size):
+            pair_rows = rows[start:start + block_size]
+            pair_cols = cols[start:start + block_size]
+            values[start:start + block_size] = _pair_cosine(self.normalized, pair_rows, pair_cols)
+            if self.normalized_term is not None:
+                values[start:start + block_size] -= _pair_cosine(self.normalized_term, pair_rows, pair_cols)
+        return values
+
+    def map_tiles(self, tiles, executor, max_pending):
+        """
+        Compute recurrence `tiles` ((rows, cols) slice pairs) on `executor`, yielding (rows, cols, tile) in order.
+
+        Each half of a delta model is a separate task, so both are computed concurrently. At most
+        `max_pending` tiles are in flight at once, bounding memory.
+        """
+        pending = deque()
+        for rows, cols in tiles:
+            ranges = (utterance_range(rows, len(self)), utterance_range(cols, len(self)))
+            pending.append((rows, cols, [executor.submit(_cosine, part, *ranges) for part in self.parts()]))
+            if len(pending) >= max_pending:
+                yield _combine(*pending.popleft())
+        while pending:
+            yield _combine(*pending.popleft())
+
+
+def _combine(rows, cols, futures):
+    """Combine the computed halves of a tile, returning (rows, cols, tile)."""
+    tile = futures[0].result()
+    for future in futures[1:]:
+        tile -= future.result()
+    return (rows, cols, tile)
+
+
+def tile_size(memory_limit=MEMORY_LIMIT, workers=WORKERS):
+    """Return the side of square float64 tiles that `workers` can compute within `memory_limit` bytes."""
+    if BLOCK_SIZE:
+        return BLOCK_SIZE
+    # Allow for both halves of delta tiles, pending tiles and a copy when storing
+    return max(1, int(math.sqrt(memory_limit / (8 * 4 * workers))))
+
+
+def map_upper(embeddings, size, workers=WORKERS):
+    """Compute `size` x `size` tiles covering the upper triangle of recurrence, yielding (rows, cols, tile) in order."""
+    n = len(embeddings)
+    tiles = [
+        (slice(row, row + size), slice(col, col + size))
+        for row in range(0, n, size) for col in range(row, n, size)
+    ]
+    with ThreadPoolExecutor(workers) as executor:
+        yield from embeddings.map_tiles(tiles, executor, 2 * workers)
+
+
+def fill(embeddings, matrix, memory_limit=MEMORY_LIMIT, workers=WORKERS, block_size=None):
+    """
+    Fill `matrix` (e.g. a memory map) with the full recurrence matrix of `embeddings`.
+
+    Square tiles of the upper triangle are computed on a pool of `workers` threads and
+    each is also stored transposed.
+    """
+    for rows, cols, tile in map_upper(embeddings, block_size or tile_size(memory_limit, workers), workers):
+        matrix[rows, cols] = tile
+        if rows != cols:
+            matrix[cols, rows] = tile.T
+    return matrix
+
+
+def compute_matrix(embeddings, dtype=np.float64, workers=WORKERS, block_size=None):
+    """Compute the full recurrence matrix of `embeddings` in memory."""
+    n = len(embeddings)
+    return fill(embeddings, np.empty((n, n), dtype=dtype), workers=workers, block_size=block_size)
+
+
+def _significant(rows, tile, min_similarity=None, top_k=None):
+    """Return (rows, cols, values) of nonzero cells of `tile` above `min_similarity` and in the `top_k` of their row."""
+    magnitude = np.abs(tile)
+    mask = magnitude > 0
+    if min_similarity is not None:
+        mask &= magnitude >= min_similarity
+    if top_k is not None and top_k < tile.shape[1]:
+        top = np.zeros(tile.shape, dtype=bool)
+        np.put_along_axis(top, np.argpartition(-magnitude, top_k - 1, axis=1)[:, :top_k], True, axis=1)
+        mask &= top
+    tile_rows, cols = np.nonzero(mask)
+    return (tile_rows + rows.start, cols, tile[tile_rows, cols])
+
+
+def map_rows(embeddings, memory_limit=MEMORY_LIMIT, workers=WORKERS, block_size=None):
+    """Compute recurrence of `embeddings` in blocks of full rows, yielding (rows, tile) in order."""
+    n = len(embeddings)
+    size = block_size or max(1, memory_limit // (8 * 4 * workers * max(n, 1)))
+    tiles = [(slice(row, min(row + size, n)), slice(None)) for row in range(0, n, size)]
+    with ThreadPoolExecutor(workers) as executor:
+        for rows, _, tile in embeddings.map_tiles(tiles, executor, 2 * workers):
+            yield (rows, tile)
+
+
+def compute_sparse(
+    embeddings, min_similarity=None, top_k=None, memory_limit=MEMORY_LIMIT, workers=WORKERS, block_size=None
+):
+    """
+    Compute the significant cells of the recurrence matrix of `embeddings` in coordinate form.
+
+    Cells are significant if their magnitude is at least `min_similarity` and among the `top_k`
+    largest of their row, counting the diagonal. Blocks of full rows are computed and reduced in turn, so the dense
+    matrix is never materialised.
+
+    Returns (rows, cols, values) arrays in row-major order.
+    """
+    parts = [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0))]
+    for rows, tile in map_rows(embeddings, memory_limit, workers, block_size):
+        parts.append(_significant(rows, tile, min_similarity, top_k))
+    return tuple(np.concatenate(part) for part in zip(*parts))
+
+
+def compute_band(
+    embeddings, window, dtype=np.float64, memory_limit=MEMORY_LIMIT, workers=WORKERS, block_size=None
+):
+    """
+    Compute recurrence of `embeddings` for the pairs at most `window` utterances apart.
+
+    Returns an N x (2 * `window` + 1) band, where `band[i, k]` is the recurrence of utterances
+    i and i + k - `window` (zero beyond either end of the conversation). Each block of rows only
+    computes the columns within `window` of it, so the cost is O(N * `window`).
+    """
+    n = len(embeddings)
+    offsets = np.arange(-window, window + 1)
+    size = block_size or max(1, min(max(window, 64), memory_limit // (8 * 4 * workers * (3 * window + 64))))
+    tiles = [
+        (slice(row, min(row + size, n)), slice(max(0, row - window), min(n, row + size + window)))
+        for row in range(0, n, size)
+    ]
+    band = np.zeros((n, len(offsets)), dtype=dtype)
+    with ThreadPoolExecutor(workers) as executor:
+        for rows, cols, tile in embeddings.map_tiles(tiles, executor, 2 * workers):
+            band_cols = np.arange(rows.start, rows.stop)[:, None] + offsets
+            tile_rows, band_offsets = np.nonzero((band_cols >= 0) & (band_cols < n))
+            tile_cols = band_cols[tile_rows, band_offsets] - cols.start
+            band[rows.start + tile_rows, band_offsets] = tile[tile_rows, tile_cols]
+    return band
+
+
+def band_values(band, embeddings, rows, cols):
+    """Look up recurrence of the utterance pairs (`rows`, `cols`) in `band`, computing pairs outside it directly."""
+    window = band.shape[1] // 2
+    offsets = cols - rows + window
+    in_band = (offsets >= 0) & (offsets < band.shape[1])
+    values = np.empty(len(rows))
+    values[in_band] = band[rows[in_band], offsets[in_band]]
+    values[~in_band] = embeddings.pairs(rows[~in_band], cols[~in_band])
+    return values
+
+
+def _pool(sums, maxes, factor):
+    """Sum `sums` and max `maxes` over `factor` x `factor` blocks, including partial blocks at the edges."""
+    shape = [-(-side // factor) for side in sums.shape]
+    padding = [(0, side * factor - original) for side, original in zip(shape, sums.shape)]
+    blocks = (shape[0], factor, shape[1], factor)
+    return (
+        np.pad(sums, padding).reshape(blocks).sum(axis=(1, 3)),
+        np.pad(maxes, padding, constant_values=-np.inf).reshape(blocks).max(axis=(1, 3))
+    )
+
+
+def _block_sizes(n, factor):
+    """Return the number of utterances in each block of `factor` utterances."""
+    sizes = np.full(-(-n // factor), factor)
+    sizes[-1] = n - factor * (len(sizes) - 1)
+    return sizes
+
+
+def compute_pyramid(
+    embeddings, max_side=PYRAMID_MAX_SIDE, memory_limit=MEMORY_LIMIT, workers=WORKERS, block_size=None
+):
+    """
+    Compute a pyramid of mean and max pooled recurrence of `embeddings`.
+
+    Levels pool blocks of 2 x 2, 4 x 4, 8 x 8... utterances, down to a single block. Only levels
+    at most `max_side` blocks wide are kept, since finer detail is better served by tiles. Tiles
+    are pooled as they are computed, so the full matrix is never stored.
+
+    Returns a list of (factor, means, maxes) levels from the finest to the coarsest.
+    """
+    n = len(embeddings)
+    if not n:
+        return []
+    factor = 2
+    while -(-n // factor) > max_side:
+        factor *= 2
+    size = block_size or tile_size(memory_limit, workers)
+    size = max(factor, size // factor * factor)
+
+    side = -(-n // factor)
+    sums = np.empty((side, side))
+    maxes = np.empty((side, side))
+    for rows, cols, tile in map_upper(embeddings, size, workers):
+        tile_sums, tile_maxes = _pool(tile, tile, factor)
+        pooled_rows = slice(rows.start // factor, rows.start // factor + tile_sums.shape[0])
+        pooled_cols = slice(cols.start // factor, cols.start // factor + tile_sums.shape[1])
+        sums[pooled_rows, pooled_cols] = tile_sums
+        maxes[pooled_rows, pooled_cols] = tile_maxes
+        if rows != cols:
+            sums[pooled_cols, pooled_rows] = tile_sums.T
+            maxes[pooled_cols, pooled_rows] = tile_maxes.T
+
+    levels = []
+    while True:
+        sizes = _block_sizes(n, factor)
+        levels.append((factor, sums / np.outer(sizes, sizes), maxes))
+        if len(sums) == 1:
+            return levels
+        sums, maxes = _pool(sums, maxes, 2)
+        factor *= 2
+
+
+def compute(embeddings, path, dtype=DTYPE, memory_limit=MEMORY_LIMIT, workers=WORKERS, block_size=None):
+    """Compute the full recurrence matrix of `embeddings` into a `.npy` file at `path`, returning its memory map."""
+    n = len(embeddings)
+    matrix = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(n, n))
+    fill(embeddings, matrix, memory_limit, workers, block_size)
+    matrix.flush()
+    del matrix
+    return np.load(path, mmap_mode='r')
+
+
+def extend(embeddings, start, path, dtype=DTYPE, memory_limit=MEMORY_LIMIT, workers=WORKERS, block_size=None):
+    """
+    Compute the recurrence of the utterances of `embeddings` from `start` into a `.npy` file at `path`.
+
+    Only the rows of utterances appended since `start` are computed, up to their diagonal, at a
+    cost of O(N * appended). They extend the matrix of the first utterances as a `BlockMatrix`.
+    Returns the memory map of the block.
+    """
+    n = len(embeddings)
+    block = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(n - start, n))
+    size = block_size or max(1, memory_limit // (8 * 4 * workers * n))
+    tiles = [(slice(row, min(row + size, n)), slice(None)) for row in range(start, n, size)]
+    with ThreadPoolExecutor(workers) as executor:
+        for rows, _, tile in embeddings.map_tiles(tiles, executor, 2 * workers):
+            block[rows.start - start:rows.stop - start] = tile
+    block.flush()
+    del block
+    return np.load(path, mmap_mode='r')
+
+
+class BlockMatrix:
+    """
+    Symmetric recurrence matrix stored as consecutive blocks of rows, e.g. one per append.
+
+    Each block holds its rows from the first column up to its own last row. Cells right of a
+    block are read, transposed, from the later blocks whose rows they are.
+    """
+
+    def __init__(self, blocks):
+        """Wrap the (memory-mapped) row `blocks`, each as wide as the rows up to its end."""
+        self.blocks = blocks
+        self.stops = np.cumsum([len(block) for block in blocks]).tolist()
+        self.starts = [0] + self.stops[:-1]
+        n = self.stops[-1] if blocks else 0
+        self.shape = (n, n)
+        self.dtype = blocks[0].dtype if blocks else DTYPE
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        """Return the dense tile of `key`, a slice of rows and optional slice of columns (with step 1)."""
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        if len(self.blocks) == 1:
+            return self.blocks[0][rows, cols]
+        n = len(self)
+        row_start, row_stop, _ = rows.indices(n)
+        col_start, col_stop, _ = cols.indices(n)
+        tile = np.zeros((max(0, row_stop - row_start), max(0, col_stop - col_start)), dtype=self.dtype)
+        for block, start, stop in zip(self.blocks, self.starts, self.stops):
+            # Cells of the block's rows, up to its last row
+            first, last, width = max(row_start, start), min(row_stop, stop), min(col_stop, stop) - col_start
+            if first < last and width > 0:
+                tile[first - row_start:last - row_start, :width] = block[
+                    first - start:last - start, col_start:col_start + width
+                ]
+            # Cells of earlier rows in the block's columns, stored transposed in its rows
+            first, last, height = max(col_start, start), min(col_stop, stop), min(row_stop, start) - row_start
+            if first < last and height > 0:
+                tile[:height, first - col_start:last - col_start] = block[
+                    first - start:last - start, row_start:row_start + height
+                ].T
+        return tile
@@ -0,0 +1,62 @@
+"""
+Registry of shared, lazily loaded resources.
+
+Modules register a loader for each heavy resource they own (embeddings, stopwords,
+tokenizer models) and fetch it with `get`, so the cost of loading is only paid by
+the first request that actually needs it.
+
+Prefork servers can instead `preload` resources in the parent process, so forked
+workers share the loaded pages copy-on-write rather than each loading a copy.
+"""
+import gc
+import logging
+import threading
+
+
+_loaders = {}
+_resources = {}
+_lock = threading.RLock()
+
+
+def register(name, loader):
+    """Register `loader` to create the resource `name` on first use."""
+    _loaders[name] = loader
+
+
+def get(name):
+    """Return the resource `name`, loading it on first use."""
+    try:
+        return _resources[name]
+    except KeyError:
+        pass
+    with _lock:
+        if name not in _resources:
+            _resources[name] = _loaders[name]()
+        return _resources[name]
+
+
+def loaded(name):
+    """Check whether the resource `name` has already been loaded."""
+    return name in _resources
+
+
+def preload(names=None):
+    """
+    Load the resources `names` (default: all registered resources) up front.
+
+    Loaded objects are then frozen out of garbage collection, so collections in forked
+    children don't write to (and copy) the pages they share with the parent.
+
+    Returns the names of resources that couldn't be loaded, e.g. optional models that
+    aren't installed or embeddings that can't be converted. These are logged, and loaded
+    lazily on first use instead.
+    """
+    failed = []
+    for name in names or list(_loaders):
+        try:
+            get(name)
+        except Exception:
+            logging.getLogger(__name__).warning('Failed to preload %s', name, exc_info=True)
+            failed.append(name)
+    gc.freeze()
+    return failed
@@ -1 +1 @@
-watchmedo auto-restart --directory=./ --pattern=*.py --recursive -- celery worker --app=server.celery --concurrency=1 --loglevel=INFO
+watchmedo auto-restart --directory=./ --pattern=*.py --recursive -- celery worker --app=server.celery --concurrency=${CELERY_CONCURRENCY:-4} --loglevel=INFO
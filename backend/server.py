@@ -7,6 +7,7 @@ import io
 import ujson as json
 
 from celery import Celery
+from celery.signals import worker_init
 from flask import Flask, jsonify, request, Response, make_response
 from flask_cors import CORS
 from flask_mail import Mail, Message
@@ -15,8 +16,10 @@ import jwt
 
 import config
 from database import db, User
+import formats
 import processing
 import projects
+import registry
 
 
 def make_celery(app):
@@ -52,6 +55,30 @@ with app.app_context():
     migrate = Migrate(app, db)
 
 
+@worker_init.connect
+def preload_resources(**kwargs):
+    """
+    Load shared resources once in the parent process, before workers are forked.
+
+    Runs in the Celery parent process, and on import of this module when `PRELOAD_ON_IMPORT`
+    is set for prefork WSGI servers (e.g. gunicorn --preload).
+    """
+    failed = registry.preload(app.config['PRELOAD_RESOURCES'])
+    if failed:
+        app.logger.warning('Resources not preloaded: {}'.format(', '.join(failed)))
+
+
+if app.config['PRELOAD_ON_IMPORT']:
+    preload_resources()
+
+
+@app.cli.command('build-term-trees')
+def build_term_trees():
+    """Store the term trees of projects created before they were stored (see `projects.build_term_trees`)."""
+    built = projects.build_term_trees()
+    print('Built term trees of {} projects'.format(len(built)))
+
+
 def token_required(f):
     """Decorator to require JWT authentication token on request endpoints."""
     @wraps(f)
@@ -101,6 +128,17 @@ def check_project_access(f):
     return _verify
 
 
+def vary_on_accept(f):
+    """Decorator to mark responses negotiated on the Accept header, so caches keep one per format."""
+    @wraps(f)
+    def _vary(*args, **kwargs):
+        response = make_response(f(*args, **kwargs))
+        response.vary.add('Accept')
+        return response
+
+    return _vary
+
+
 # Views
 #
 @app.route('/register/', methods=['POST'])
@@ -238,11 +276,94 @@ def projects_list(current_user):
 @app.route('/projects/<id>/model', methods=['GET'])
 @token_required
 @check_project_access
+@vary_on_accept
 def model(current_user, id):
-    """Get recurrence model for the project."""
+    """
+    Get recurrence model for the project.
+
+    Clients accepting a `formats.MIMETYPES` type get the matrix in a binary format, otherwise JSON.
+    Passing `min_similarity` and/or `top_k` returns only significant cells of the matrix, as coordinates
+    (see `processing.generate_recurrence`), and passing `window` returns only the band of pairs at most
+    `window` utterances apart.
+    """
+    num_terms = request.args.get('num_terms', type=int, default=None)
+    model = request.args.get('model')
+    options = {
+        'n_themes': request.args.get('n_themes', type=int, default=3),
+        'min_similarity': request.args.get('min_similarity', type=float, default=None),
+        'top_k': request.args.get('top_k', type=int, default=None),
+        'window': request.args.get('window', type=int, default=None)
+    }
+    mimetype = request.accept_mimetypes.best_match(['application/json'] + list(formats.MIMETYPES))
+    try:
+        if mimetype in formats.MIMETYPES:
+            result = processing.generate_recurrence(
+                projects.get_project_dir(id), model, num_terms, as_array=True, **options
+            )
+            return Response(formats.encode_recurrence(result, formats.MIMETYPES[mimetype]), mimetype=mimetype)
+        result = processing.generate_recurrence(projects.get_project_dir(id), model, num_terms, **options)
+    except ValueError as e:
+        return Response(json.dumps({'msg': str(e)}), 400)
+    return json.dumps(result)
+
+
+@app.route('/projects/<id>/model/tile', methods=['GET'])
+@token_required
+@check_project_access
+@vary_on_accept
+def model_tile(current_user, id):
+    """
+    Get a tile of the recurrence model for the project, between independent ranges of rows and columns.
+
+    Clients accepting a `formats.MIMETYPES` type get the tile in a binary format, otherwise JSON.
+    """
+    num_terms = request.args.get('num_terms', type=int, default=None)
+    model = request.args.get('model')
+    row_start = request.args.get('row_start', type=int, default=0)
+    row_limit = request.args.get('row_limit', type=int, default=256)
+    col_start = request.args.get('col_start', type=int, default=0)
+    col_limit = request.args.get('col_limit', type=int, default=256)
+    try:
+        result = processing.generate_recurrence_tile(
+            projects.get_project_dir(id), model, num_terms,
+            rows=(row_start, row_start + row_limit), cols=(col_start, col_start + col_limit)
+        )
+    except ValueError as e:
+        return Response(json.dumps({'msg': str(e)}), 400)
+    mimetype = request.accept_mimetypes.best_match(['application/json'] + list(formats.MIMETYPES))
+    if mimetype in formats.MIMETYPES:
+        # Tiles between different ranges of rows and columns aren't symmetric
+        return Response(
+            formats.encode_recurrence(result, formats.MIMETYPES[mimetype], layout='dense'), mimetype=mimetype
+        )
+    result['recurrence_matrix'] = result['recurrence_matrix'].tolist()
+    return json.dumps(result)
+
+
+@app.route('/projects/<id>/model/overview', methods=['GET'])
+@token_required
+@check_project_access
+@vary_on_accept
+def model_overview(current_user, id):
+    """
+    Get an overview of the recurrence model for the project, pooled to at most `max_side` blocks wide.
+
+    Clients accepting a `formats.MIMETYPES` type get the overview in a binary format, otherwise JSON.
+    """
     num_terms = request.args.get('num_terms', type=int, default=None)
     model = request.args.get('model')
-    result = processing.generate_recurrence(projects.get_project_dir(id), model, num_terms)
+    max_side = request.args.get('max_side', type=int, default=512)
+    pooling = request.args.get('pooling', default='mean')
+    try:
+        result = processing.generate_recurrence_overview(
+            projects.get_project_dir(id), model, num_terms, max_side, pooling
+        )
+    except ValueError as e:
+        return Response(json.dumps({'msg': str(e)}), 400)
+    mimetype = request.accept_mimetypes.best_match(['application/json'] + list(formats.MIMETYPES))
+    if mimetype in formats.MIMETYPES:
+        return Response(formats.encode_recurrence(result, formats.MIMETYPES[mimetype]), mimetype=mimetype)
+    result['recurrence_matrix'] = result['recurrence_matrix'].tolist()
     return json.dumps(result)
 
 
@@ -322,6 +443,21 @@ def upload(current_user):
     return json.dumps(project.as_dict())
 
 
+@app.route('/projects/<id>/upload', methods=['POST'])
+@token_required
+@check_project_access
+def upload_append(current_user, id):
+    """Upload files to append their utterances to the project."""
+    files = list(request.files.values())
+    try:
+        project = projects.append(id, files)
+    except projects.ProjectError as e:
+        app.logger.error(e)
+        return Response(json.dumps({'msg': str(e)}), 400)
+
+    return json.dumps(project.as_dict())
+
+
 @app.route('/projects/<id>/exports/channel-similarity', methods=['GET'])
 @token_required
 @check_project_access
@@ -343,34 +479,92 @@ def download_channel_similarity(current_user, id):
     return response
 
 
-@app.route('/projects/<id>/exports/primitives', methods=['GET'])
+@app.route('/projects/<id>/exports/channel-similarity-sweep', methods=['GET'])
 @token_required
 @check_project_access
-def download_primitives(current_user, id):
-    """Download primtivies CSV with specified model parameters."""
+def download_channel_similarity_sweep(current_user, id):
+    """
+    Download one channel similarity CSV for each combination of several models and numbers of terms.
+
+    Models (at least one) and numbers of terms are given as repeated `model` and `num_terms` parameters
+    ('all' for all terms).
+    """
     project = projects.get(id)
-    num_terms = request.args.get('num_terms', type=int, default=None)
-    model = request.args.get('model')
-    result = processing.generate_primitives(projects.get_project_dir(id), model, num_terms)
-    fields = result[0]._fields
+    models = request.args.getlist('model')
     f = io.StringIO()
     writer = csv.writer(f)
-    headers = ['Utterance']
-    headers.extend(fields)
-    writer.writerow(headers)
-    for i, r in enumerate(result):
-        row = [i + 1]
-        row.extend([getattr(r, field) for field in fields])
-        writer.writerow(row)
+    writer.writerow(['Model', 'Num Terms', 'From', 'To', 'Cumulative Similarity', 'Count'])
+    try:
+        num_terms_values = [
+            None if num_terms in ('', 'all') else int(num_terms) for num_terms in request.args.getlist('num_terms')
+        ] or [None]
+        sweep = processing.generate_channel_similarity_sweep(projects.get_project_dir(id), models, num_terms_values)
+        for row in sweep:
+            writer.writerow([row[0], row[1] or 'all'] + list(row[2:]))
+    except ValueError as e:
+        return Response(json.dumps({'msg': str(e)}), 400)
     f.seek(0)
     response = make_response(f.read())
-    filename = '{}-primitives-{}-{}.csv'.format(project.name, model, num_terms or 'all')
+    filename = '{}-channel-similarity-sweep.csv'.format(project.name)
     response.headers['Content-Disposition'] = 'attachment; filename=' + filename
     response.mimetype = 'text/csv'
 
     return response
 
 
+@app.route('/projects/<id>/exports/primitives', methods=['GET'])
+@token_required
+@check_project_access
+def download_primitives(current_user, id):
+    """
+    Download primtivies CSV with specified model parameters.
+
+    `ranges` optionally lists the numbers of neighbours to average over, comma separated ('long' for
+    all neighbours), e.g. '1,2,5,10,25,long'. The CSV is written incrementally as primitives are computed.
+    """
+    project = projects.get(id)
+    num_terms = request.args.get('num_terms', type=int, default=None)
+    model = request.args.get('model')
+    window = request.args.get('window', type=int, default=None)
+    try:
+        ranges = processing.PRIMITIVE_RANGES
+        if request.args.get('ranges'):
+            ranges = [
+                None if limit.strip() == 'long' else int(limit) for limit in request.args['ranges'].split(',')
+            ]
+        if window is not None:
+            if len(ranges) != 3 or ranges[2] is not None:
+                raise ValueError('Banded primitives take short, medium and long ranges')
+            rows = iter(processing.generate_primitives(
+                projects.get_project_dir(id), model, num_terms, *ranges[:2], window=window
+            ))
+        else:
+            rows = processing.iter_primitives(projects.get_project_dir(id), model, num_terms, ranges)
+        first_row = next(rows, None)
+    except ValueError as e:
+        return Response(json.dumps({'msg': str(e)}), 400)
+
+    def generate_csv():
+        f = io.StringIO()
+        writer = csv.writer(f)
+        writer.writerow(['Utterance'] + processing.primitive_fields(ranges))
+        if first_row is not None:
+            writer.writerow([1] + list(first_row))
+        for i, row in enumerate(rows, 2):
+            writer.writerow([i] + list(row))
+            if f.tell() > 64 * 1024:
+                yield f.getvalue()
+                f.seek(0)
+                f.truncate()
+        yield f.getvalue()
+
+    filename = '{}-primitives-{}-{}.csv'.format(project.name, model, num_terms or 'all')
+    response = Response(generate_csv(), mimetype='text/csv')
+    response.headers['Content-Disposition'] = 'attachment; filename=' + filename
+
+    return response
+
+
 @app.route('/cluster', methods=['GET'])
 @token_required
 @check_project_access
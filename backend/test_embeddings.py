@@ -0,0 +1,71 @@
+"""Tests for the embeddings module."""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import embeddings
+
+
+class TestEmbeddings:
+    """Test conversion and loading of the binary embedding store."""
+
+    def setup_class(self):
+        """Write small text embeddings and convert them."""
+        self.dir = tempfile.mkdtemp()
+        with open(os.path.join(self.dir, 'paragram-phrase-XXL.txt'), 'w', encoding='utf-8') as f:
+            f.write('hello 1.0 0.0 0.5\n')
+            f.write('world 0.0 1.0 0.25\n')
+        with open(os.path.join(self.dir, 'zh.tsv'), 'w', encoding='utf-8') as f:
+            f.write('你好\t0.5,0.5,0.5\n')
+            f.write('hello\t9.0,9.0,9.0\n')
+        self.store_dir = os.path.join(self.dir, 'embeddings')
+        self.store = embeddings.load(self.store_dir, self.dir)
+
+    def teardown_class(self):
+        """Cleanup."""
+        shutil.rmtree(self.dir, True)
+
+    def test_store(self):
+        """Test vocabulary and vector lookups."""
+        assert len(self.store) == 3
+        assert self.store.vectors.dtype == np.float32
+        assert isinstance(self.store.vectors, np.memmap)
+        assert '你好' in self.store and 'missing' not in self.store
+
+        # PP-XXL takes precedence over ZH
+        rows, skipped_terms = self.store.get_rows(['hello', 'missing', '你好'])
+        assert skipped_terms == ['missing']
+        assert np.allclose(self.store.vectors[rows], [[1.0, 0.0, 0.5], [0.5, 0.5, 0.5]])
+
+        vectors = self.store.get_vectors(['world', 'missing'])
+        assert np.allclose(vectors, [[0.0, 1.0, 0.25], [0.0, 0.0, 0.0]])
+
+    def test_quantize(self):
+        """Test quantized round trips stay close to the float32 vectors."""
+        vectors = np.random.RandomState(0).normal(size=(20, 300)).astype(np.float32)
+        vectors[3] = 0
+        for precision, tolerance in (('float32', 0), ('float16', 1e-2), ('int8', 5e-2)):
+            data, scales = embeddings.quantize(vectors, precision)
+            assert data.dtype == np.dtype(precision)
+            assert (scales is not None) == (precision == 'int8')
+            restored = embeddings.dequantize(data, scales)
+            assert np.abs(restored - vectors).max() <= tolerance
+            assert not restored[3].any()
+
+    def test_quantized_store(self):
+        """Test loading a quantized variant of the store."""
+        store = embeddings.load(self.store_dir, self.dir, precision='int8')
+        assert store.vectors.dtype == np.int8
+        assert np.allclose(store.get_vectors(['hello']), [[1.0, 0.0, 0.5]], atol=0.01)
+
+    def test_layout(self):
+        """Test building and looking up the global layout of the store."""
+        assert self.store.layout is None
+        embeddings.build_layout(self.store_dir)
+        store = embeddings.load(self.store_dir, self.dir)
+        positions, skipped_terms = store.get_layout(['你好', 'missing', 'hello'])
+        assert skipped_terms == ['missing']
+        assert positions.shape == (2, 2)
+        assert np.allclose(positions, store.layout[[2, 0]])
@@ -0,0 +1,52 @@
+"""Tests for the binary recurrence formats."""
+import numpy as np
+
+import formats
+
+
+class TestFormats:
+    """Test encoding recurrence as binary payloads."""
+
+    def setup_class(self):
+        """Setup."""
+        rng = np.random.RandomState(0)
+        self.matrix = rng.uniform(-1, 1, (40, 40)).astype(np.float32)
+        self.matrix = (self.matrix + self.matrix.T) / 2
+        self.result = {
+            'utterances': [{'id': i} for i in range(40)], 'channels': ['A', 'B'], 'utterance_count': 40,
+            'recurrence_matrix': self.matrix
+        }
+
+    def test_round_trip(self):
+        """Test decoding each encoding back to the matrix."""
+        for encoding, tolerance in (('float16', 1e-3), ('uint8', 1 / 255)):
+            payload = b''.join(formats.encode_recurrence(self.result, encoding))
+            header, matrix = formats.decode(payload)
+            assert header['utterances'] == self.result['utterances'] and header['channels'] == ['A', 'B']
+            assert header['encoding'] == encoding
+            assert np.allclose(matrix, self.matrix, atol=tolerance)
+
+    def test_payload_size(self):
+        """Test values are sent once per pair, aligned after the header."""
+        payload = formats.encode_recurrence(self.result, 'uint8')
+        assert (len(payload[0]) + len(payload[1])) % 8 == 0
+        assert len(payload[2]) == 40 * 41 // 2
+
+    def test_coordinates(self):
+        """Test sparse matrices are sent as coordinates."""
+        rows, cols = np.nonzero(np.abs(self.matrix) > 0.9)
+        result = dict(self.result, recurrence_matrix={
+            'shape': (40, 40), 'rows': rows, 'cols': cols, 'values': self.matrix[rows, cols]
+        })
+        header, matrix = formats.decode(b''.join(formats.encode_recurrence(result, 'float16')))
+        assert header['layout'] == 'coordinates' and matrix['shape'] == [40, 40]
+        assert np.array_equal(matrix['rows'], rows) and np.array_equal(matrix['cols'], cols)
+        assert np.allclose(matrix['values'], self.matrix[rows, cols], atol=1e-3)
+
+    def test_dense(self):
+        """Test tiles are sent with all their values in the dense layout."""
+        tile = self.matrix[5:10, 20:40]
+        result = dict(self.result, rows=(5, 10), cols=(20, 40), recurrence_matrix=tile)
+        header, matrix = formats.decode(b''.join(formats.encode_recurrence(result, 'float16', layout='dense')))
+        assert header['layout'] == 'dense' and header['shape'] == [5, 20]
+        assert np.allclose(matrix, tile, atol=1e-3)
@@ -0,0 +1,51 @@
+"""Tests for the layout module."""
+import numpy as np
+import pytest
+
+import layout
+
+
+class TestLayout:
+    """Test 2D layout of term vectors."""
+
+    def setup_class(self):
+        """Setup clusters of random vectors."""
+        random = np.random.RandomState(1)
+        self.labels = random.randint(8, size=600)
+        self.vectors = random.normal(size=(8, 50))[self.labels] + random.normal(size=(600, 50)) * 0.3
+
+    def test_umap_layout(self):
+        """Test the default layout keeps clusters together, the same way every time."""
+        fractions = []
+        positions = layout.layout(self.vectors, 'umap', progress=fractions.append)
+        assert positions.shape == (600, 2) and np.isfinite(positions).all()
+        assert np.array_equal(positions, layout.layout(self.vectors, 'umap'))
+        assert fractions == sorted(fractions) and fractions[-1] == 1
+
+        # Nearest terms in the layout are of the same cluster
+        distances = ((positions[:, None, :] - positions[None, :, :]) ** 2).sum(axis=2)
+        np.fill_diagonal(distances, np.inf)
+        assert np.mean(self.labels[distances.argmin(axis=1)] == self.labels) > 0.95
+
+    def test_nearest_neighbours(self):
+        """Test approximate nearest neighbours match exact ones."""
+        exact, distances = layout.nearest_neighbours(self.vectors, 5)
+        normalized = self.vectors / np.linalg.norm(self.vectors, axis=1)[:, None]
+        similarities = normalized @ normalized.T
+        np.fill_diagonal(similarities, -np.inf)
+        assert np.array_equal(exact[:, 0], similarities.argmax(axis=1))
+        assert distances[:, 0] == pytest.approx(1 - similarities.max(axis=1), abs=1e-5)
+
+        layout.EXACT_NEIGHBOURS, exact_neighbours = 100, layout.EXACT_NEIGHBOURS
+        try:
+            approximate, _ = layout.nearest_neighbours(self.vectors, 5)
+        finally:
+            layout.EXACT_NEIGHBOURS = exact_neighbours
+        assert np.mean([len(set(a) & set(e)) / 5 for a, e in zip(approximate, exact)]) > 0.9
+
+    def test_small_layouts(self):
+        """Test layouts of fewer terms than neighbours."""
+        for n in range(5):
+            assert layout.layout(self.vectors[:n]).shape == (n, 2)
+        with pytest.raises(ValueError):
+            layout.layout(self.vectors, 'unknown')
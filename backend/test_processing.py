@@ -1,13 +1,15 @@
 """Tests for the processing module."""
-from flask import Flask
+import os
+import shutil
+import sqlite3
+
 import numpy as np
-from sqlalchemy.orm import sessionmaker
-from werkzeug.datastructures import FileStorage
+import pytest
 
-from database import db
+import cache
 import processing
 import projects
-import server
+import recurrence
 
 
 class TestProcessing:
@@ -19,22 +21,17 @@ class TestProcessing:
 
     def setup_class(self):
         """Setup."""
-        self.app = Flask(__name__)
-        db.init_app(self.app)
-        with self.app.app_context():
-            db.create_all()
-            p = projects.find('__test__')
-            if p:
-                projects.delete(p.id)
-            f = open(TestProcessing.TEST_FILE, 'rb')
-            self.project = projects.create('__test__', [FileStorage(f, f.name)])
-            print(self.project.id, 'hello')
-            self.project_path = self.project.get_path()
+        # Index the data directly, without the application database
+        self.project = projects.Project(None, '__test__', 'english', 'utterances')
+        self.project.id = '__test__'
+        shutil.rmtree(self.project.get_path(), True)
+        with open(TestProcessing.TEST_FILE, encoding='utf-8', errors='ignore') as f:
+            self.project.add_data({os.path.basename(TestProcessing.TEST_FILE): f.read()})
+        self.project_path = self.project.get_path()
 
     def teardown_class(self):
         """Cleanup."""
-        with self.app.app_context():
-            projects.delete(self.project.id)
+        shutil.rmtree(self.project_path, True)
 
     def test_cluster_layout(self):
         """Test generation of the cluster layout for an existing index."""
@@ -43,8 +40,13 @@ class TestProcessing:
         # print(index_reader.get_cluster_layout())
 
     def test_generate_term_matrix(self):
-        """Test generation of term x term matrix."""
-        processing.generate_term_matrix(self.project_path)
+        """Test generation of utterance x term matrix."""
+        matrix = processing.generate_term_matrix(self.project_path)
+        terms = self.project.get_reader().get_terms_ordered()
+        assert matrix.shape == (TestProcessing.N, len(terms))
+        assert matrix.nnz == sum(len(u['terms']) for u in processing.generate_recurrence(
+            self.project_path, 'term', limit=None, include_text=False
+        )['utterances'])
 
     def test_recurrence(self):
         """Test generating recurrence for index."""
@@ -56,15 +58,175 @@ class TestProcessing:
         result = processing.generate_recurrence(self.project_path, 'composition')
         assert len(result['utterances']) == n and len(result['recurrence_matrix']) == n
 
+    def test_cosine_recurrence(self):
+        """Test sparse and dense utterance embeddings give the same recurrence."""
+        matrix = processing.generate_term_matrix(self.project_path)
+        recurrence_matrix = processing.cosine_recurrence(matrix)
+        assert np.allclose(recurrence_matrix, processing.cosine_recurrence(matrix.toarray()))
+        assert np.all(np.diag(recurrence_matrix) == 1)
+
+    def test_recurrence_file(self, tmp_path):
+        """Test tiled recurrence written to a memory-mapped file matches the in-memory matrix."""
+        embeddings = processing.load_recurrence_model(self.project_path, 'composition-delta', limit=None)['embeddings']
+        matrix = recurrence.compute(embeddings, str(tmp_path / 'recurrence.npy'), memory_limit=32 * 40 ** 2)
+        assert isinstance(matrix, np.memmap)
+        assert np.allclose(matrix, embeddings.tile(), atol=1e-6)
+        assert np.allclose(recurrence.compute_matrix(embeddings, workers=3, block_size=17), embeddings.tile())
+
+    def test_recurrence_cache(self):
+        """Test recurrence matrices are cached, shared between ranges and invalidated with the index."""
+        os.utime(os.path.join(self.project_path, 'index.db'), ns=(1, 1))
+        assert os.listdir(cache.Cache(self.project_path).directory) == [cache.STAMP_FILE]
+
+        expected = processing.generate_recurrence(self.project_path, 'composition', limit=None)['recurrence_matrix']
+        result = processing.load_recurrence(self.project_path, 'composition', start=10, limit=20)
+        assert isinstance(result['recurrence_matrix'], np.memmap)
+        assert np.allclose(result['recurrence_matrix'], np.array(expected)[10:30, 10:30])
+        assert result['utterances'][0]['text']
+        cached = cache.Cache(self.project_path).get_json('utterances', {
+            'model': 'composition', 'delta': False, 'num_terms': None, 'start': 10, 'limit': 20, 'n_themes': 3
+        })
+        assert 'text' not in cached['utterances'][0]
+        assert cache.Cache(self.project_path).find_matrices('recurrence') == [
+            {'model': 'composition', 'delta': False, 'num_terms': None}
+        ]
+
+        project_cache = cache.Cache(self.project_path, budget=0)
+        project_cache.put_json('a', {}, 1)
+        project_cache.put_json('b', {}, 2)
+        assert project_cache.get_json('a', {}) is None and project_cache.get_json('b', {}) == 2
+
+        # Parts of a matrix are kept and evicted together
+        from scipy.sparse import csr_matrix
+        sparse = project_cache.put_matrix('c', {}, csr_matrix(np.eye(3)))
+        assert np.array_equal(sparse.toarray(), np.eye(3))
+        project_cache.put_matrix('d', {}, np.ones(2))
+        assert project_cache.get_matrix('c', {}) is None
+        assert len(os.listdir(project_cache.directory)) == 3  # Stamp, and description and data of 'd'
+
+    def test_recurrence_tile(self):
+        """Test tiles between independent ranges of rows and columns, from cached embeddings."""
+        for model in ('composition-delta', 'term'):
+            expected = processing.generate_recurrence(self.project_path, model, limit=None)['recurrence_matrix']
+            expected = np.array(expected)
+            for _ in range(2):  # Computed, then cached
+                result = processing.generate_recurrence_tile(self.project_path, model, rows=(5, 20), cols=(100, 200))
+                assert result['rows'] == (5, 20) and result['cols'] == (100, TestProcessing.N)
+                assert np.allclose(result['recurrence_matrix'], expected[5:20, 100:], atol=1e-6)
+        invalid = (('term', (-5, 10), (0, 10)), ('term', (0, 10), (10, 10)), ('unknown', (0, 10), (0, 10)))
+        for model, rows, cols in invalid:
+            with pytest.raises(ValueError):
+                processing.generate_recurrence_tile(self.project_path, model, rows=rows, cols=cols)
+
+    def test_recurrence_pyramid(self):
+        """Test pooled levels of the recurrence pyramid."""
+        embeddings = processing.load_recurrence_model(self.project_path, 'composition-delta', limit=None)['embeddings']
+        dense = embeddings.tile()
+        levels = recurrence.compute_pyramid(embeddings, max_side=40, block_size=8)
+        assert [factor for factor, _, _ in levels] == [4, 8, 16, 32, 64, 128]
+        for factor, means, maxes in levels:
+            side = -(-TestProcessing.N // factor)
+            assert means.shape == maxes.shape == (side, side)
+            block = dense[:factor, (side - 1) * factor:]
+            assert means[0, -1] == pytest.approx(block.mean())
+            assert maxes[0, -1] == pytest.approx(block.max())
+            if side > 1:
+                assert means[1, 0] == pytest.approx(dense[factor:2 * factor, :factor].mean())
+        assert levels[-1][1][0, 0] == pytest.approx(dense.mean())
+
+        result = processing.generate_recurrence_overview(self.project_path, 'composition-delta', max_side=20)
+        assert result['factor'] == 8 and result['recurrence_matrix'].shape == (16, 16)
+        for options in ({'pooling': 'median'}, {'max_side': 0}):
+            with pytest.raises(ValueError):
+                processing.generate_recurrence_overview(self.project_path, 'composition-delta', **options)
+
+    def test_sparse_recurrence(self):
+        """Test sparse recurrence keeps the significant cells of the dense matrix."""
+        embeddings = processing.load_recurrence_model(self.project_path, 'composition-delta', limit=None)['embeddings']
+        dense = embeddings.tile()
+        rows, cols, values = recurrence.compute_sparse(embeddings, min_similarity=0.5, block_size=17)
+        assert np.array_equal(np.stack([rows, cols]), np.nonzero(np.abs(dense) >= 0.5))
+        assert np.allclose(values, dense[rows, cols])
+
+        rows, cols, values = recurrence.compute_sparse(embeddings, top_k=5, block_size=17)
+        assert np.array_equal(np.bincount(rows, minlength=len(dense)), np.minimum((dense != 0).sum(axis=1), 5))
+        assert np.all(np.abs(values) >= -np.sort(-np.abs(dense))[rows, 4] - 1e-9)
+
+        for options in ({'top_k': 0}, {'min_similarity': 1.5}, {'min_similarity': -0.5}):
+            with pytest.raises(ValueError):
+                processing.generate_recurrence(self.project_path, 'composition-delta', **options)
+
+    def test_banded_recurrence(self):
+        """Test the recurrence band matches the diagonals of the dense matrix."""
+        embeddings = processing.load_recurrence_model(self.project_path, 'composition-delta', limit=None)['embeddings']
+        dense = embeddings.tile()
+        band = recurrence.compute_band(embeddings, 3, block_size=17)
+        assert band.shape == (TestProcessing.N, 7)
+        for offset in range(-3, 4):
+            rows = np.arange(max(0, -offset), min(TestProcessing.N, TestProcessing.N - offset))
+            assert np.allclose(band[rows, 3 + offset], dense[rows, rows + offset])
+        rows = np.array([0, 5, 100])
+        cols = np.array([2, 60, 100])
+        assert np.allclose(recurrence.band_values(band, embeddings, rows, cols), dense[rows, cols])
+
+        for expected, actual in zip(
+            processing.generate_primitives(self.project_path, 'composition-delta'),
+            processing.generate_primitives(self.project_path, 'composition-delta', window=3)
+        ):
+            assert actual == pytest.approx(expected, abs=1e-6)
+        with pytest.raises(ValueError):
+            processing.generate_primitives(self.project_path, 'composition-delta', window=0)
+
     def test_channel_similarity(self):
         """Test generation of channel similarity export for an index."""
+        cache.Cache(self.project_path).clear()
         result = list(processing.generate_channel_similarity(self.project_path, 'composition'))
         assert(len(result[0])) == 4
+        params = {'model': 'composition', 'delta': False, 'num_terms': None}
+        assert cache.Cache(self.project_path).get_matrix('recurrence', params) is not None
+
+        # Compare with summing over all forward pairs of utterances
+        recurrence = processing.generate_recurrence(self.project_path, 'composition', limit=None, include_text=False)
+        similarities = np.array(recurrence['recurrence_matrix'])
+        expected = {}
+        for u1 in recurrence['utterances']:
+            for u2 in recurrence['utterances'][u1['id'] + 1:]:
+                similarity, count = expected.get((u1['channel'], u2['channel']), (0, 0))
+                expected[(u1['channel'], u2['channel'])] = (similarity + similarities[u1['id'], u2['id']], count + 1)
+        assert [(ch1, ch2) for ch1, ch2, _, _ in result] == list(expected)
+        for ch1, ch2, similarity, count in result:
+            assert similarity == pytest.approx(expected[(ch1, ch2)][0], rel=1e-5)
+            assert count == expected[(ch1, ch2)][1]
+
+        # Now from the cached matrix
+        cached = list(processing.generate_channel_similarity(self.project_path, 'composition'))
+        assert [row[:2] + row[3:] for row in cached] == [row[:2] + row[3:] for row in result]
+        assert [row[2] for row in cached] == pytest.approx([row[2] for row in result], rel=1e-5)
+
+    def test_channel_similarity_sweep(self):
+        """Test a sweep over models and numbers of terms matches separate channel similarity exports."""
+        configurations = [(model, num_terms) for model in ('composition-delta', 'term') for num_terms in (None, 50)]
+        expected = [
+            (model, num_terms) + row
+            for model, num_terms in configurations
+            for row in processing.generate_channel_similarity(self.project_path, model, num_terms)
+        ]
+        cache.Cache(self.project_path).clear()  # Compose the sweep's embeddings from its shared term matrix
+        result = list(processing.generate_channel_similarity_sweep(
+            self.project_path, ['composition-delta', 'term'], [None, 50]
+        ))
+        assert [row[:4] + row[5:] for row in result] == [row[:4] + row[5:] for row in expected]
+        assert [row[4] for row in result] == pytest.approx([row[4] for row in expected], abs=1e-6)
+        with pytest.raises(ValueError):
+            list(processing.generate_channel_similarity_sweep(self.project_path, [], [None]))
 
     def test_primitives(self):
         """Test generation of primitives export for an index."""
         similarities = np.array(processing.generate_recurrence(self.project_path, 'term')['recurrence_matrix'])
+        cache.Cache(self.project_path).clear()
         result = processing.generate_primitives(self.project_path, 'term')
+        params = {'model': 'term', 'delta': False, 'num_terms': None}
+        assert cache.Cache(self.project_path).get_matrix('recurrence', params) is not None
 
         def assert_primitive(index, end, field):
             # Determine step
@@ -94,7 +256,7 @@ class TestProcessing:
                 v2 += similarities[index, i]
                 n_samples += 1
                 i += step
-            assert v1 == v2 / n_samples
+            assert v1 == pytest.approx(v2 / n_samples)  # stored recurrence is float32
 
         # Sanity checking
         r0 = result[0]
@@ -124,6 +286,36 @@ class TestProcessing:
         assert_primitive(22, 41, 'other_forward_medium')
         assert_primitive(6, 119, 'other_forward_long')
 
+    def test_primitive_ranges(self):
+        """Test primitives streamed from recurrence rows for a list of ranges."""
+        similarities = processing.load_utterance_embeddings(self.project_path, 'composition-delta').tile()
+        channels = [u[1] for u in self.project.get_reader().get_utterances()]
+        ranges = [1, 2, 5, 10, 25, None]
+        fields = processing.primitive_fields(ranges)
+        assert len(fields) == 24 and fields[5] == 'self_backward_long' and fields[6] == 'self_forward_1'
+        result = list(processing.iter_primitives(
+            self.project_path, 'composition-delta', ranges=ranges, memory_limit=32 * 40 * TestProcessing.N
+        ))
+        assert len(result) == TestProcessing.N
+
+        for index in (0, 30, 61, 120):
+            self_ids = [i for i, channel in enumerate(channels) if channel == channels[index]]
+            other_ids = [i for i, channel in enumerate(channels) if channel != channels[index]]
+            neighbours = (
+                [i for i in self_ids if i < index][::-1], [i for i in self_ids if i > index],
+                [i for i in other_ids if i < index][::-1], [i for i in other_ids if i > index]
+            )
+            expected = [
+                np.mean(similarities[index, ids[:limit]]) if ids else 0 for ids in neighbours for limit in ranges
+            ]
+            assert result[index] == pytest.approx(expected)
+
+        for ranges in ([0, None], [-2, 10, None], [2, None, None], [2, 2, None]):
+            with pytest.raises(ValueError):
+                next(processing.iter_primitives(self.project_path, 'composition-delta', ranges=ranges))
+        with pytest.raises(ValueError):
+            processing.generate_primitives(self.project_path, 'composition-delta', short_range=0, window=5)
+
     def test_similar_terms(self):
         """Test detection of similar terms for corpus."""
         index_reader = self.project.get_reader()
@@ -134,6 +326,33 @@ class TestProcessing:
         # assertion
         # processing.generate_term_clusters(terms, similarities)
 
+    def test_term_tree(self):
+        """Test clusters cut from the stored term tree match those of all pairwise distances."""
+        index_reader = self.project.get_reader()
+        ignored_terms = index_reader.get_ignored_terms()
+        terms = [t for t in index_reader.get_terms_ordered() if t not in ignored_terms]
+        layout = index_reader.get_term_layout()
+        positions = [layout[term] for term in terms]
+        edges, mean_distance = index_reader.get_term_tree()
+        assert len(edges) == len(terms) - 1
+        for threshold in (0.01, 0.05, 0.2):
+            expected = processing.generate_term_clusters(terms, processing.find_similar_terms(positions, threshold))
+            clusters = self.project.generate_term_clusters(threshold)
+            assert clusters == expected and list(clusters) == list(expected)
+
+        # Computed without writing the index (and so invalidating the cache) for older indexes
+        connection = sqlite3.connect(os.path.join(self.project_path, 'index.db'))
+        connection.executescript('drop table term_tree; drop table term_layout_stats;')
+        connection.close()
+        stat = os.stat(os.path.join(self.project_path, 'index.db'))
+        assert self.project.generate_term_clusters() == processing.generate_term_clusters(
+            terms, processing.find_similar_terms(positions, 0.01)
+        )
+        assert os.stat(os.path.join(self.project_path, 'index.db')).st_mtime_ns == stat.st_mtime_ns
+        assert self.project.get_reader().get_term_tree() is None
+        self.project._create_term_tree()  # As by `projects.build_term_trees`
+        assert self.project.get_reader().get_term_tree()[1] == pytest.approx(mean_distance)
+
     def test_themes(self):
         """Test theme inference for utterances."""
         result = processing.generate_recurrence(self.project_path, 'composition')
@@ -144,7 +363,32 @@ class TestProcessing:
         for u in result['utterances']:
             themes.update(set(u['themes']))
         assert len(themes) == 176
+        result = processing.generate_recurrence(self.project_path, 'composition', n_themes=1)
+        assert all(len(u['themes']) <= 1 for u in result['utterances'])
+
+    def test_infer_themes(self):
+        """Test batched theme inference matches a nearest neighbour search."""
+        from scipy import spatial
+        random = np.random.RandomState(0)
+        concept_vectors = random.normal(size=(50, 10))
+        utterance_embeddings = random.normal(size=(20, 10))
+        themes = processing.infer_themes(utterance_embeddings, concept_vectors, 3, block_size=7)
+        assert (themes == spatial.cKDTree(concept_vectors).query(utterance_embeddings, k=3)[1]).all()
 
     def test_model(self):
         """Test modelling an index."""
         # processing.generate_model(self.data_dir, filter_terms=True)
+
+
+class TestTermDistances:
+    """Test distances between term positions, without a project."""
+
+    def test_similar_terms(self):
+        """Test similar terms and the mean distance match all pairwise distances."""
+        from scipy.spatial import distance
+        positions = np.random.RandomState(0).normal(size=(500, 2))
+        distances = distance.cdist(positions, positions)
+        assert processing.mean_distance(positions, block_pairs=1000) == pytest.approx(distances.mean())
+        assert processing.mean_distance(positions, sample_size=20000) == pytest.approx(distances.mean(), rel=0.05)
+        similar = processing.find_similar_terms(positions, 0.1)
+        assert (similar.toarray() == (distances <= distances.mean() * 0.1)).all()
@@ -1,9 +1,18 @@
 """Tests for the projects module."""
+import csv
+import io
 import os
+import shutil
 
+import numpy as np
+import pytest
 from werkzeug.datastructures import FileStorage
 
+import cache
+from index import IndexUpdater
+import processing
 import projects
+import server
 
 
 class TestProjects:
@@ -15,9 +24,10 @@ class TestProjects:
 
     def teardown_method(self):
         """Cleanup."""
-        project = projects.find(self.name)
-        if project:
-            projects.delete(project.id)
+        with server.app.app_context():
+            project = projects.find(self.name)
+            if project:
+                projects.delete(project.id)
 
     def test_project(self):
         """Test creation and deletion of project."""
@@ -29,6 +39,8 @@ class TestProjects:
         term_positions = list(project.get_reader().get_term_layout())
         assert len(term_positions) == \
             len(project.get_reader().get_terms_ordered()) - len(project.get_reader().get_ignored_terms())
+        term_embeddings = project.get_reader().get_term_embeddings()
+        assert term_embeddings.shape[0] == len(project.get_reader().get_terms_ordered())
         project.generate_recurrence('composition')
 
         assert len(projects.listall()) == num_projects + 1
@@ -48,3 +60,76 @@ class TestProjects:
         assert len(term_positions) == \
             len(project.get_reader().get_terms_ordered()) - len(project.get_reader().get_ignored_terms())
         project.generate_recurrence('composition')
+
+    def test_append(self):
+        """Test appending utterances to a project matches indexing them all at once."""
+        with open(os.path.join('test_data', 'denton-kennet.csv'), encoding='utf-8', errors='ignore') as f:
+            rows = list(csv.reader(f))
+
+        def data(rows):
+            f = io.StringIO()
+            csv.writer(f).writerows(rows)
+            return {'denton-kennet.csv': f.getvalue()}
+
+        full = projects.Project(None, self.name, 'english', 'utterances')
+        full.id = '__test_full__'
+        appended = projects.Project(None, self.name, 'english', 'utterances')
+        appended.id = '__test_appended__'
+        try:
+            full.add_data(data(rows))
+            appended.add_data(data(rows[:80]))
+            models = ('composition-delta', 'term')
+            for model in models:
+                processing.generate_recurrence(appended.get_path(), model, limit=None)
+            processing.load_utterance_embeddings(appended.get_path(), 'term')
+            appended.append_data(data(rows[:1] + rows[80:120]))
+            appended.append_data(data(rows[:1] + rows[120:]))
+            appended_cache = cache.Cache(appended.get_path())
+            assert len(appended_cache.find_matrices('recurrence')) == len(models)
+            matrix = appended_cache.get_matrix('recurrence', {'model': 'term', 'delta': False, 'num_terms': None})
+            assert [len(block) for block in matrix.blocks] == [79, 40, len(rows) - 120]
+
+            reader = appended.get_reader()
+            assert reader.get_term_frequencies() == full.get_reader().get_term_frequencies()
+            assert reader.get_term_embeddings().shape[0] == len(reader.get_terms_ordered())
+            assert len(reader.get_term_layout()) == len(reader.get_terms_ordered()) - len(reader.get_ignored_terms())
+            assert reader.get_term_layout_mode() == 'project'
+            updater = IndexUpdater(appended.get_path())
+            updater.save_term_layout_mode('custom')
+            updater.finish()
+            assert appended.get_reader().get_term_layout_mode() == 'custom'
+            for model in models:
+                expected = processing.generate_recurrence(full.get_path(), model, limit=None)
+                result = processing.generate_recurrence(appended.get_path(), model, limit=None)
+                assert [u['terms'] for u in result['utterances']] == [u['terms'] for u in expected['utterances']]
+                assert np.allclose(result['recurrence_matrix'], expected['recurrence_matrix'], atol=1e-6)
+            tile = processing.generate_recurrence_tile(appended.get_path(), 'term', rows=(70, 90), cols=(0, 200))
+            assert np.allclose(tile['recurrence_matrix'], np.array(expected['recurrence_matrix'])[70:90], atol=1e-6)
+
+            # The tree and mean distance are extended to match those of all terms
+            layout = reader.get_term_layout()
+            positions = np.array(list(layout.values()))
+            edges, mean_distance = reader.get_term_tree()
+            assert len(edges) == len(layout) - 1
+            assert sum(d for _, _, d in edges) == pytest.approx(processing.generate_term_tree(positions)[2].sum())
+            assert mean_distance == pytest.approx(processing.mean_distance(positions))
+
+            # Errors restore the index, embeddings and cache as they were
+            def fail(terms, connection):
+                raise RuntimeError('Tree failed')
+
+            cache_files = sorted(os.listdir(appended_cache.directory))
+            terms = reader.get_terms_ordered()
+            term_embeddings = np.array(reader.get_term_embeddings())
+            appended._update_term_tree = fail
+            with pytest.raises(RuntimeError):
+                appended.append_data(data(rows[:1] + [[1, 'JEFF KENNETT', 'Quokkas and xylophones']]))
+            reader = appended.get_reader()
+            assert reader.get_utterance_count() == len(rows) - 1
+            assert reader.get_terms_ordered() == terms
+            assert np.array_equal(reader.get_term_embeddings(), term_embeddings)
+            assert sorted(os.listdir(cache.Cache(appended.get_path()).directory)) == cache_files
+            assert not [name for name in os.listdir(appended.get_path()) if name.startswith('.')]
+        finally:
+            shutil.rmtree(full.get_path(), True)
+            shutil.rmtree(appended.get_path(), True)
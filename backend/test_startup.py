@@ -0,0 +1,65 @@
+"""Tests for the startup cost of the API server."""
+import os
+import subprocess
+import sys
+
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+HEAVY_MODULES = ('scipy', 'sklearn', 'jieba', 'spacy')
+
+
+class TestStartup:
+    """Test that importing the server doesn't load heavy modules or resources."""
+
+    def test_import_time(self):
+        """Report import times of the server, like `python -X importtime`."""
+        process = subprocess.run(
+            [
+                sys.executable, '-X', 'importtime', '-c',
+                'import server, registry; assert not registry.loaded("embeddings")'
+            ],
+            cwd=BACKEND_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+        )
+        assert process.returncode == 0, process.stderr
+
+        # Parse "import time: self [us] | cumulative | imported package" lines
+        imports = []
+        for line in process.stderr.splitlines():
+            if line.startswith('import time:') and not line.endswith('imported package'):
+                self_us, cumulative_us, module = line[len('import time:'):].split('|')
+                imports.append((int(cumulative_us), int(self_us), module.strip()))
+
+        print('{:>12} {:>12}  {}'.format('cumulative', 'self', 'module'))
+        for cumulative_us, self_us, module in sorted(imports, reverse=True)[:25]:
+            print('{:>10}ms {:>10}ms  {}'.format(cumulative_us // 1000, self_us // 1000, module))
+
+        modules = set(module for _, _, module in imports)
+        for heavy_module in HEAVY_MODULES:
+            assert not any(m == heavy_module or m.startswith(heavy_module + '.') for m in modules), heavy_module
+
+    def test_preload(self):
+        """Test preloading resources before forking workers."""
+        process = subprocess.run(
+            [
+                sys.executable, '-c',
+                'import registry, text_util; '
+                'assert registry.preload(["stopwords"]) == []; '
+                'assert registry.loaded("stopwords") and not registry.loaded("jieba")'
+            ],
+            cwd=BACKEND_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+        )
+        assert process.returncode == 0, process.stderr
+
+    def test_preload_failure(self):
+        """Test resources that fail to preload are reported and left to load lazily."""
+        process = subprocess.run(
+            [
+                sys.executable, '-c',
+                'import registry; '
+                'registry.register("broken", lambda: int("not a number")); '
+                'assert registry.preload(["broken"]) == ["broken"]; '
+                'assert not registry.loaded("broken")'
+            ],
+            cwd=BACKEND_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+        )
+        assert process.returncode == 0, process.stderr
@@ -2,7 +2,7 @@
 import os
 import re
 
-import jieba
+import registry
 
 
 # Match all word contractions, except possessives which we split to retain the root owner.
@@ -25,10 +25,21 @@ RE_URL = u"((([A-Za-z]{3,9}:(?:\/\/)?)(?:[\-;:&=\+\$,\w]+@)?[A-Za-z0-9\.\-]+|(?:
 RE_TERM = re.compile(RE_URL + '|' + RE_EMAIL + '|' + RE_NUM + '|' + RE_CONTRACTION + '|' + RE_WORD, re.UNICODE)
 
 
-# Load stopwords
-STOPWORDS = None
-with open(os.path.join(os.path.dirname(__file__), 'resources', 'stopwords-english.txt')) as stopwords_file:
-    STOPWORDS = set([line.strip() for line in stopwords_file])
+def _load_stopwords():
+    """Load english stopwords."""
+    with open(os.path.join(os.path.dirname(__file__), 'resources', 'stopwords-english.txt')) as stopwords_file:
+        return set([line.strip() for line in stopwords_file])
+
+
+def _load_jieba():
+    """Import jieba and load its dictionary."""
+    import jieba
+    jieba.initialize()
+    return jieba
+
+
+registry.register('stopwords', _load_stopwords)
+registry.register('jieba', _load_jieba)
 
 
 def tokenize(text, language='english', lowercase=True, min_word_length=0, stopwords=None):
@@ -39,7 +50,7 @@ def tokenize(text, language='english', lowercase=True, min_word_length=0, stopwo
     """
     language = language.lower()
     if language == 'english':
-        stopwords = stopwords or STOPWORDS
+        stopwords = stopwords or registry.get('stopwords')
         if lowercase:
             text = text.lower()
         for match in RE_TERM.finditer(text):
@@ -47,7 +58,7 @@ def tokenize(text, language='english', lowercase=True, min_word_length=0, stopwo
             if len(word) >= min_word_length and word not in stopwords:
                 yield word
     elif language == 'chinese':
-        for word in jieba.cut(text):
+        for word in registry.get('jieba').cut(text):
             if RE_TERM.match(word):
                 yield word
     else:
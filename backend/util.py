@@ -2,12 +2,17 @@
 import numpy as np
 
 
-def generate_term_vectors(terms):
-    """Generate one-hot encoded term vectors for list of `terms`."""
-    base = np.zeros(len(terms))
-    term_vectors = {}
-    for i, term in enumerate(terms):
-        term_vectors[term] = np.copy(base)
-        term_vectors[term][i] = 1
+def normalize_rows(matrix):
+    """Scale the rows of dense or sparse `matrix` to unit length, leaving zero rows as zeros."""
+    from scipy import sparse
 
-    return term_vectors
+    if sparse.issparse(matrix):
+        matrix = sparse.csr_matrix(matrix, dtype=np.float64)
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    else:
+        matrix = np.asarray(matrix, dtype=np.float64)
+        norms = np.linalg.norm(matrix, axis=1)
+    scales = np.divide(1, norms, out=np.zeros_like(norms), where=norms > 0)
+    if sparse.issparse(matrix):
+        return sparse.diags(scales) @ matrix
+    return matrix * scales[:, None]